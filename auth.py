@@ -1,27 +1,158 @@
 import os
+import hashlib
+import secrets
+import time
+import uuid
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Optional
 
-from passlib.context import CryptContext
-from jose import JWTError, jwt
 from dotenv import load_dotenv
 
+from jwt_backends import InvalidTokenError, build_backend, parse_keys
+
 load_dotenv()
 
-# Configuración para hashing de contraseñas
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Política de hashing de contraseñas. PASSWORD_SCHEMES es una lista separada por comas: el
+# primer esquema se usa para los hashes nuevos y los demás solo para verificar hashes antiguos.
+# Un hash de otro esquema o con otros parámetros se marca como obsoleto y se rehashea tras un
+# login correcto (ver hashing.PasswordHasher.rehash_in_background).
+# "argon2" (argon2id) requiere el paquete argon2-cffi.
+PASSWORD_SCHEMES = [name.strip() for name in os.getenv("PASSWORD_SCHEMES", "bcrypt").split(",") if name.strip()]
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", 3))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", 65536)) # KiB
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", 4))
+
+
+# Construye un CryptContext con los parámetros indicados (o los del entorno)
+def build_pwd_context(
+    schemes=None,
+    bcrypt_rounds: int = BCRYPT_ROUNDS,
+    argon2_time_cost: int = ARGON2_TIME_COST,
+    argon2_memory_cost: int = ARGON2_MEMORY_COST,
+    argon2_parallelism: int = ARGON2_PARALLELISM,
+):
+    from passlib.context import CryptContext
+
+    schemes = list(schemes or PASSWORD_SCHEMES)
+    settings = {}
+    if "bcrypt" in schemes:
+        settings["bcrypt__rounds"] = bcrypt_rounds
+    if "argon2" in schemes:
+        settings.update(
+            argon2__type="ID",
+            argon2__time_cost=argon2_time_cost,
+            argon2__memory_cost=argon2_memory_cost,
+            argon2__parallelism=argon2_parallelism,
+        )
+    return CryptContext(schemes=schemes, deprecated="auto", **settings)
+
+
+# Contexto de hashing de contraseñas. passlib se importa al primer uso: los workers que solo
+# verifican JWT no lo cargan, y en el pool de procesos cada worker lo crea una sola vez.
+_pwd_context = None
+
+def get_pwd_context():
+    global _pwd_context
+    if _pwd_context is None:
+        _pwd_context = build_pwd_context()
+    return _pwd_context
 
 # Variables de entorno para JWT
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
+# Vida de los refresh tokens (rotan en cada uso)
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 14))
+# Si está activo, el token incluye id y email del usuario para resolverlo sin consultar la DB
+JWT_EMBED_CLAIMS = os.getenv("JWT_EMBED_CLAIMS", "false").lower() in ("1", "true", "yes")
+# Implementación de JWT: "jose" (python-jose) o "hmac" (librería estándar, más rápida)
+JWT_BACKEND = os.getenv("JWT_BACKEND", "jose")
+# Claves de firma para rotación: "kid1:secreto1,kid2:secreto2". Se firma con JWT_ACTIVE_KID.
+# Sin JWT_KEYS se usa SECRET_KEY como única clave.
+JWT_KEYS = parse_keys(os.getenv("JWT_KEYS", "")) or {"default": SECRET_KEY}
+JWT_ACTIVE_KID = os.getenv("JWT_ACTIVE_KID") or next(iter(JWT_KEYS))
+# Caché de tokens ya verificados
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", 300))
+
+# Los tokens sin "kid" (emitidos antes de configurar la rotación) se verifican con SECRET_KEY
+jwt_backend = build_backend(JWT_BACKEND, JWT_KEYS, JWT_ACTIVE_KID, ALGORITHM, legacy_key=SECRET_KEY)
 
 # Funciones de hashing de contraseñas
 def verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 def get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
+
+# Indica si el hash usa un esquema o parámetros distintos de los configurados.
+# No calcula ningún hash: se puede llamar desde el event loop.
+def password_needs_update(hashed_password: str) -> bool:
+    return get_pwd_context().needs_update(hashed_password)
+
+# Hashea un lote de contraseñas en una sola tarea del pool (importaciones masivas)
+def get_password_hashes(passwords: list) -> list:
+    pwd_context = get_pwd_context()
+    return [pwd_context.hash(password) for password in passwords]
+
+# Busca los parámetros más costosos cuya verificación no supere `target_seconds` en esta
+# máquina. bcrypt: número de rondas. argon2: time_cost con la memoria indicada (si ni
+# time_cost=1 entra en el objetivo, se reduce la memoria a la mitad). Devuelve las variables
+# de entorno a configurar y la latencia medida.
+def calibrate_password_hashing(
+    scheme: str,
+    target_seconds: float,
+    argon2_memory_cost: int = ARGON2_MEMORY_COST,
+    argon2_parallelism: int = ARGON2_PARALLELISM,
+    samples: int = 3,
+) -> dict:
+    def verify_seconds(context) -> float:
+        hashed = context.hash("calibration-password")
+        timings = []
+        for _ in range(samples):
+            start = time.perf_counter()
+            context.verify("calibration-password", hashed)
+            timings.append(time.perf_counter() - start)
+        return sorted(timings)[len(timings) // 2]
+
+    if scheme == "bcrypt":
+        best = None
+        for rounds in range(4, 20):
+            seconds = verify_seconds(build_pwd_context(["bcrypt"], bcrypt_rounds=rounds))
+            if seconds > target_seconds and best is not None:
+                break
+            best = ({"PASSWORD_SCHEMES": "bcrypt", "BCRYPT_ROUNDS": rounds}, seconds)
+            if seconds > target_seconds:
+                break # Ni el mínimo entra en el objetivo
+        settings, seconds = best
+    elif scheme == "argon2":
+        memory_cost = argon2_memory_cost
+        while True:
+            best = None
+            for time_cost in range(1, 21):
+                context = build_pwd_context(
+                    ["argon2"], argon2_time_cost=time_cost,
+                    argon2_memory_cost=memory_cost, argon2_parallelism=argon2_parallelism,
+                )
+                seconds = verify_seconds(context)
+                if seconds > target_seconds:
+                    break
+                best = (time_cost, seconds)
+            if best is not None or memory_cost <= 8 * argon2_parallelism:
+                break
+            memory_cost //= 2
+        time_cost, seconds = best or (1, seconds)
+        settings = {
+            "PASSWORD_SCHEMES": "argon2,bcrypt",
+            "ARGON2_TIME_COST": time_cost,
+            "ARGON2_MEMORY_COST": memory_cost,
+            "ARGON2_PARALLELISM": argon2_parallelism,
+        }
+    else:
+        raise ValueError(f"Esquema de hashing no soportado: {scheme!r}")
+    return {"settings": settings, "verify_seconds": seconds}
 
 # Funciones para JWT
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -31,16 +162,90 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.now(timezone.utc) + expires_delta
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    to_encode.update({"exp": expire, "iat": datetime.now(timezone.utc)})
+    to_encode.setdefault("jti", uuid.uuid4().hex) # Identificador único, necesario para revocarlo
+    encoded_jwt = jwt_backend.encode(to_encode)
     return encoded_jwt
 
-def decode_access_token(token: str):
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
+# Caché LRU de tokens verificados, indexada por el digest del token.
+# Una entrada nunca sobrevive al "exp" del token. Los claims devueltos son compartidos:
+# no deben modificarse.
+class TokenCache:
+    def __init__(self, max_entries: int = TOKEN_CACHE_SIZE, ttl: float = TOKEN_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[bytes, tuple]" = OrderedDict()
+        # Métricas
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self._key(token)
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.time():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
             return None
-        return username
-    except JWTError:
-        return None
\ No newline at end of file
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, token: str, claims: dict):
+        if self.max_entries <= 0:
+            return
+        expires_at = time.time() + self.ttl
+        if "exp" in claims:
+            expires_at = min(expires_at, claims["exp"])
+        key = self._key(token)
+        self._entries[key] = (claims, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+token_cache = TokenCache()
+
+# Devuelve todos los claims del token verificado, o None si no es válido
+def decode_access_token_claims(token: str) -> Optional[dict]:
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+    try:
+        payload = jwt_backend.decode(token)
+    except InvalidTokenError:
+        return None
+    if payload.get("sub") is None:
+        return None
+    token_cache.put(token, payload)
+    return payload
+
+def decode_access_token(token: str):
+    payload = decode_access_token_claims(token)
+    if payload is None:
+        return None
+    return payload.get("sub")
+
+# Refresh tokens opacos: al cliente se le entrega el token y en la DB solo se guarda su hash
+def create_refresh_token() -> str:
+    return secrets.token_urlsafe(32)
+
+def hash_refresh_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+# Claims que identifican al usuario dentro del token
+def build_user_claims(user) -> dict:
+    claims = {"sub": user.username, "uid": user.id, "ver": user.token_version or 0}
+    if JWT_EMBED_CLAIMS:
+        claims["email"] = user.email
+    return claims
\ No newline at end of file
@@ -1,9 +1,20 @@
 import os
 import httpx
 import base64
+import asyncio
+import time
+import importlib.util
+from datetime import date
+from typing import AsyncIterator, List, Optional, Sequence
 from dotenv import load_dotenv
 from fastapi import HTTPException, status
 
+import kvstore
+from cache import ResponseCache, build_backend
+from metrics import UPSTREAM_SECONDS
+from resilience import CircuitBreaker, CircuitOpenError, DeadlineExceededError, RetryPolicy, UpstreamPolicy
+from serialization import normalize
+
 load_dotenv()
 
 BELVO_SECRET_ID = os.getenv("BELVO_SECRET_ID")
@@ -14,6 +25,53 @@ BELVO_API_URL = os.getenv("BELVO_API_URL")
 # Link ID estático para las peticiones a la Mock API
 MOCK_LINK_ID = "8848bd0c-9c7e-4f53-a732-ec896b11d4c4"
 
+# Configuración del pool de conexiones HTTP hacia Belvo
+BELVO_MAX_CONNECTIONS = int(os.getenv("BELVO_MAX_CONNECTIONS", 100))
+BELVO_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("BELVO_MAX_KEEPALIVE_CONNECTIONS", 20))
+BELVO_KEEPALIVE_EXPIRY = float(os.getenv("BELVO_KEEPALIVE_EXPIRY", 30))
+BELVO_HTTP2 = os.getenv("BELVO_HTTP2", "false").lower() in ("1", "true", "yes")
+# Timeouts por defecto (segundos); cada llamada puede sobrescribirlos
+BELVO_CONNECT_TIMEOUT = float(os.getenv("BELVO_CONNECT_TIMEOUT", 5))
+BELVO_READ_TIMEOUT = float(os.getenv("BELVO_READ_TIMEOUT", 10))
+BELVO_POOL_TIMEOUT = float(os.getenv("BELVO_POOL_TIMEOUT", 5))
+# Política de llamadas a Belvo (ver resilience.py):
+# plazo total por llamada (incluidos los reintentos), reintentos de los GET con backoff,
+# circuit breaker y peticiones de cobertura (BELVO_HEDGE_DELAY=0 las desactiva)
+BELVO_REQUEST_DEADLINE = float(os.getenv("BELVO_REQUEST_DEADLINE", 20))
+BELVO_RETRY_ATTEMPTS = int(os.getenv("BELVO_RETRY_ATTEMPTS", 3))
+BELVO_RETRY_BASE_DELAY = float(os.getenv("BELVO_RETRY_BASE_DELAY", 0.2))
+BELVO_RETRY_MAX_DELAY = float(os.getenv("BELVO_RETRY_MAX_DELAY", 2))
+BELVO_BREAKER_THRESHOLD = int(os.getenv("BELVO_BREAKER_THRESHOLD", 5))
+BELVO_BREAKER_RECOVERY = float(os.getenv("BELVO_BREAKER_RECOVERY", 30))
+BELVO_HEDGE_DELAY = float(os.getenv("BELVO_HEDGE_DELAY", 0))
+# Precarga la lista de instituciones al arrancar, en segundo plano
+BELVO_WARM_CACHE = os.getenv("BELVO_WARM_CACHE", "true").lower() in ("1", "true", "yes")
+# Timeout de cada rama del resumen de un link (/belvo/links/{link_id}/summary)
+BELVO_SUMMARY_BRANCH_TIMEOUT = float(os.getenv("BELVO_SUMMARY_BRANCH_TIMEOUT", 10))
+# Links pedidos a la vez por las consultas en lote
+BELVO_BATCH_CONCURRENCY = int(os.getenv("BELVO_BATCH_CONCURRENCY", 10))
+
+# Caché de respuestas de Belvo (por defecto en SHARED_STATE_URL). Vacío = caché en memoria del
+# proceso; "redis://..." = Redis compartido; "shm://" = compartida entre los workers de la
+# máquina; "local://" = sustituto local. Ver kvstore.py.
+BELVO_CACHE_URL = os.getenv("BELVO_CACHE_URL") or kvstore.SHARED_STATE_URL
+BELVO_CACHE_MAX_ENTRIES = int(os.getenv("BELVO_CACHE_MAX_ENTRIES", 1024))
+# TTL (fresco) y ventana stale-while-revalidate por endpoint, en segundos
+BELVO_CACHE_POLICIES = {
+    "institutions": {
+        "ttl": float(os.getenv("BELVO_INSTITUTIONS_TTL", 86400)),
+        "stale_ttl": float(os.getenv("BELVO_INSTITUTIONS_STALE_TTL", 3600)),
+    },
+    "accounts": {
+        "ttl": float(os.getenv("BELVO_ACCOUNTS_TTL", 60)),
+        "stale_ttl": float(os.getenv("BELVO_ACCOUNTS_STALE_TTL", 300)),
+    },
+    "balances": {
+        "ttl": float(os.getenv("BELVO_BALANCES_TTL", 30)),
+        "stale_ttl": float(os.getenv("BELVO_BALANCES_STALE_TTL", 60)),
+    },
+}
+
 async def get_belvo_basic_auth_headers():
     if not BELVO_SECRET_ID or not BELVO_SECRET_PASSWORD:
         raise HTTPException(
@@ -52,27 +110,173 @@ async def get_belvo_basic_auth_headers():
 #                 detail=f"Error de red al conectar con Belvo: {e}"
 #             )
 
-async def get_belvo_institutions():
-    headers = await get_belvo_basic_auth_headers()
-    async with httpx.AsyncClient() as client:
+# Cliente HTTP compartido para todas las llamadas a Belvo.
+# Se crea una sola vez (en el arranque de la aplicación) y reutiliza las conexiones
+# TCP/TLS mediante keep-alive, en lugar de abrir un httpx.AsyncClient por petición.
+class BelvoClient:
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        *,
+        http2: bool = BELVO_HTTP2,
+        limits: Optional[httpx.Limits] = None,
+        timeout: Optional[httpx.Timeout] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        policy: Optional[UpstreamPolicy] = None,
+    ):
+        self.base_url = base_url if base_url is not None else (BELVO_API_URL or "")
+        if http2 and importlib.util.find_spec("h2") is None:
+            print("BELVO_HTTP2 está activado pero el paquete 'h2' no está instalado; se usará HTTP/1.1.")
+            http2 = False
+        self.http2 = http2
+        self.limits = limits or httpx.Limits(
+            max_connections=BELVO_MAX_CONNECTIONS,
+            max_keepalive_connections=BELVO_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=BELVO_KEEPALIVE_EXPIRY,
+        )
+        self.timeout = timeout or httpx.Timeout(
+            BELVO_READ_TIMEOUT, connect=BELVO_CONNECT_TIMEOUT, pool=BELVO_POOL_TIMEOUT
+        )
+        self.transport = transport
+        self.policy = policy or build_belvo_policy()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _build_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=self.http2,
+            limits=self.limits,
+            timeout=self.timeout,
+            transport=self.transport,
+        )
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Creación perezosa por si se usa fuera del ciclo de vida de la aplicación (scripts)
+        if self._client is None or self._client.is_closed:
+            self._client = self._build_client()
+        return self._client
+
+    async def start(self):
+        if self._client is None or self._client.is_closed:
+            self._client = self._build_client()
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    # Un intento de GET, medido en el histograma de peticiones externas. La etiqueta es la
+    # ruta sin query string (las URL `next` de la paginación comparten la de su primera página).
+    async def _timed_get(self, url: str, **kwargs) -> httpx.Response:
+        endpoint = httpx.URL(url).path
+        start = time.perf_counter()
+        outcome = "error"
         try:
-            response = await client.get(
-                f"{BELVO_API_URL}/institutions/", # Ruta ajustada según tu baseURL
-                headers=headers
-            )
+            response = await self.client.get(url, **kwargs)
+            outcome = response.status_code
+            return response
+        except asyncio.CancelledError:
+            outcome = "cancelled" # Rama perdedora de una petición de cobertura
+            raise
+        finally:
+            UPSTREAM_SECONDS.observe(time.perf_counter() - start, "belvo", endpoint, outcome)
+
+    # GET contra Belvo con la política de reintentos/breaker/cobertura.
+    # Traduce los fallos a HTTPException: 503 si el circuito está abierto o Belvo está saturado,
+    # 504 si se agota el plazo, 502 si Belvo falla o responde un error propio (p. ej. credenciales);
+    # los 400/404 se propagan tal cual porque dependen de la petición.
+    async def get(
+        self,
+        url: str,
+        *,
+        params: Optional[dict] = None,
+        timeout: Optional[float] = None,
+        error_detail: str = "Error al consultar Belvo",
+    ) -> dict:
+        headers = await get_belvo_basic_auth_headers()
+        kwargs = {"params": params, "headers": headers}
+        if timeout is not None:
+            kwargs["timeout"] = timeout
+        try:
+            response = await self.policy.call(lambda: self._timed_get(url, **kwargs))
             response.raise_for_status()
-            return response.json().get("results", [])
+            return response.json()
+        except CircuitOpenError as e:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"{error_detail}: Belvo no está disponible temporalmente",
+                headers={"Retry-After": str(int(e.retry_after) or 1)},
+            )
         except httpx.HTTPStatusError as e:
+            upstream_status = e.response.status_code
+            if upstream_status in (400, 404):
+                status_code = upstream_status
+            elif upstream_status == 429:
+                status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+            else:
+                status_code = status.HTTP_502_BAD_GATEWAY
+            raise HTTPException(
+                status_code=status_code,
+                detail=f"{error_detail}: {e.response.text}"
+            )
+        except (DeadlineExceededError, httpx.TimeoutException) as e:
             raise HTTPException(
-                status_code=e.response.status_code,
-                detail=f"Error al obtener instituciones de Belvo: {e.response.text}"
+                status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                detail=f"{error_detail}: Belvo no respondió a tiempo ({e})"
             )
         except httpx.RequestError as e:
             raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                status_code=status.HTTP_502_BAD_GATEWAY,
                 detail=f"Error de red al conectar con Belvo: {e}"
             )
 
+    def stats(self) -> dict:
+        return self.policy.stats()
+
+
+# Política por defecto de las llamadas a Belvo, configurada desde el entorno
+def build_belvo_policy() -> UpstreamPolicy:
+    return UpstreamPolicy(
+        "belvo",
+        retry=RetryPolicy(BELVO_RETRY_ATTEMPTS, BELVO_RETRY_BASE_DELAY, BELVO_RETRY_MAX_DELAY),
+        breaker=CircuitBreaker("belvo", BELVO_BREAKER_THRESHOLD, BELVO_BREAKER_RECOVERY),
+        deadline=BELVO_REQUEST_DEADLINE or None,
+        hedge_delay=BELVO_HEDGE_DELAY or None,
+    )
+
+belvo_client = BelvoClient()
+
+# Dependencia de FastAPI para obtener el cliente compartido
+async def get_belvo_client() -> BelvoClient:
+    return belvo_client
+
+# Caché compartida de respuestas; se puede sustituir (p. ej. en pruebas) por otra ResponseCache
+belvo_cache = ResponseCache(
+    build_backend(BELVO_CACHE_URL, max_entries=BELVO_CACHE_MAX_ENTRIES, prefix="belvo:")
+)
+
+async def get_belvo_institutions(client: Optional[BelvoClient] = None, timeout: Optional[float] = None):
+    client = client or belvo_client
+
+    async def fetch():
+        data = await client.get(
+            "/institutions/", # Ruta ajustada según tu baseURL
+            timeout=timeout,
+            error_detail="Error al obtener instituciones de Belvo",
+        )
+        return normalize("institutions", data.get("results", []))
+
+    return await belvo_cache.get_or_fetch("institutions", fetch, **BELVO_CACHE_POLICIES["institutions"])
+
+# Llena la caché de instituciones (la más pedida y la que menos cambia). Con una caché
+# compartida (Redis) los workers que arrancan después la encuentran ya cargada.
+async def warm_cache():
+    try:
+        await get_belvo_institutions()
+    except Exception as e:
+        print(f"No se pudo precargar la caché de Belvo: {getattr(e, 'detail', e)}")
+
 # La función get_belvo_link_creation_token ya no es necesaria si no se usa el widget
 # async def get_belvo_link_creation_token():
 #     access_token = await get_belvo_access_token()
@@ -100,65 +304,186 @@ async def get_belvo_institutions():
 #                 detail=f"Error de red al conectar con Belvo: {e}"
 #             )
 
-async def get_belvo_accounts():
-    headers = await get_belvo_basic_auth_headers()
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                f"{BELVO_API_URL}/accounts/?link={MOCK_LINK_ID}", # Ruta y link_id ajustados
-                headers=headers
-            )
-            response.raise_for_status()
-            return response.json().get("results", [])
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(
-                status_code=e.response.status_code,
-                detail=f"Error al obtener cuentas de Belvo para link {MOCK_LINK_ID}: {e.response.text}"
-            )
-        except httpx.RequestError as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Error de red al conectar con Belvo: {e}"
-            )
+# Recursos de un link que se piden de una vez (sin paginar): ruta en Belvo y nombre para errores
+BELVO_RESOURCES = {
+    "accounts": ("/accounts/", "cuentas"),
+    "balances": ("/br/balances/", "balances"),
+}
 
-async def get_belvo_balances():
-    headers = await get_belvo_basic_auth_headers()
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                f"{BELVO_API_URL}/br/balances/?link={MOCK_LINK_ID}",
-                headers=headers
-            )
-            response.raise_for_status()
-            return response.json().get("results", [])
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(
-                status_code=e.response.status_code,
-                detail=f"Error al obtener balances de Belvo para link {MOCK_LINK_ID}: {e.response.text}"
-            )
-        except httpx.RequestError as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Error de red al conectar con Belvo: {e}"
-            )
+# Detalle de un link en Belvo (sin caché). Se usa al registrar un link para comprobar a quién
+# pertenece: el widget de Belvo se abre con external_id = id del usuario en esta API, y Belvo
+# lo guarda en el link.
+async def get_belvo_link(client: Optional[BelvoClient], link_id: str) -> dict:
+    client = client or belvo_client
+    return await client.get(f"/links/{link_id}/", error_detail=f"Error al obtener el link {link_id} de Belvo")
 
-async def get_belvo_transactions():
-    headers = await get_belvo_basic_auth_headers()
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(
-                f"{BELVO_API_URL}/transactions/?link={MOCK_LINK_ID}",
-                headers=headers
-            )
-            response.raise_for_status()
-            return response.json().get("results", [])
-        except httpx.HTTPStatusError as e:
-            raise HTTPException(
-                status_code=e.response.status_code,
-                detail=f"Error al obtener transacciones de Belvo para link {MOCK_LINK_ID}: {e.response.text}"
+def link_belongs_to(link: dict, user_id: int) -> bool:
+    return link.get("external_id") == str(user_id)
+
+# Descarga directa (sin caché) de las cuentas o balances de un link.
+# La usan las funciones cacheadas de abajo y la sincronización local (sync.py).
+# Como el resto de funciones de este módulo, devuelve los datos ya validados y normalizados
+# con los esquemas (ver serialization.py): las rutas los serializan sin volver a validarlos.
+async def fetch_belvo_resource(
+    client: Optional[BelvoClient],
+    resource: str,
+    link_id: str,
+    timeout: Optional[float] = None,
+) -> list:
+    client = client or belvo_client
+    path, name = BELVO_RESOURCES[resource]
+    data = await client.get(
+        path,
+        params={"link": link_id},
+        timeout=timeout,
+        error_detail=f"Error al obtener {name} de Belvo para link {link_id}",
+    )
+    return normalize(resource, data.get("results", []))
+
+async def get_belvo_accounts(
+    client: Optional[BelvoClient] = None,
+    timeout: Optional[float] = None,
+    link_id: str = MOCK_LINK_ID,
+):
+    return await belvo_cache.get_or_fetch(
+        f"accounts:{link_id}",
+        lambda: fetch_belvo_resource(client, "accounts", link_id, timeout),
+        **BELVO_CACHE_POLICIES["accounts"],
+    )
+
+async def get_belvo_balances(
+    client: Optional[BelvoClient] = None,
+    timeout: Optional[float] = None,
+    link_id: str = MOCK_LINK_ID,
+):
+    return await belvo_cache.get_or_fetch(
+        f"balances:{link_id}",
+        lambda: fetch_belvo_resource(client, "balances", link_id, timeout),
+        **BELVO_CACHE_POLICIES["balances"],
+    )
+
+# Recorre todas las páginas de transacciones siguiendo el cursor `next` de Belvo.
+# Mientras se consume una página ya se está descargando la siguiente (prefetch),
+# y solo hay una página en memoria a la vez.
+async def iter_belvo_transactions(
+    client: Optional[BelvoClient] = None,
+    *,
+    link_id: str = MOCK_LINK_ID,
+    page_size: int = 100,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    limit: Optional[int] = None,
+    timeout: Optional[float] = None,
+) -> AsyncIterator[dict]:
+    client = client or belvo_client
+    error_detail = f"Error al obtener transacciones de Belvo para link {link_id}"
+    params = {"link": link_id, "page_size": page_size}
+    if date_from is not None:
+        params["value_date__gte"] = date_from.isoformat()
+    if date_to is not None:
+        params["value_date__lte"] = date_to.isoformat()
+
+    pending = asyncio.ensure_future(
+        client.get("/transactions/", params=params, timeout=timeout, error_detail=error_detail)
+    )
+    yielded = 0
+    try:
+        while pending is not None:
+            page = await pending
+            pending = None
+            results = normalize("transactions", page.get("results", []))
+            next_url = page.get("next")
+            if next_url and (limit is None or yielded + len(results) < limit):
+                # La URL `next` ya incluye los filtros y el cursor
+                pending = asyncio.ensure_future(
+                    client.get(next_url, timeout=timeout, error_detail=error_detail)
+                )
+            for transaction in results:
+                if limit is not None and yielded >= limit:
+                    return
+                yield transaction
+                yielded += 1
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+async def get_belvo_transactions(
+    client: Optional[BelvoClient] = None,
+    timeout: Optional[float] = None,
+    limit: Optional[int] = None,
+    link_id: str = MOCK_LINK_ID,
+):
+    return [
+        transaction
+        async for transaction in iter_belvo_transactions(
+            client, link_id=link_id, limit=limit, timeout=timeout
+        )
+    ]
+
+# Describe el fallo de una rama del resumen para devolverlo al cliente
+def _describe_branch_error(error: Exception, timeout: float) -> str:
+    if isinstance(error, asyncio.TimeoutError):
+        return f"Belvo no respondió en {timeout:g} s"
+    if isinstance(error, HTTPException):
+        return f"{error.status_code}: {error.detail}"
+    return f"Error inesperado: {error}"
+
+LINK_RESOURCES = ("accounts", "balances", "transactions")
+
+# Resumen de un link: cuentas, balances y transacciones pedidos a Belvo en paralelo.
+# El tiempo total es el de la llamada más lenta (no la suma). Cada rama tiene su propio
+# timeout; si una falla, el resto se devuelve igualmente y el fallo se indica en "errors".
+# `resources` limita qué ramas se piden; las no pedidas quedan a None sin error.
+async def get_belvo_link_summary(
+    client: Optional[BelvoClient] = None,
+    link_id: str = MOCK_LINK_ID,
+    *,
+    resources: Sequence[str] = LINK_RESOURCES,
+    transactions_limit: int = 100,
+    branch_timeout: float = BELVO_SUMMARY_BRANCH_TIMEOUT,
+) -> dict:
+    client = client or belvo_client
+    fetchers = {
+        "accounts": lambda: get_belvo_accounts(client, link_id=link_id),
+        "balances": lambda: get_belvo_balances(client, link_id=link_id),
+        "transactions": lambda: get_belvo_transactions(client, link_id=link_id, limit=transactions_limit),
+    }
+    branches = [name for name in LINK_RESOURCES if name in resources]
+    results = await asyncio.gather(
+        *(asyncio.wait_for(fetchers[name](), branch_timeout) for name in branches),
+        return_exceptions=True,
+    )
+    summary = {"link_id": link_id, "errors": {}, **{name: None for name in LINK_RESOURCES}}
+    for name, result in zip(branches, results):
+        if isinstance(result, Exception):
+            summary["errors"][name] = _describe_branch_error(result, branch_timeout)
+        elif isinstance(result, BaseException):
+            raise result
+        else:
+            summary[name] = result
+    return summary
+
+# Pide los recursos de muchos links con concurrencia acotada: como mucho `concurrency`
+# links a la vez, y el pool del cliente limita además las conexiones abiertas hacia Belvo
+# (BELVO_MAX_CONNECTIONS). Devuelve un resumen por link, en el orden recibido (los link_ids
+# no se repiten: schemas.LinkBatchRequest los valida).
+async def fetch_links_batch(
+    client: Optional[BelvoClient] = None,
+    link_ids: Sequence[str] = (),
+    *,
+    resources: Sequence[str] = ("accounts", "balances"),
+    concurrency: int = BELVO_BATCH_CONCURRENCY,
+    transactions_limit: int = 100,
+    branch_timeout: float = BELVO_SUMMARY_BRANCH_TIMEOUT,
+) -> List[dict]:
+    client = client or belvo_client
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch_link(link_id: str) -> dict:
+        async with semaphore:
+            return await get_belvo_link_summary(
+                client, link_id, resources=resources,
+                transactions_limit=transactions_limit, branch_timeout=branch_timeout,
             )
-        except httpx.RequestError as e:
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Error de red al conectar con Belvo: {e}"
-            )
\ No newline at end of file
+
+    return await asyncio.gather(*(fetch_link(link_id) for link_id in link_ids))
@@ -0,0 +1,340 @@
+# Prueba de carga de los endpoints de autenticación y de Belvo.
+# Escenarios: signup, login, /users/me/ con el mismo token (caché de tokens y de principals)
+# y las rutas /belvo/* (resumen en paralelo, consulta en lote, copia local y streaming).
+#
+# Por defecto todo corre en un solo proceso: la API (main.app) sobre SQLite en un fichero
+# temporal (requiere el paquete aiosqlite) y fake_belvo.app como Belvo, ambos a través de
+# httpx.ASGITransport. Con --database-url se usa otra base de datos (p. ej. un MySQL local) y
+# con --base-url se ataca una API ya desplegada (la latencia de Belvo y los límites de login
+# se configuran entonces en ese servidor).
+#
+# Cada escenario informa del throughput y de las latencias p50/p95/p99; con --output se
+# guardan en JSON junto con el commit y la configuración, y --compare muestra la diferencia
+# con un resultado anterior:
+#
+#   python benchmarks/bench_endpoints.py --output base.json
+#   git checkout mi-rama
+#   python benchmarks/bench_endpoints.py --output rama.json --compare base.json
+#
+# Uso: python benchmarks/bench_endpoints.py [--scenarios login,me] [--requests 500]
+#      [--concurrency 20] [--belvo-latency-ms 50] [--belvo-transactions 1000] [--belvo-page-size 100]
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SCENARIOS = (
+    "signup",
+    "login",
+    "me",
+    "belvo_summary",
+    "belvo_batch",
+    "belvo_accounts",
+    "belvo_transactions",
+    "belvo_stream",
+)
+PASSWORD = "benchmark-password"
+
+
+def percentile(sorted_values, fraction: float) -> float:
+    # Rango más cercano sobre una lista ya ordenada
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+# Configura la API en proceso antes de importarla: los módulos leen el entorno al importarse
+def configure_environment(args):
+    os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+    os.environ.setdefault("ALGORITHM", "HS256")
+    os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+    os.environ.setdefault("BELVO_SECRET_ID", "benchmark")
+    os.environ.setdefault("BELVO_SECRET_PASSWORD", "benchmark")
+    os.environ["DATABASE_URL"] = args.database_url
+    os.environ["DB_MIGRATE_ON_STARTUP"] = "true" # Base de datos nueva en cada ejecución
+    os.environ["BELVO_SYNC_ENABLED"] = "false" # Las rutas sincronizan bajo demanda
+    os.environ["BELVO_SYNC_PAGE_SIZE"] = str(args.belvo_page_size)
+    # Los escenarios de login repiten credenciales desde una sola IP: sin límites de intentos
+    for name in ("LOGIN_RATE_IP_CAPACITY", "LOGIN_RATE_USERNAME_CAPACITY"):
+        os.environ[name] = "1000000000"
+    for name in ("LOGIN_RATE_IP_PER_MINUTE", "LOGIN_RATE_USERNAME_PER_MINUTE"):
+        os.environ[name] = "1000000000"
+
+
+class Target:
+    """Cliente HTTP contra la API, en proceso (ASGI) o remota (--base-url)."""
+
+    def __init__(self, args):
+        self.args = args
+        self.main = None
+        self.lifespan = None
+        self.client = None
+
+    async def __aenter__(self):
+        import httpx
+
+        limits = httpx.Limits(max_connections=self.args.concurrency * 2)
+        timeout = httpx.Timeout(self.args.timeout)
+        if self.args.base_url:
+            self.client = httpx.AsyncClient(base_url=self.args.base_url, limits=limits, timeout=timeout)
+            return self
+
+        import fake_belvo
+
+        fake_belvo.FAKE_BELVO_LATENCY_MS = self.args.belvo_latency_ms
+        fake_belvo.FAKE_BELVO_ACCOUNTS = self.args.belvo_accounts
+        fake_belvo.FAKE_BELVO_TRANSACTIONS = self.args.belvo_transactions
+
+        import belvo_api
+        import main
+
+        self.main = main
+        self.lifespan = main.lifespan(main.app)
+        belvo_api.belvo_client.base_url = "http://fake-belvo/api"
+        belvo_api.belvo_client.transport = httpx.ASGITransport(app=fake_belvo.app)
+        await self.lifespan.__aenter__()
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app), base_url="http://api", limits=limits, timeout=timeout
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.client.aclose()
+        if self.main is not None:
+            await self.lifespan.__aexit__(None, None, None)
+            await self.main.engine.dispose()
+
+    def metadata(self) -> dict:
+        if self.args.base_url:
+            return {"mode": "remote", "base_url": self.args.base_url}
+        return {
+            "mode": "in-process",
+            "database": self.main.engine.url.get_backend_name(),
+            "belvo_latency_ms": self.args.belvo_latency_ms,
+            "belvo_accounts": self.args.belvo_accounts,
+            "belvo_transactions": self.args.belvo_transactions,
+            "belvo_page_size": self.args.belvo_page_size,
+        }
+
+
+async def signup(client, username: str):
+    response = await client.post(
+        "/signup", json={"username": username, "email": f"{username}@bench.example", "password": PASSWORD}
+    )
+    response.raise_for_status()
+
+
+async def login(client, username: str) -> str:
+    response = await client.post("/token", data={"username": username, "password": PASSWORD})
+    response.raise_for_status()
+    return response.json()["access_token"]
+
+
+# Datos compartidos por los escenarios: usuarios ya registrados, un token y links de Belvo
+async def prepare(client, args) -> dict:
+    run_id = uuid.uuid4().hex[:8]
+    usernames = [f"bench_{run_id}_{i}" for i in range(max(1, args.users))]
+    await asyncio.gather(*(signup(client, username) for username in usernames))
+    token = await login(client, usernames[0])
+    headers = {"Authorization": f"Bearer {token}"}
+    me = await client.get("/users/me/", headers=headers)
+    me.raise_for_status()
+    # Links de fake_belvo creados con el external_id del usuario (ver fake_belvo.py)
+    link_ids = [f"{me.json()['id']}:bench-{run_id}-link-{i}" for i in range(max(1, args.links))]
+    for link_id in link_ids:
+        response = await client.post("/belvo/links", json={"link_id": link_id}, headers=headers)
+        response.raise_for_status()
+    return {"run_id": run_id, "usernames": usernames, "headers": headers, "link_ids": link_ids}
+
+
+# Cada escenario devuelve una función que recibe el número de petición y hace una llamada
+def build_request(name: str, client, args, state: dict):
+    headers = state["headers"]
+    usernames = state["usernames"]
+    link_ids = state["link_ids"]
+
+    async def request(i: int):
+        if name == "signup":
+            await signup(client, f"bench_{state['run_id']}_new_{i}")
+            return
+        if name == "login":
+            await login(client, usernames[i % len(usernames)])
+            return
+        if name == "me":
+            response = await client.get("/users/me/", headers=headers)
+        elif name == "belvo_summary":
+            response = await client.get(f"/belvo/links/{link_ids[i % len(link_ids)]}/summary", headers=headers)
+        elif name == "belvo_batch":
+            response = await client.post(
+                "/belvo/links/batch",
+                json={"link_ids": link_ids, "resources": ["accounts", "balances", "transactions"]},
+                headers=headers,
+            )
+        elif name == "belvo_accounts":
+            response = await client.get(f"/belvo/links/{link_ids[i % len(link_ids)]}/accounts", headers=headers)
+        elif name == "belvo_transactions":
+            response = await client.get(
+                f"/belvo/links/{link_ids[i % len(link_ids)]}/transactions", headers=headers
+            )
+        else: # belvo_stream: todas las páginas de Belvo, en streaming
+            response = await client.get(
+                "/belvo/transactions", params={"page_size": args.belvo_page_size}, headers=headers
+            )
+        response.raise_for_status()
+
+    return request
+
+
+async def run_scenario(name: str, request, args) -> dict:
+    latencies = []
+    errors = {}
+    counter = iter(range(args.requests))
+
+    async def worker():
+        for i in counter:
+            start = time.perf_counter()
+            try:
+                await request(i)
+            except Exception as e:
+                key = getattr(getattr(e, "response", None), "status_code", None) or type(e).__name__
+                errors[str(key)] = errors.get(str(key), 0) + 1
+                continue
+            latencies.append(time.perf_counter() - start)
+
+    for i in range(args.requests, args.requests + args.warmup):
+        try:
+            await request(i)
+        except Exception:
+            pass
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    ms = lambda seconds: round(seconds * 1000, 3)
+    return {
+        "requests": args.requests,
+        "ok": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": ms(sum(latencies) / len(latencies)) if latencies else 0.0,
+            "p50": ms(percentile(latencies, 0.50)),
+            "p95": ms(percentile(latencies, 0.95)),
+            "p99": ms(percentile(latencies, 0.99)),
+            "max": ms(latencies[-1]) if latencies else 0.0,
+        },
+    }
+
+
+def print_results(results: dict, baseline: dict = None):
+    print(f"{'escenario':<20} {'ok/total':>11} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, result in results["scenarios"].items():
+        latency = result["latency_ms"]
+        line = (
+            f"{name:<20} {result['ok']:>5}/{result['requests']:<5} {result['throughput_rps']:>10,.1f}"
+            f" {latency['p50']:>9.2f} {latency['p95']:>9.2f} {latency['p99']:>9.2f}"
+        )
+        previous = (baseline or {}).get("scenarios", {}).get(name)
+        if previous and previous["throughput_rps"] and previous["latency_ms"]["p95"]:
+            throughput = result["throughput_rps"] / previous["throughput_rps"] - 1
+            p95 = latency["p95"] / previous["latency_ms"]["p95"] - 1
+            line += f"   req/s {throughput:+.1%} p95 {p95:+.1%}"
+        if result["errors"]:
+            line += f"   errores: {result['errors']}"
+        print(line)
+
+
+async def run(args) -> dict:
+    async with Target(args) as target:
+        state = await prepare(target.client, args)
+        results = {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "config": {
+                "requests": args.requests,
+                "concurrency": args.concurrency,
+                "users": args.users,
+                "links": args.links,
+                **target.metadata(),
+            },
+            "scenarios": {},
+        }
+        for name in args.scenarios:
+            request = build_request(name, target.client, args, state)
+            results["scenarios"][name] = await run_scenario(name, request, args)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prueba de carga de los endpoints de autenticación y Belvo")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Separados por comas: {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200, help="Peticiones por escenario")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=5, help="Peticiones de calentamiento no medidas")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--users", type=int, default=10, help="Usuarios registrados para el escenario login")
+    parser.add_argument("--links", type=int, default=5, help="Links de Belvo del usuario de prueba")
+    parser.add_argument("--base-url", help="API ya desplegada (por defecto, main.app en proceso)")
+    parser.add_argument("--database-url", help="Por defecto SQLite en un fichero temporal")
+    parser.add_argument("--belvo-latency-ms", type=float, default=0)
+    parser.add_argument("--belvo-accounts", type=int, default=2)
+    parser.add_argument("--belvo-transactions", type=int, default=1000)
+    parser.add_argument("--belvo-page-size", type=int, default=100)
+    parser.add_argument("--output", help="Fichero JSON con los resultados")
+    parser.add_argument("--compare", help="Resultados JSON anteriores con los que comparar")
+    args = parser.parse_args()
+
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Escenarios desconocidos: {', '.join(unknown)}")
+
+    temp_dir = None
+    if not args.base_url:
+        if not args.database_url:
+            temp_dir = tempfile.TemporaryDirectory(prefix="bench-endpoints-")
+            args.database_url = f"sqlite+aiosqlite:///{os.path.join(temp_dir.name, 'bench.db')}"
+        configure_environment(args)
+
+    try:
+        results = asyncio.run(run(args))
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"commit {results['commit']} comparado con {baseline.get('commit', '?')}")
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+            output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+# Micro-benchmark de serialización de respuestas grandes de Belvo.
+# Compara, para una lista de transacciones (10 000 por defecto):
+# - el camino original: FastAPI valida el resultado con response_model y lo codifica con json
+# - validar una sola vez con un TypeAdapter y serializar con pydantic (dump_json)
+# - datos ya normalizados (validados al llegar de Belvo) serializados con json y con orjson
+# - respuesta ya serializada reutilizada de render_cache (acierto de caché)
+#
+# Uso: python benchmarks/bench_serialization.py [--transactions 10000] [--repeat 20]
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_model_field
+
+import fake_belvo
+import schemas
+from serialization import ADAPTERS, RenderCache, normalize, orjson
+
+
+def bench(name, func, repeat, size):
+    func()  # calentamiento
+    start = time.perf_counter()
+    for _ in range(repeat):
+        body = func()
+    elapsed = (time.perf_counter() - start) / repeat
+    print(f"{name:<44} {elapsed * 1000:>9.2f} ms/respuesta {len(body) / 1e6:>7.2f} MB {size / elapsed:>12,.0f} tx/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark de serialización de transacciones")
+    parser.add_argument("--transactions", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    total = args.transactions
+    raw = [fake_belvo._transaction("bench-link", i, total) for i in range(total)]
+    adapter = ADAPTERS["transactions"]
+    normalized = normalize("transactions", raw)
+    render_cache = RenderCache()
+
+    # Lo que hace FastAPI con response_model=List[Transaction]: validar y volcar a tipos JSON
+    # (serialize_response) y codificar con JSONResponse (json de la biblioteca estándar)
+    field = create_model_field("Response_transactions", List[schemas.Transaction], mode="serialization")
+    loop = asyncio.new_event_loop()
+
+    def fastapi_response_model():
+        content = loop.run_until_complete(serialize_response(field=field, response_content=raw))
+        return JSONResponse(content).body
+
+    def type_adapter_dump_json():
+        return adapter.dump_json(adapter.validate_python(raw))
+
+    def normalized_json():
+        return json.dumps(normalized, ensure_ascii=False, separators=(",", ":")).encode()
+
+    def cached_render():
+        return render_cache.render("transactions", normalized)
+
+    print(f"{total} transacciones, media de {args.repeat} repeticiones\n")
+    bench("FastAPI response_model + json (original)", fastapi_response_model, args.repeat, total)
+    bench("TypeAdapter validate + dump_json", type_adapter_dump_json, args.repeat, total)
+    bench("normalizado + json", normalized_json, args.repeat, total)
+    if orjson is not None:
+        bench("normalizado + orjson", lambda: orjson.dumps(normalized), args.repeat, total)
+    else:
+        print("orjson no está instalado; se omite")
+    bench("render_cache (bytes ya serializados)", cached_render, args.repeat, total)
+
+
+if __name__ == "__main__":
+    main()
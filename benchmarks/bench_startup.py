@@ -0,0 +1,153 @@
+# Benchmark de arranque en frío de la API.
+# Cada ejecución es un proceso nuevo que mide:
+# - import: tiempo de `import main` (módulos de la aplicación y sus dependencias)
+# - startup: el lifespan de la aplicación (comprobación del esquema, pool de conexiones, cliente de Belvo)
+# - first_request: la primera petición sin DB (GET /metrics) y la primera con DB (POST /token)
+# y qué módulos pesados (passlib, jose) quedaron cargados tras el arranque.
+#
+# Por defecto usa SQLite en un fichero temporal (requiere aiosqlite), migrado antes de medir
+# con `manage.py migrate`; con --database-url se usa otra base de datos ya migrada.
+#
+# Uso: python benchmarks/bench_startup.py [--runs 5] [--output startup.json] [--importtime]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ("passlib", "jose", "orjson", "pyinstrument", "redis")
+
+# Se ejecuta en el proceso hijo; imprime una línea JSON con las mediciones
+CHILD = r"""
+import asyncio, json, sys, time
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def run():
+    import httpx
+
+    timings = {"import": imported - start}
+    lifespan = main.lifespan(main.app)
+    begin = time.perf_counter()
+    await lifespan.__aenter__()
+    timings["startup"] = time.perf_counter() - begin
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://api") as client:
+        begin = time.perf_counter()
+        await client.get("/metrics", headers={"Authorization": "Bearer bench-metrics"})
+        timings["first_request"] = time.perf_counter() - begin
+        begin = time.perf_counter()
+        await client.post("/token", data={"username": "bench-startup", "password": "x"})
+        timings["first_db_request"] = time.perf_counter() - begin
+    timings["total"] = time.perf_counter() - start
+    loaded = sorted(name for name in HEAVY_MODULES if name in sys.modules)
+    await lifespan.__aexit__(None, None, None)
+    await main.engine.dispose()
+    print(json.dumps({"timings": timings, "loaded_modules": loaded}))
+
+HEAVY_MODULES = %r
+asyncio.run(run())
+"""
+
+
+def child_env(database_url: str) -> dict:
+    env = dict(os.environ)
+    env.setdefault("SECRET_KEY", "benchmark-secret")
+    env.setdefault("ALGORITHM", "HS256")
+    env.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+    env["DATABASE_URL"] = database_url
+    env["METRICS_TOKEN"] = "bench-metrics" # /metrics con el token del scraper, sin consultar la DB
+    env["BELVO_SYNC_ENABLED"] = "false"
+    env["BELVO_WARM_CACHE"] = "false" # Sin red externa
+    env["PYTHONDONTWRITEBYTECODE"] = "1"
+    return env
+
+
+def run_child(env: dict, importtime: bool) -> dict:
+    command = [sys.executable]
+    if importtime:
+        command += ["-X", "importtime"]
+    command += ["-c", CHILD % (HEAVY_MODULES,)]
+    result = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f"El proceso de arranque falló:\n{result.stderr}")
+    measurement = json.loads(result.stdout.strip().splitlines()[-1])
+    if importtime:
+        measurement["importtime"] = parse_importtime(result.stderr)
+    return measurement
+
+
+# Módulos de primer nivel con más tiempo acumulado según `python -X importtime`
+def parse_importtime(stderr: str, top: int = 15) -> list:
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name[1:].startswith(" "): # Sin sangría: importado directamente
+            modules.append((int(cumulative), name.strip()))
+    modules.sort(reverse=True)
+    return [{"module": name, "cumulative_ms": round(us / 1000, 2)} for us, name in modules[:top]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de arranque en frío de la API")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--database-url", help="Base de datos ya migrada (por defecto SQLite temporal)")
+    parser.add_argument("--importtime", action="store_true", help="Desglose de `python -X importtime` (última ejecución)")
+    parser.add_argument("--output", help="Fichero JSON con los resultados")
+    args = parser.parse_args()
+
+    temp_dir = None
+    database_url = args.database_url
+    if not database_url:
+        temp_dir = tempfile.TemporaryDirectory(prefix="bench-startup-")
+        database_url = f"sqlite+aiosqlite:///{os.path.join(temp_dir.name, 'bench.db')}"
+    env = child_env(database_url)
+    try:
+        if temp_dir is not None:
+            subprocess.run([sys.executable, "manage.py", "migrate"], cwd=ROOT, env=env, check=True, capture_output=True)
+        runs = [run_child(env, importtime=False) for _ in range(args.runs)]
+        breakdown = run_child(env, importtime=True)["importtime"] if args.importtime else None
+    finally:
+        if temp_dir is not None:
+            temp_dir.cleanup()
+
+    names = runs[0]["timings"].keys()
+    summary = {
+        name: {
+            "median_ms": round(statistics.median(run["timings"][name] for run in runs) * 1000, 2),
+            "max_ms": round(max(run["timings"][name] for run in runs) * 1000, 2),
+        }
+        for name in names
+    }
+    print(f"{'fase':<18} {'mediana ms':>11} {'máx ms':>9}")
+    for name, values in summary.items():
+        print(f"{name:<18} {values['median_ms']:>11.1f} {values['max_ms']:>9.1f}")
+    print(f"módulos pesados cargados: {', '.join(runs[-1]['loaded_modules']) or 'ninguno'}")
+    if breakdown:
+        print("\nimports más lentos (acumulado):")
+        for entry in breakdown:
+            print(f"  {entry['module']:<40} {entry['cumulative_ms']:>9.1f} ms")
+
+    if args.output:
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        from bench_endpoints import git_commit
+
+        results = {
+            "commit": git_commit(),
+            "runs": args.runs,
+            "startup": summary,
+            "loaded_modules": runs[-1]["loaded_modules"],
+            "importtime": breakdown,
+        }
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(results, output, indent=2)
+            output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
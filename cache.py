@@ -0,0 +1,169 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional
+
+import kvstore
+
+
+# Entrada de caché: fresca hasta `fresh_until`, servible como "stale" hasta `stale_until`
+@dataclass
+class CacheEntry:
+    value: Any
+    fresh_until: float
+    stale_until: float
+
+
+# Backend en memoria con límite de tamaño (LRU)
+class MemoryBackend:
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self.evictions = 0
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if time.time() >= entry.stale_until:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    async def set(self, key: str, entry: CacheEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def delete(self, key: str):
+        self._entries.pop(key, None)
+
+    async def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+# Backend sobre un almacén clave-valor compatible con Redis (ver kvstore.py).
+# Los valores se guardan como JSON, por lo que deben ser serializables.
+# El tamaño lo acota Redis (maxmemory + política LRU), no este backend.
+class KVBackend:
+    def __init__(self, kv, prefix: str = "cache:"):
+        self.kv = kv
+        self.prefix = prefix
+
+    async def get(self, key: str) -> Optional[CacheEntry]:
+        raw = await self.kv.get(self.prefix + key)
+        if raw is None:
+            return None
+        data = json.loads(raw)
+        return CacheEntry(data["v"], data["f"], data["s"])
+
+    async def set(self, key: str, entry: CacheEntry):
+        ttl_ms = max(1, int((entry.stale_until - time.time()) * 1000))
+        payload = json.dumps({"v": entry.value, "f": entry.fresh_until, "s": entry.stale_until})
+        await self.kv.set(self.prefix + key, payload, px=ttl_ms)
+
+    async def delete(self, key: str):
+        await self.kv.delete(self.prefix + key)
+
+    async def clear(self):
+        # Sin SCAN no podemos borrar por prefijo; las entradas caducarán solas
+        pass
+
+
+# Construye el backend según la configuración: Redis si hay URL, memoria si no
+def build_backend(url: Optional[str] = None, max_entries: int = 1024, prefix: str = "cache:"):
+    kv = kvstore.connect_kv(url)
+    if kv is None:
+        return MemoryBackend(max_entries=max_entries)
+    return KVBackend(kv, prefix=prefix)
+
+
+# Caché de respuestas con TTL, stale-while-revalidate y coalescencia de peticiones
+# (single-flight): N fallos concurrentes de la misma clave hacen una sola llamada.
+class ResponseCache:
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self._inflight: "dict[str, asyncio.Task]" = {}
+        # Métricas
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refresh_errors = 0
+
+    async def _fetch_and_store(self, key: str, fetch: Callable[[], Awaitable[Any]], ttl: float, stale_ttl: float):
+        value = await fetch()
+        now = time.time()
+        await self.backend.set(key, CacheEntry(value, now + ttl, now + ttl + stale_ttl))
+        return value
+
+    def _start_fetch(self, key: str, fetch, ttl: float, stale_ttl: float) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_and_store(key, fetch, ttl, stale_ttl))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._fetch_done(key, done))
+        else:
+            self.coalesced += 1
+        return task
+
+    # Libera la clave y recoge el error de la llamada compartida: si todos los que esperaban se
+    # cancelaron, nadie lo lee y asyncio avisaría de "Task exception was never retrieved"
+    def _fetch_done(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            task.exception()
+
+    def _on_refresh_done(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            self.refresh_errors += 1
+
+    async def get_or_fetch(
+        self,
+        key: str,
+        fetch: Callable[[], Awaitable[Any]],
+        ttl: float,
+        stale_ttl: float = 0,
+    ):
+        entry = await self.backend.get(key)
+        now = time.time()
+        if entry is not None and now < entry.fresh_until:
+            self.hits += 1
+            return entry.value
+        if entry is not None and now < entry.stale_until:
+            # Se sirve el valor viejo y se revalida en segundo plano
+            self.stale_hits += 1
+            if key not in self._inflight:
+                self._start_fetch(key, fetch, ttl, stale_ttl).add_done_callback(self._on_refresh_done)
+            return entry.value
+        self.misses += 1
+        # shield: si un cliente cancela, la llamada compartida sigue para los demás
+        return await asyncio.shield(self._start_fetch(key, fetch, ttl, stale_ttl))
+
+    async def invalidate(self, key: str):
+        await self.backend.delete(key)
+
+    async def clear(self):
+        await self.backend.clear()
+
+    def stats(self) -> dict:
+        stats = {
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "refresh_errors": self.refresh_errors,
+            "in_flight": len(self._inflight),
+        }
+        if isinstance(self.backend, MemoryBackend):
+            stats["entries"] = len(self.backend)
+            stats["evictions"] = self.backend.evictions
+        return stats
@@ -1,11 +1,29 @@
+import base64
+import json
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from typing import List, Optional, Tuple
+
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import delete
+from sqlalchemy import and_, delete, insert, or_, update
+from sqlalchemy.exc import IntegrityError
 
 import models, schemas
-from auth import get_password_hash # Importamos la función para hashear contraseñas
+from auth import REFRESH_TOKEN_EXPIRE_DAYS, create_refresh_token, hash_refresh_token
+from hashing import password_hasher # Hashing asíncrono fuera del event loop
+from invalidation import invalidation_bus
+from metrics import CRUD_SECONDS, timed
+from principals import principal_cache
+from revocation import revocation_index
+
+# Función para obtener un usuario por id
+@timed(CRUD_SECONDS)
+async def get_user_by_id(db: AsyncSession, user_id: int):
+    return await db.get(models.User, user_id)
 
 # Función para obtener un usuario por nombre de usuario
+@timed(CRUD_SECONDS)
 async def get_user_by_username(db: AsyncSession, username: str):
     result = await db.execute(
         select(models.User).filter(models.User.username == username)
@@ -13,28 +31,456 @@ async def get_user_by_username(db: AsyncSession, username: str):
     return result.scalars().first()
 
 # Función para obtener un usuario por email
+@timed(CRUD_SECONDS)
 async def get_user_by_email(db: AsyncSession, email: str):
     result = await db.execute(
         select(models.User).filter(models.User.email == email)
     )
     return result.scalars().first()
 
-# Función para crear un nuevo usuario
+# Error al crear un usuario que viola un índice único; `field` es "username" o "email"
+class DuplicateUserError(Exception):
+    def __init__(self, field: str):
+        super().__init__(field)
+        self.field = field
+
+# Mensajes de violación de unicidad de MySQL, SQLite y PostgreSQL
+_UNIQUE_VIOLATION_MARKERS = ("Duplicate entry", "UNIQUE constraint failed", "duplicate key value")
+
+# Deduce qué índice único se violó a partir del mensaje del driver; None si el error no es
+# un duplicado de username o email (p. ej. una columna NOT NULL o una clave foránea)
+def _duplicate_field(error: IntegrityError) -> Optional[str]:
+    message = str(error.orig)
+    if not any(marker in message for marker in _UNIQUE_VIOLATION_MARKERS):
+        return None
+    # MySQL incluye el valor duplicado antes de "for key"; PostgreSQL lo incluye en DETAIL
+    message = message.split("for key", 1)[-1].split("DETAIL", 1)[0]
+    if "email" in message:
+        return "email"
+    if "username" in message:
+        return "username"
+    return None
+
+# Función para crear un nuevo usuario.
+# Un solo INSERT: la unicidad la garantizan los índices de models.User (sin SELECT previos,
+# y sin condiciones de carrera entre registros concurrentes). El id generado se obtiene
+# del propio INSERT (lastrowid en MySQL, RETURNING donde el dialecto lo soporte).
+@timed(CRUD_SECONDS)
 async def create_user(db: AsyncSession, user: schemas.UserCreate):
-    hashed_password = get_password_hash(user.password) # Hasheamos la contraseña
-    db_user = models.User(
-        username=user.username,
-        email=user.email,
-        hashed_password=hashed_password
+    hashed_password = await password_hasher.hash(user.password) # Hasheamos la contraseña en el pool
+    values = {
+        "username": user.username,
+        "email": user.email,
+        "hashed_password": hashed_password,
+    }
+    try:
+        result = await db.execute(insert(models.User).values(**values))
+        await db.commit() # Confirma los cambios en la base de datos
+    except IntegrityError as e:
+        await db.rollback()
+        field = _duplicate_field(e)
+        if field is None:
+            raise # No es un duplicado: error del servidor, no del usuario
+        raise DuplicateUserError(field) from e
+    return models.User(id=result.inserted_primary_key[0], token_version=0, **values)
+
+# Importación masiva de usuarios en lotes de `batch_size`.
+# Las contraseñas se hashean en paralelo en el pool y los usuarios cuyo username o email
+# ya existen se omiten (INSERT IGNORE). Devuelve cuántos se insertaron.
+@timed(CRUD_SECONDS)
+async def bulk_create_users(db: AsyncSession, users: List[schemas.UserCreate], batch_size: int = 1000) -> int:
+    inserted = 0
+    # Sentencia Core sobre la tabla (executemany) en lugar del bulk insert del ORM
+    statement = (
+        insert(models.User.__table__)
+        .prefix_with("IGNORE", dialect="mysql")
+        .prefix_with("OR IGNORE", dialect="sqlite")
     )
-    db.add(db_user) # Agrega el nuevo usuario a la sesión
-    await db.commit() # Confirma los cambios en la base de datos
-    await db.refresh(db_user) # Refresca el objeto para obtener el ID generado
-    return db_user
+    for start in range(0, len(users), batch_size):
+        batch = users[start:start + batch_size]
+        hashed_passwords = await password_hasher.hash_many([user.password for user in batch])
+        rows = [
+            {"username": user.username, "email": user.email, "hashed_password": hashed}
+            for user, hashed in zip(batch, hashed_passwords)
+        ]
+        result = await db.execute(statement, rows)
+        await db.commit()
+        inserted += max(result.rowcount, 0)
+    return inserted
+
+# Sustituye un hash de contraseña obsoleto por el rehasheado con la política actual.
+# Solo si el hash no ha cambiado entretanto (p. ej. por un cambio de contraseña).
+@timed(CRUD_SECONDS)
+async def update_password_hash(db: AsyncSession, user_id: int, old_hash: str, new_hash: str) -> bool:
+    result = await db.execute(
+        update(models.User)
+        .where(models.User.id == user_id, models.User.hashed_password == old_hash)
+        .values(hashed_password=new_hash)
+    )
+    await db.commit()
+    return result.rowcount > 0
 
 # Función para eliminar un usuario
+@timed(CRUD_SECONDS)
 async def delete_user(db: AsyncSession, user_id: int):
     await db.execute(
         delete(models.User).where(models.User.id == user_id)
     )
-    await db.commit()
\ No newline at end of file
+    await db.commit()
+    principal_cache.invalidate_user(user_id) # Sus tokens dejan de resolverse desde la caché
+    await invalidation_bus.publish("user", user_id=user_id) # Y tampoco en los demás workers
+
+# --- Administración de usuarios ---
+# Listados por paginación por clave (WHERE columna > último valor ORDER BY columna LIMIT n):
+# cada página es una búsqueda en el índice, con el mismo coste en la primera página que en la
+# página un millón, a diferencia de OFFSET, que recorre y descarta todas las filas anteriores.
+
+# Columnas por las que se puede ordenar (y buscar por prefijo); todas tienen índice único
+USER_ORDER_COLUMNS = {
+    "id": models.User.id,
+    "username": models.User.username,
+    "email": models.User.email,
+}
+
+# Cursor de paginación inválido o generado para otro orden
+class InvalidCursorError(Exception):
+    pass
+
+# Cursor opaco: la columna de orden y el último valor devuelto
+def encode_user_cursor(order_by: str, value) -> str:
+    return base64.urlsafe_b64encode(json.dumps([order_by, value]).encode()).decode().rstrip("=")
+
+def decode_user_cursor(cursor: str, order_by: str):
+    try:
+        field, value = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursorError(cursor) from e
+    expected = int if order_by == "id" else str
+    if field != order_by or type(value) is not expected:
+        raise InvalidCursorError(cursor)
+    return value
+
+# LIKE 'prefijo%' con los comodines del prefijo escapados: así la consulta es un rango del índice
+def _like_prefix(prefix: str) -> str:
+    return prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+
+def _admin_users_query(order_by: str, prefix: Optional[str], include_disabled: bool):
+    table = models.User
+    column = USER_ORDER_COLUMNS[order_by]
+    query = select(table.id, table.username, table.email, table.disabled_at).order_by(column)
+    if prefix:
+        # El prefijo se aplica a la columna de orden, de modo que filtro y orden usan el mismo índice
+        query = query.where(column.like(_like_prefix(prefix), escape="\\"))
+    if not include_disabled:
+        query = query.where(table.disabled_at.is_(None))
+    return query, column
+
+def _admin_user_row(row) -> dict:
+    return {
+        "id": row.id,
+        "username": row.username,
+        "email": row.email,
+        "disabled_at": row.disabled_at.isoformat() if row.disabled_at is not None else None,
+    }
+
+# Una página de usuarios a partir de `after` (último valor de la columna de orden de la página
+# anterior). Devuelve (usuarios, cursor de la página siguiente o None).
+@timed(CRUD_SECONDS)
+async def list_users(
+    db: AsyncSession,
+    *,
+    order_by: str = "id",
+    prefix: Optional[str] = None,
+    after=None,
+    limit: int = 100,
+    include_disabled: bool = True,
+) -> Tuple[List[dict], Optional[str]]:
+    query, column = _admin_users_query(order_by, prefix, include_disabled)
+    if after is not None:
+        query = query.where(column > after)
+    # Se pide una fila de más para saber si hay página siguiente sin un COUNT
+    rows = (await db.execute(query.limit(limit + 1))).all()
+    users = [_admin_user_row(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        next_cursor = encode_user_cursor(order_by, users[-1][order_by])
+    return users, next_cursor
+
+# Todos los usuarios que cumplen el filtro, para exportaciones en streaming. Igual que
+# iter_mirrored_transactions: una sesión corta por página en lugar de un cursor abierto.
+async def iter_users(
+    session_factory,
+    *,
+    order_by: str = "id",
+    prefix: Optional[str] = None,
+    include_disabled: bool = True,
+    page_size: int = 1000,
+):
+    query, column = _admin_users_query(order_by, prefix, include_disabled)
+    after = None
+    while True:
+        page_query = query if after is None else query.where(column > after)
+        async with session_factory() as db:
+            rows = (await db.execute(page_query.limit(page_size))).all()
+        for row in rows:
+            yield _admin_user_row(row)
+        if len(rows) < page_size:
+            return
+        after = getattr(rows[-1], order_by)
+
+def _batches(ids: List[int], batch_size: int):
+    ids = sorted(set(ids)) # Orden de clave primaria: los locks se toman siempre en el mismo orden
+    for start in range(0, len(ids), batch_size):
+        yield ids[start:start + batch_size]
+
+async def _invalidate_users(user_ids: List[int]):
+    principal_cache.invalidate_users(user_ids)
+    await invalidation_bus.publish("users", user_ids=user_ids)
+
+# Elimina usuarios por id con un DELETE ... WHERE id IN (...) por lote (sus links y refresh
+# tokens se borran en cascada). Cada lote es una transacción corta. Devuelve cuántos se eliminaron.
+@timed(CRUD_SECONDS)
+async def bulk_delete_users(db: AsyncSession, user_ids: List[int], batch_size: int = 1000) -> int:
+    deleted = 0
+    for batch in _batches(user_ids, batch_size):
+        result = await db.execute(delete(models.User).where(models.User.id.in_(batch)))
+        await db.commit()
+        deleted += result.rowcount
+        await _invalidate_users(batch)
+    return deleted
+
+# Desactiva usuarios por id, en lotes: marca disabled_at, incrementa token_version (invalida
+# sus tokens de acceso) y revoca sus refresh tokens. Los ya desactivados no se modifican.
+# Devuelve cuántos se desactivaron.
+@timed(CRUD_SECONDS)
+async def bulk_disable_users(db: AsyncSession, user_ids: List[int], batch_size: int = 1000) -> int:
+    disabled = 0
+    now = _utcnow()
+    for batch in _batches(user_ids, batch_size):
+        result = await db.execute(
+            update(models.User)
+            .where(models.User.id.in_(batch), models.User.disabled_at.is_(None))
+            .values(disabled_at=now, token_version=models.User.token_version + 1)
+        )
+        await db.execute(
+            update(models.RefreshToken)
+            .where(models.RefreshToken.user_id.in_(batch), models.RefreshToken.revoked_at.is_(None))
+            .values(revoked_at=now)
+        )
+        await db.commit()
+        disabled += result.rowcount
+        await _invalidate_users(batch)
+    return disabled
+
+# --- Sesiones: refresh tokens y revocación ---
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+# Refresh token rechazado; `reused` indica que ya había sido rotado (posible robo)
+class InvalidRefreshTokenError(Exception):
+    def __init__(self, reused: bool = False):
+        super().__init__("reused" if reused else "invalid")
+        self.reused = reused
+
+# Emite un refresh token para una sesión nueva (family_id=None) o para una existente.
+# Devuelve (token, family_id).
+@timed(CRUD_SECONDS)
+async def issue_refresh_token(db: AsyncSession, user_id: int, family_id: Optional[str] = None) -> Tuple[str, str]:
+    token = create_refresh_token()
+    family_id = family_id or uuid.uuid4().hex
+    now = _utcnow()
+    await db.execute(insert(models.RefreshToken).values(
+        token_hash=hash_refresh_token(token),
+        user_id=user_id,
+        family_id=family_id,
+        created_at=now,
+        expires_at=now + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    ))
+    await db.commit()
+    return token, family_id
+
+# Rota un refresh token: lo marca como usado y emite otro de la misma familia.
+# El UPDATE condicional garantiza que dos peticiones concurrentes no roten el mismo token.
+# Devuelve (principal del usuario, nuevo token, family_id).
+@timed(CRUD_SECONDS)
+async def rotate_refresh_token(db: AsyncSession, token: str):
+    result = await db.execute(
+        select(models.RefreshToken).where(models.RefreshToken.token_hash == hash_refresh_token(token))
+    )
+    stored = result.scalars().first()
+    now = _utcnow()
+    if stored is None or stored.expires_at <= now:
+        raise InvalidRefreshTokenError()
+    if stored.revoked_at is not None:
+        # Reutilización de un token ya rotado: se revoca toda la sesión
+        await revoke_refresh_family(db, stored.family_id)
+        raise InvalidRefreshTokenError(reused=True)
+    result = await db.execute(
+        update(models.RefreshToken)
+        .where(models.RefreshToken.id == stored.id, models.RefreshToken.revoked_at.is_(None))
+        .values(revoked_at=now)
+    )
+    if result.rowcount != 1:
+        await db.rollback()
+        raise InvalidRefreshTokenError(reused=True)
+    user = await get_user_by_id(db, user_id=stored.user_id)
+    if user is None or user.disabled_at is not None:
+        await db.commit()
+        raise InvalidRefreshTokenError()
+    # Copia desacoplada de la sesión: el commit siguiente expira los objetos ORM
+    principal = schemas.Principal.model_validate(user)
+    new_token, family_id = await issue_refresh_token(db, user.id, stored.family_id) # Confirma ambos cambios
+    return principal, new_token, family_id
+
+# Revoca todos los refresh tokens de una sesión
+@timed(CRUD_SECONDS)
+async def revoke_refresh_family(db: AsyncSession, family_id: str):
+    await db.execute(
+        update(models.RefreshToken)
+        .where(models.RefreshToken.family_id == family_id, models.RefreshToken.revoked_at.is_(None))
+        .values(revoked_at=_utcnow())
+    )
+    await db.commit()
+
+# Revoca un token de acceso hasta su expiración. Se aplica al instante en este proceso y, con
+# almacén compartido, en los demás; si no, lo recogen en la siguiente sincronización de la lista.
+@timed(CRUD_SECONDS)
+async def revoke_access_token(db: AsyncSession, jti: str, expires_at: float):
+    try:
+        await db.execute(insert(models.RevokedToken).values(
+            jti=jti,
+            revoked_at=_utcnow(),
+            expires_at=datetime.fromtimestamp(expires_at, timezone.utc).replace(tzinfo=None),
+        ))
+        await db.commit()
+    except IntegrityError:
+        await db.rollback() # Ya estaba revocado (p. ej. desde otro worker aún no sincronizado)
+    revocation_index.add(jti, expires_at)
+    await invalidation_bus.publish("revoked", jti=jti, expires_at=expires_at)
+
+# Purga filas que ya no sirven: tokens expirados
+@timed(CRUD_SECONDS)
+async def purge_expired_tokens(db: AsyncSession):
+    now = _utcnow()
+    await db.execute(delete(models.RevokedToken).where(models.RevokedToken.expires_at <= now))
+    await db.execute(delete(models.RefreshToken).where(models.RefreshToken.expires_at <= now))
+    await db.commit()
+
+
+# --- Links de Belvo ---
+
+# Error al registrar un link que el usuario ya tenía
+class DuplicateLinkError(Exception):
+    pass
+
+@timed(CRUD_SECONDS)
+async def get_user_links(db: AsyncSession, user_id: int):
+    result = await db.execute(
+        select(models.BelvoLink).where(models.BelvoLink.user_id == user_id).order_by(models.BelvoLink.id)
+    )
+    return result.scalars().all()
+
+@timed(CRUD_SECONDS)
+async def get_user_link(db: AsyncSession, user_id: int, link_id: str):
+    result = await db.execute(
+        select(models.BelvoLink).where(
+            models.BelvoLink.user_id == user_id, models.BelvoLink.link_id == link_id
+        )
+    )
+    return result.scalars().first()
+
+# Devuelve cuáles de `link_ids` pertenecen al usuario (una sola consulta)
+@timed(CRUD_SECONDS)
+async def get_owned_link_ids(db: AsyncSession, user_id: int, link_ids: List[str]) -> set:
+    result = await db.execute(
+        select(models.BelvoLink.link_id).where(
+            models.BelvoLink.user_id == user_id, models.BelvoLink.link_id.in_(link_ids)
+        )
+    )
+    return set(result.scalars().all())
+
+# Registra el link y, si es la primera vez que alguien lo registra, su estado de sincronización
+# (vencido desde ya, para que el planificador lo recoja en la siguiente pasada)
+@timed(CRUD_SECONDS)
+async def create_user_link(db: AsyncSession, user_id: int, link: schemas.BelvoLinkCreate):
+    now = _utcnow()
+    db_link = models.BelvoLink(
+        user_id=user_id, link_id=link.link_id, institution=link.institution, created_at=now
+    )
+    db.add(db_link)
+    try:
+        await db.flush()
+        await db.execute(
+            insert(models.BelvoSyncState)
+            .prefix_with("IGNORE", dialect="mysql")
+            .prefix_with("OR IGNORE", dialect="sqlite")
+            .values(link_id=link.link_id, next_sync_at=now)
+        )
+        await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        raise DuplicateLinkError(link.link_id) from e
+    await db.refresh(db_link)
+    return db_link
+
+@timed(CRUD_SECONDS)
+async def delete_user_link(db: AsyncSession, user_id: int, link_id: str) -> bool:
+    result = await db.execute(
+        delete(models.BelvoLink).where(
+            models.BelvoLink.user_id == user_id, models.BelvoLink.link_id == link_id
+        )
+    )
+    await db.commit()
+    return result.rowcount > 0
+
+# --- Copia local de Belvo (la escribe sync.py) ---
+
+@timed(CRUD_SECONDS)
+async def get_sync_state(db: AsyncSession, link_id: str):
+    return await db.get(models.BelvoSyncState, link_id)
+
+# Cuentas o balances guardados de un link, tal como los devolvió Belvo
+@timed(CRUD_SECONDS)
+async def get_mirrored_data(db: AsyncSession, model, link_id: str) -> list:
+    result = await db.execute(select(model.data).where(model.link_id == link_id).order_by(model.id))
+    return result.scalars().all()
+
+# Transacciones guardadas de un link, de la más reciente a la más antigua.
+# Paginación por clave (value_date, id) sobre el índice ix_belvo_transactions_link_date:
+# cada página es una consulta corta con su propia sesión, apta para respuestas en streaming.
+async def iter_mirrored_transactions(
+    session_factory,
+    link_id: str,
+    *,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    limit: Optional[int] = None,
+    page_size: int = 500,
+):
+    table = models.BelvoTransaction
+    query = select(table.value_date, table.id, table.data).where(table.link_id == link_id)
+    if date_from is not None:
+        query = query.where(table.value_date >= date_from)
+    if date_to is not None:
+        query = query.where(table.value_date <= date_to)
+    query = query.order_by(table.value_date.desc(), table.id.desc())
+    yielded = 0
+    cursor = None
+    while limit is None or yielded < limit:
+        size = page_size if limit is None else min(page_size, limit - yielded)
+        page_query = query
+        if cursor is not None:
+            last_date, last_id = cursor
+            page_query = query.where(or_(
+                table.value_date < last_date,
+                and_(table.value_date == last_date, table.id < last_id),
+            ))
+        async with session_factory() as db:
+            rows = (await db.execute(page_query.limit(size))).all()
+        for row in rows:
+            yield row.data
+        yielded += len(rows)
+        if len(rows) < size:
+            return
+        cursor = (rows[-1].value_date, rows[-1].id)
@@ -1,16 +1,128 @@
+import asyncio
 import os
+import itertools
+import time
+from sqlalchemy import exc, text
+from sqlalchemy.engine import make_url
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from dotenv import load_dotenv
 
+from metrics import instrument_engine
+
 load_dotenv() # Carga las variables de entorno del archivo .env
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# Réplicas de solo lectura, separadas por comas (opcional)
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+
+# Configuración del motor y del pool de conexiones
+DB_ECHO = os.getenv("DB_ECHO", "false").lower() in ("1", "true", "yes")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10)) # Segundos esperando una conexión libre
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800)) # Recicla conexiones antes del wait_timeout de MySQL
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", 0)) # 0 = sin límite
+DB_POOL_WARMUP = int(os.getenv("DB_POOL_WARMUP", 2)) # Conexiones abiertas al arrancar, por motor
+
+
+# Métricas de checkout del pool: latencia total de obtener una conexión y tiempo
+# esperando cuando no había ninguna conexión libre.
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.checkout_seconds_total = 0.0
+        self.checkout_seconds_max = 0.0
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.timeouts = 0
+
+    def stats(self) -> dict:
+        return {
+            "checkouts": self.checkouts,
+            "checkout_seconds_total": round(self.checkout_seconds_total, 6),
+            "checkout_seconds_max": round(self.checkout_seconds_max, 6),
+            "waits": self.waits,
+            "wait_seconds_total": round(self.wait_seconds_total, 6),
+            "timeouts": self.timeouts,
+        }
+
+
+# Pool de conexiones que mide el tiempo de cada checkout
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def connect(self):
+        # Solo espera si no queda ninguna conexión libre ni hueco de overflow (max_overflow=-1: sin límite)
+        waited = (
+            self._max_overflow != -1
+            and self.checkedin() == 0
+            and self.checkedout() >= self.size() + self._max_overflow
+        )
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        except exc.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - start
+            self.metrics.checkouts += 1
+            self.metrics.checkout_seconds_total += elapsed
+            self.metrics.checkout_seconds_max = max(self.metrics.checkout_seconds_max, elapsed)
+            if waited:
+                self.metrics.waits += 1
+                self.metrics.wait_seconds_total += elapsed
+
+    # Conserva la clase (y las métricas) al recrear el pool, p. ej. tras engine.dispose()
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
 
-# 1. create_async_engine: Crea una instancia del motor de base de datos.
+# Argumentos de conexión según el driver (timeout por sentencia)
+def _connect_args(url) -> dict:
+    if not DB_STATEMENT_TIMEOUT_MS:
+        return {}
+    driver = make_url(url).get_backend_name()
+    if driver == "mysql":
+        # MAX_EXECUTION_TIME aplica a SELECT (MySQL 5.7.8+)
+        return {"init_command": f"SET SESSION MAX_EXECUTION_TIME={DB_STATEMENT_TIMEOUT_MS}"}
+    if driver == "postgresql":
+        return {"server_settings": {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}}
+    return {}
+
+
+# Crea un motor asíncrono con la configuración de pool del entorno.
+# SQLite (usado en pruebas/benchmarks) mantiene el pool por defecto de SQLAlchemy.
+def build_engine(url):
+    kwargs = {"echo": DB_ECHO, "future": True, "connect_args": _connect_args(url)}
+    if make_url(url).get_backend_name() != "sqlite":
+        kwargs.update(
+            poolclass=InstrumentedQueuePool,
+            pool_size=DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW,
+            pool_timeout=DB_POOL_TIMEOUT,
+            pool_recycle=DB_POOL_RECYCLE,
+            pool_pre_ping=DB_POOL_PRE_PING,
+        )
+    return create_async_engine(url, **kwargs)
+
+
+# 1. create_async_engine: Crea una instancia del motor de base de datos (ver build_engine).
 #    future=True: Usa la API 2.0 de SQLAlchemy para operaciones asíncronas.
-#    echo=True: Opcional, muestra las sentencias SQL en la consola para depuración.
-engine = create_async_engine(DATABASE_URL, echo=True, future=True)
+#    echo: desactivado por defecto (DB_ECHO=true muestra las sentencias SQL para depuración).
+engine = build_engine(DATABASE_URL)
+# Motores de las réplicas de lectura; sin réplicas, las lecturas van al primario
+read_engines = [build_engine(url) for url in DATABASE_REPLICA_URLS] or [engine]
+# Duración de cada sentencia SQL en el histograma db_query_duration_seconds de /metrics
+for _db_engine in {id(e): e for e in [engine, *read_engines]}.values():
+    instrument_engine(_db_engine)
 
 # 2. sessionmaker: Crea una "fábrica" de sesiones. Cada sesión será un "espacio de trabajo"
 #    para tus operaciones de base de datos.
@@ -24,6 +136,11 @@ AsyncSessionLocal = sessionmaker(
     bind=engine,
     class_=AsyncSession
 )
+# Fábricas de sesiones de solo lectura, repartidas en round-robin entre las réplicas
+_read_session_factories = itertools.cycle([
+    sessionmaker(autocommit=False, autoflush=False, bind=read_engine, class_=AsyncSession)
+    for read_engine in read_engines
+])
 
 # 3. declarative_base: Retorna una clase base para tus modelos ORM.
 #    Todas tus tablas (modelos) heredarán de esta clase.
@@ -36,4 +153,55 @@ async def get_db():
         try:
             yield session # Provee la sesión al código que la llama
         finally:
-            await session.close() # Asegura que la sesión se cierre al finalizar
\ No newline at end of file
+            await session.close() # Asegura que la sesión se cierre al finalizar
+
+# Nueva sesión contra la siguiente réplica de lectura (para código fuera de las dependencias)
+def read_session() -> AsyncSession:
+    return next(_read_session_factories)()
+
+# Igual que get_db, pero contra una réplica de lectura. Solo para consultas que toleren
+# el retraso de replicación (nunca para leer algo recién escrito en la misma petición).
+async def get_read_db():
+    async with read_session() as session:
+        try:
+            yield session
+        finally:
+            await session.close()
+
+# Abre `connections` conexiones a la vez en cada motor para que las primeras peticiones no
+# paguen el handshake (TCP, TLS, autenticación); después se devuelven al pool.
+async def warm_pool(connections: int = DB_POOL_WARMUP):
+    async def open_connection(db_engine):
+        conn = await db_engine.connect().start()
+        await conn.execute(text("SELECT 1"))
+        return conn
+
+    engines = {id(db_engine): db_engine for db_engine in [engine, *read_engines]}.values()
+    results = await asyncio.gather(
+        *(open_connection(db_engine) for db_engine in engines for _ in range(max(0, connections))),
+        return_exceptions=True,
+    )
+    await asyncio.gather(*(conn.close() for conn in results if not isinstance(conn, BaseException)))
+    errors = [error for error in results if isinstance(error, BaseException)]
+    if errors:
+        raise errors[0]
+
+# Estado y métricas de los pools de conexiones (primario y réplicas)
+def pool_stats() -> dict:
+    stats = {}
+    engines = [("primary", engine)] + [
+        (f"replica_{i}", read_engine)
+        for i, read_engine in enumerate(read_engines) if read_engine is not engine
+    ]
+    for name, db_engine in engines:
+        pool = db_engine.pool
+        if not isinstance(pool, InstrumentedQueuePool):
+            continue
+        stats[name] = {
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": pool.overflow(),
+            **pool.metrics.stats(),
+        }
+    return stats
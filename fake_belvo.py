@@ -0,0 +1,150 @@
+# Servidor local que imita la API de Belvo (solo las rutas que usa belvo_api.py).
+# Sirve datos deterministas para cualquier link, sin credenciales reales ni red externa.
+#
+# Uso:
+#   uvicorn fake_belvo:app --port 8001
+#   BELVO_API_URL=http://127.0.0.1:8001/api uvicorn main:app
+#
+# Los links de prueba se "crean" con el external_id delante del link_id, separado por ":"
+# (p. ej. "42:mi-link" es un link del usuario 42); sin ":" el link no tiene external_id.
+#
+# También se puede usar en proceso: BelvoClient(transport=httpx.ASGITransport(app=fake_belvo.app),
+# base_url="http://fake-belvo/api").
+import asyncio
+import os
+from datetime import date, timedelta
+from typing import Optional
+
+from fastapi import FastAPI, Query, Request
+
+# Número de cuentas y transacciones generadas por link, y latencia añadida por petición
+FAKE_BELVO_ACCOUNTS = int(os.getenv("FAKE_BELVO_ACCOUNTS", 2))
+FAKE_BELVO_TRANSACTIONS = int(os.getenv("FAKE_BELVO_TRANSACTIONS", 1000))
+FAKE_BELVO_LATENCY_MS = float(os.getenv("FAKE_BELVO_LATENCY_MS", 0))
+# Fecha valor de la transacción más reciente (las demás retroceden un día cada 10)
+FAKE_BELVO_TODAY = date.fromisoformat(os.getenv("FAKE_BELVO_TODAY", date.today().isoformat()))
+
+app = FastAPI(title="Belvo local (pruebas)")
+
+# Transacciones por link; se puede modificar en caliente para simular transacciones nuevas
+transactions_per_link: "dict[str, int]" = {}
+# Peticiones recibidas por ruta (útil para comprobar cuántas llamadas hace el cliente)
+requests_count: "dict[str, int]" = {}
+
+
+@app.middleware("http")
+async def simulate_latency(request: Request, call_next):
+    requests_count[request.url.path] = requests_count.get(request.url.path, 0) + 1
+    if FAKE_BELVO_LATENCY_MS:
+        await asyncio.sleep(FAKE_BELVO_LATENCY_MS / 1000)
+    return await call_next(request)
+
+
+def _account(link: str, index: int) -> dict:
+    return {
+        "id": f"{link}-acc-{index}",
+        "link": link,
+        "institution": {"name": "erebor_mx_retail", "type": "bank"},
+        "category": "CHECKING_ACCOUNT",
+        "type": "Cuenta Corriente",
+        "name": f"Cuenta {index}",
+        "number": f"4057{index:08d}",
+        "currency": "MXN",
+        "balance": {"current": 1000.0 * (index + 1), "available": 900.0 * (index + 1)},
+    }
+
+
+# La transacción i es más reciente cuanto mayor es i: las nuevas aparecen al subir el total
+def _transaction(link: str, index: int, total: int) -> dict:
+    account = _account(link, index % FAKE_BELVO_ACCOUNTS)
+    return {
+        "id": f"{link}-tx-{index:08d}",
+        "account": {key: account[key] for key in ("id", "link", "institution", "name", "number", "currency", "balance")},
+        "amount": round(10 + (index * 37) % 5000 / 7, 2),
+        "currency": "MXN",
+        "description": f"Movimiento {index}",
+        "value_date": (FAKE_BELVO_TODAY - timedelta(days=(total - 1 - index) // 10)).isoformat(),
+        "type": "OUTFLOW" if index % 3 else "INFLOW",
+        "status": "PROCESSED",
+        "category": "Online Platforms & Leisure",
+        "subcategory": None,
+    }
+
+
+@app.get("/api/institutions/")
+async def institutions():
+    return {
+        "count": 1,
+        "next": None,
+        "results": [{
+            "id": 1,
+            "name": "erebor_mx_retail",
+            "type": "bank",
+            "website": "https://www.erebor.mx",
+            "display_name": "Erebor Bank",
+            "country_codes": ["MX"],
+            "primary_color": "#056dae",
+            "logo": None,
+            "icon_logo": None,
+            "text_logo": None,
+            "status": "healthy",
+        }],
+    }
+
+
+@app.get("/api/links/{link_id}/")
+async def link_detail(link_id: str):
+    external_id, separator, _ = link_id.partition(":")
+    return {
+        "id": link_id,
+        "institution": "erebor_mx_retail",
+        "access_mode": "recurrent",
+        "status": "valid",
+        "external_id": external_id if separator else None,
+    }
+
+
+@app.get("/api/accounts/")
+async def accounts(link: str):
+    results = [_account(link, i) for i in range(FAKE_BELVO_ACCOUNTS)]
+    return {"count": len(results), "next": None, "results": results}
+
+
+@app.get("/api/br/balances/")
+async def balances(link: str):
+    results = [
+        {
+            "id": f"{link}-bal-{i}",
+            "link": link,
+            "account_id": f"{link}-acc-{i}",
+            "currency": "MXN",
+            "available": 900.0 * (i + 1),
+            "blocked": 0.0,
+            "automatically_invested": 0.0,
+        }
+        for i in range(FAKE_BELVO_ACCOUNTS)
+    ]
+    return {"count": len(results), "next": None, "results": results}
+
+
+# Paginado como Belvo: `next` es la URL completa de la página siguiente (o null)
+@app.get("/api/transactions/")
+async def transactions(
+    request: Request,
+    link: str,
+    page: int = 1,
+    page_size: int = Query(100, ge=1, le=1000),
+    value_date__gte: Optional[date] = None,
+    value_date__lte: Optional[date] = None,
+):
+    total = transactions_per_link.get(link, FAKE_BELVO_TRANSACTIONS)
+    matching = [
+        transaction for transaction in (_transaction(link, i, total) for i in range(total))
+        if (value_date__gte is None or transaction["value_date"] >= value_date__gte.isoformat())
+        and (value_date__lte is None or transaction["value_date"] <= value_date__lte.isoformat())
+    ]
+    start = (page - 1) * page_size
+    next_url = None
+    if start + page_size < len(matching):
+        next_url = str(request.url.include_query_params(page=page + 1))
+    return {"count": len(matching), "next": next_url, "results": matching[start:start + page_size]}
@@ -0,0 +1,160 @@
+import asyncio
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Awaitable, Callable, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+
+import auth
+from metrics import PASSWORD_HASH_SECONDS, PASSWORD_HASH_WAIT_SECONDS
+
+load_dotenv()
+
+# Configuración del pool de hashing (bcrypt/argon2 son costosos en CPU, ~250 ms por hash;
+# esquema y coste en auth.py)
+# PASSWORD_HASH_EXECUTOR: "thread" (por defecto) o "process"
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+# Número máximo de operaciones esperando un worker antes de responder 503
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", 32))
+
+
+# Servicio asíncrono de hashing: ejecuta bcrypt fuera del event loop en un pool acotado.
+# - Como mucho `max_workers` operaciones se ejecutan a la vez.
+# - Como mucho `max_queue` operaciones esperan turno; si se supera, se responde 503
+#   en lugar de acumular peticiones (backpressure).
+class PasswordHasher:
+    def __init__(
+        self,
+        executor_kind: str = PASSWORD_HASH_EXECUTOR,
+        max_workers: int = PASSWORD_HASH_WORKERS,
+        max_queue: int = PASSWORD_HASH_MAX_QUEUE,
+    ):
+        if executor_kind not in ("thread", "process"):
+            raise ValueError(f"PASSWORD_HASH_EXECUTOR inválido: {executor_kind!r}")
+        self.executor_kind = executor_kind
+        self.max_workers = max(1, max_workers)
+        self.max_queue = max(0, max_queue)
+        self._executor: Optional[Executor] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # Métricas
+        self.in_flight = 0
+        self.queued = 0
+        self.completed = 0
+        self.rejected = 0
+        self.rehashed = 0
+        self.rehash_skipped = 0
+        self.rehash_failed = 0
+        self._background: set = set() # Referencias a las tareas de rehash en curso
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="pwd-hash"
+                )
+        return self._executor
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        # Se crea de forma perezosa para quedar ligado al event loop en ejecución
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_workers)
+        return self._semaphore
+
+    async def _run(self, func, *args, reject_when_full: bool = True):
+        semaphore = self._get_semaphore()
+        if reject_when_full and semaphore.locked() and self.queued >= self.max_queue:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Servicio de autenticación saturado, inténtalo de nuevo más tarde.",
+                headers={"Retry-After": "1"},
+            )
+        self.queued += 1
+        queued_at = time.perf_counter()
+        try:
+            await semaphore.acquire()
+        finally:
+            self.queued -= 1
+        started_at = time.perf_counter()
+        PASSWORD_HASH_WAIT_SECONDS.observe(started_at - queued_at)
+        self.in_flight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), func, *args)
+        finally:
+            PASSWORD_HASH_SECONDS.observe(time.perf_counter() - started_at, func.__name__)
+            self.in_flight -= 1
+            self.completed += 1
+            semaphore.release()
+
+    async def verify(self, plain_password: str, hashed_password: str) -> bool:
+        return await self._run(auth.verify_password, plain_password, hashed_password)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(auth.get_password_hash, password)
+
+    # Hash con un esquema o parámetros obsoletos (barato: no calcula ningún hash)
+    def needs_update(self, hashed_password: str) -> bool:
+        return auth.password_needs_update(hashed_password)
+
+    # Rehashea la contraseña con la política actual fuera de la petición y guarda el resultado
+    # con `save(nuevo_hash)`. Si el pool tiene cola se omite: se reintentará en otro login.
+    def rehash_in_background(self, password: str, save: Callable[[str], Awaitable]):
+        if self.queued > 0:
+            self.rehash_skipped += 1
+            return
+
+        async def rehash():
+            try:
+                await save(await self._run(auth.get_password_hash, password))
+                self.rehashed += 1
+            except Exception as e:
+                self.rehash_failed += 1
+                print(f"No se pudo actualizar el hash de una contraseña: {getattr(e, 'detail', e)}")
+
+        task = asyncio.create_task(rehash())
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    # Hashea muchas contraseñas en paralelo, en lotes de `chunk_size` por tarea.
+    # Como mucho la mitad de los workers se dedica a lotes, para que los logins sigan
+    # teniendo hueco; los lotes esperan turno en lugar de ser rechazados.
+    async def hash_many(self, passwords: list, chunk_size: int = 16) -> list:
+        chunks = [passwords[i:i + chunk_size] for i in range(0, len(passwords), chunk_size)]
+        batch_slots = asyncio.Semaphore(max(1, self.max_workers // 2))
+
+        async def hash_chunk(chunk):
+            async with batch_slots:
+                return await self._run(auth.get_password_hashes, chunk, reject_when_full=False)
+
+        results = await asyncio.gather(*(hash_chunk(chunk) for chunk in chunks))
+        return [hashed for chunk in results for hashed in chunk]
+
+    def stats(self) -> dict:
+        return {
+            "executor": self.executor_kind,
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "rehashed": self.rehashed,
+            "rehash_skipped": self.rehash_skipped,
+            "rehash_failed": self.rehash_failed,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._semaphore = None
+
+
+# Instancia compartida usada por las rutas y por crud
+password_hasher = PasswordHasher()
@@ -0,0 +1,88 @@
+import asyncio
+import json
+import os
+import uuid
+
+from dotenv import load_dotenv
+
+import kvstore
+from principals import principal_cache
+from revocation import revocation_index
+
+load_dotenv()
+
+# Almacén cuyo pub/sub difunde las invalidaciones (por defecto SHARED_STATE_URL).
+# Vacío = sin difusión: los demás workers se enteran por la sincronización con la DB o al
+# caducar sus cachés.
+INVALIDATION_URL = os.getenv("INVALIDATION_URL") or kvstore.SHARED_STATE_URL
+INVALIDATION_CHANNEL = os.getenv("INVALIDATION_CHANNEL", "auth:invalidate")
+
+
+# Difunde a todos los workers y nodos los cambios que invalidan estado en memoria:
+# - "user": un usuario se modificó o se eliminó (se descarta de la caché de principals)
+# - "users": lo mismo para un lote de usuarios (operaciones masivas de administración)
+# - "revoked": un token de acceso se revocó (se añade al índice de revocación al instante)
+# Cada proceso aplica el cambio localmente antes de publicarlo e ignora sus propios mensajes.
+class InvalidationBus:
+    def __init__(self, kv=None, channel: str = INVALIDATION_CHANNEL):
+        self.kv = kv if kv is not None else kvstore.connect_kv(INVALIDATION_URL)
+        self.channel = channel
+        self.origin = uuid.uuid4().hex
+        self._handlers = {}
+        # Métricas
+        self.published = 0
+        self.received = 0
+        self.errors = 0
+
+    def on(self, kind: str, handler):
+        self._handlers[kind] = handler
+
+    async def publish(self, kind: str, **payload):
+        if self.kv is None:
+            return
+        message = json.dumps({"kind": kind, "origin": self.origin, **payload})
+        try:
+            await self.kv.publish(self.channel, message)
+            self.published += 1
+        except Exception as e:
+            # El cambio ya está en la DB: los demás workers lo recogerán igualmente más tarde
+            self.errors += 1
+            print(f"No se pudo difundir la invalidación {kind!r}: {e}")
+
+    def _dispatch(self, raw: bytes):
+        message = json.loads(raw)
+        if message.pop("origin", None) == self.origin:
+            return
+        handler = self._handlers.get(message.pop("kind", None))
+        if handler is not None:
+            self.received += 1
+            handler(**message)
+
+    # Bucle de escucha en segundo plano (se lanza en el arranque); se resuscribe tras un error
+    async def run(self, retry_delay: float = 1.0):
+        if self.kv is None:
+            return
+        while True:
+            try:
+                async for raw in self.kv.subscribe(self.channel):
+                    self._dispatch(raw)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.errors += 1
+                print(f"Error escuchando invalidaciones: {e}")
+            await asyncio.sleep(retry_delay)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.kv is not None,
+            "published": self.published,
+            "received": self.received,
+            "errors": self.errors,
+        }
+
+
+invalidation_bus = InvalidationBus()
+invalidation_bus.on("user", lambda user_id: principal_cache.invalidate_user(user_id))
+invalidation_bus.on("users", lambda user_ids: principal_cache.invalidate_users(user_ids))
+invalidation_bus.on("revoked", lambda jti, expires_at: revocation_index.add(jti, expires_at))
@@ -0,0 +1,165 @@
+import base64
+import hashlib
+import hmac
+import json
+import time
+from datetime import datetime
+from typing import Dict, Optional
+
+
+# Error común a todos los backends cuando un token no es válido
+class InvalidTokenError(Exception):
+    pass
+
+
+# Claims de fecha que se codifican como timestamp entero (igual que python-jose)
+_TIME_CLAIMS = ("exp", "iat", "nbf")
+
+
+def _normalize_claims(claims: dict) -> dict:
+    normalized = dict(claims)
+    for name in _TIME_CLAIMS:
+        value = normalized.get(name)
+        if isinstance(value, datetime):
+            normalized[name] = int(value.timestamp())
+    return normalized
+
+
+# Clase base: gestiona varias claves activas identificadas por `kid` para poder rotarlas.
+# Los tokens se firman con la clave activa; se verifican con la clave que indique su `kid`.
+# `legacy_key` verifica los tokens emitidos sin `kid` (antes de la rotación de claves).
+class JWTBackend:
+    name = "base"
+
+    def __init__(self, keys: Dict[str, str], active_kid: str, algorithm: str, legacy_key: Optional[str] = None):
+        if active_kid not in keys:
+            raise ValueError(f"JWT_ACTIVE_KID {active_kid!r} no está entre las claves configuradas")
+        self.keys = keys
+        self.active_kid = active_kid
+        self.algorithm = algorithm
+        self.legacy_key = legacy_key
+
+    def _key_for(self, kid: Optional[str]) -> str:
+        key = self.keys.get(kid) if kid is not None else self.legacy_key
+        if key is None:
+            raise InvalidTokenError(f"Clave de firma desconocida: {kid!r}")
+        return key
+
+    def encode(self, claims: dict) -> str:
+        raise NotImplementedError
+
+    def decode(self, token: str) -> dict:
+        raise NotImplementedError
+
+
+# Backend basado en python-jose (comportamiento original)
+class JoseBackend(JWTBackend):
+    name = "jose"
+
+    def encode(self, claims: dict) -> str:
+        from jose import jwt
+
+        return jwt.encode(
+            claims, self.keys[self.active_kid], algorithm=self.algorithm,
+            headers={"kid": self.active_kid},
+        )
+
+    def decode(self, token: str) -> dict:
+        from jose import JWTError, jwt
+
+        try:
+            kid = jwt.get_unverified_header(token).get("kid")
+            return jwt.decode(token, self._key_for(kid), algorithms=[self.algorithm])
+        except JWTError as e:
+            raise InvalidTokenError(str(e)) from e
+
+
+def _b64encode(data: bytes) -> bytes:
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+# Backend HMAC (HS256/HS384/HS512) implementado solo con la librería estándar.
+# Evita las capas genéricas de python-jose (JWK, validación de claims opcionales),
+# lo que lo hace varias veces más rápido para el caso que usamos.
+class HmacBackend(JWTBackend):
+    name = "hmac"
+    _digests = {"HS256": hashlib.sha256, "HS384": hashlib.sha384, "HS512": hashlib.sha512}
+
+    def __init__(self, keys: Dict[str, str], active_kid: str, algorithm: str, legacy_key: Optional[str] = None):
+        if algorithm not in self._digests:
+            raise ValueError(f"El backend 'hmac' no soporta el algoritmo {algorithm!r}")
+        super().__init__(keys, active_kid, algorithm, legacy_key)
+        self._digest = self._digests[algorithm]
+
+    def _sign(self, signing_input: bytes, key: str) -> bytes:
+        return hmac.new(key.encode(), signing_input, self._digest).digest()
+
+    def encode(self, claims: dict) -> str:
+        header = {"alg": self.algorithm, "typ": "JWT", "kid": self.active_kid}
+        segments = [
+            _b64encode(json.dumps(header, separators=(",", ":")).encode()),
+            _b64encode(json.dumps(_normalize_claims(claims), separators=(",", ":")).encode()),
+        ]
+        signing_input = b".".join(segments)
+        signature = _b64encode(self._sign(signing_input, self.keys[self.active_kid]))
+        return (signing_input + b"." + signature).decode()
+
+    def decode(self, token: str) -> dict:
+        try:
+            header_segment, payload_segment, signature_segment = token.split(".")
+            header = json.loads(_b64decode(header_segment))
+            signature = _b64decode(signature_segment)
+        except ValueError as e:
+            raise InvalidTokenError("Token mal formado") from e
+        if not isinstance(header, dict):
+            raise InvalidTokenError("Cabecera mal formada")
+        if header.get("alg") != self.algorithm:
+            raise InvalidTokenError("Algoritmo no permitido")
+        signing_input = f"{header_segment}.{payload_segment}".encode()
+        expected = self._sign(signing_input, self._key_for(header.get("kid")))
+        if not hmac.compare_digest(signature, expected):
+            raise InvalidTokenError("Firma inválida")
+        try:
+            payload = json.loads(_b64decode(payload_segment))
+        except ValueError as e:
+            raise InvalidTokenError("Payload mal formado") from e
+        if not isinstance(payload, dict):
+            raise InvalidTokenError("Payload mal formado")
+        now = time.time()
+        try:
+            if "exp" in payload and now >= payload["exp"]:
+                raise InvalidTokenError("Token expirado")
+            if "nbf" in payload and now < payload["nbf"]:
+                raise InvalidTokenError("Token aún no válido")
+        except TypeError as e:
+            raise InvalidTokenError("Claims de fecha inválidos") from e
+        return payload
+
+
+BACKENDS = {JoseBackend.name: JoseBackend, HmacBackend.name: HmacBackend}
+
+
+# Convierte "kid1:secreto1,kid2:secreto2" en un diccionario
+def parse_keys(raw: str) -> Dict[str, str]:
+    keys = {}
+    for item in raw.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        kid, sep, secret = item.partition(":")
+        if not sep or not kid or not secret:
+            raise ValueError("JWT_KEYS debe tener el formato 'kid:secreto,kid:secreto'")
+        keys[kid] = secret
+    return keys
+
+
+def build_backend(name: str, keys: Dict[str, str], active_kid: str, algorithm: str, legacy_key: Optional[str] = None) -> JWTBackend:
+    try:
+        backend_class = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"JWT_BACKEND desconocido: {name!r} (opciones: {', '.join(BACKENDS)})")
+    return backend_class(keys, active_kid, algorithm, legacy_key)
@@ -0,0 +1,197 @@
+# Servidor local que imita a Redis (solo los comandos que usa kvstore.py), para probar el
+# estado compartido entre varios workers o nodos sin instalar Redis. Guarda los datos en
+# memoria con kvstore.LocalKV; no persiste nada.
+#
+# Uso:
+#   python kv_server.py --port 6390
+#   SHARED_STATE_URL=redis://127.0.0.1:6390/0 uvicorn main:app --workers 4
+#
+# Comandos: PING, GET, SET (PX/EX), DEL, INCR, INCRBY, PEXPIRE, PTTL, PUBLISH, SUBSCRIBE,
+# UNSUBSCRIBE, HELLO (RESP2 o RESP3, el protocolo por defecto de redis-py 8) y respuestas
+# neutras a CLIENT y SELECT.
+import argparse
+import asyncio
+from typing import List, Optional
+
+from kvstore import LocalKV
+
+
+class RespError(Exception):
+    pass
+
+
+def _bulk(value: Optional[bytes], resp3: bool = False) -> bytes:
+    if value is None:
+        return b"_\r\n" if resp3 else b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+# En RESP3 los mensajes de pub/sub son de tipo "push" (>) en lugar de arrays
+def _array(items: List[bytes], push: bool = False) -> bytes:
+    return (b">%d\r\n" if push else b"*%d\r\n") % len(items) + b"".join(items)
+
+
+# Respuesta a HELLO: un mapa en RESP3, un array de pares clave-valor en RESP2
+def _hello(protocol: int) -> bytes:
+    fields = [
+        (b"server", _bulk(b"kv_server")),
+        (b"version", _bulk(b"6.0.0")),
+        (b"proto", _integer(protocol)),
+        (b"mode", _bulk(b"standalone")),
+        (b"role", _bulk(b"master")),
+        (b"modules", _array([])),
+    ]
+    items = b"".join(_bulk(key) + value for key, value in fields)
+    return (b"%%%d\r\n" if protocol == 3 else b"*%d\r\n") % (len(fields) * (1 if protocol == 3 else 2)) + items
+
+
+def _integer(value: int) -> bytes:
+    return b":%d\r\n" % value
+
+
+async def _read_command(reader: asyncio.StreamReader) -> Optional[List[bytes]]:
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        return line.strip().split() # Comando en línea (p. ej. desde telnet)
+    args = []
+    for _ in range(int(line[1:])):
+        header = await reader.readline()
+        length = int(header[1:])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+class KVServer:
+    def __init__(self, kv: Optional[LocalKV] = None):
+        self.kv = kv or LocalKV()
+
+    async def _execute(self, name: str, args: List[bytes], resp3: bool = False) -> bytes:
+        kv = self.kv
+        if name == "PING":
+            return b"+PONG\r\n"
+        if name in ("CLIENT", "SELECT"):
+            return b"+OK\r\n"
+        if name == "GET":
+            return _bulk(await kv.get(args[0].decode()), resp3)
+        if name == "SET":
+            px = None
+            options = [arg.upper() for arg in args[2:]]
+            if b"PX" in options:
+                px = int(args[2 + options.index(b"PX") + 1])
+            elif b"EX" in options:
+                px = int(args[2 + options.index(b"EX") + 1]) * 1000
+            await kv.set(args[0].decode(), args[1], px=px)
+            return b"+OK\r\n"
+        if name == "DEL":
+            return _integer(await kv.delete(*(arg.decode() for arg in args)))
+        if name in ("INCR", "INCRBY"):
+            amount = int(args[1]) if name == "INCRBY" else 1
+            try:
+                return _integer(await kv.incrby(args[0].decode(), amount))
+            except ValueError:
+                raise RespError("ERR value is not an integer or out of range")
+        if name == "PEXPIRE":
+            return _integer(int(await kv.pexpire(args[0].decode(), int(args[1]))))
+        if name == "PTTL":
+            return _integer(await kv.pttl(args[0].decode()))
+        if name == "PUBLISH":
+            return _integer(await kv.publish(args[0].decode(), args[1]))
+        raise RespError(f"ERR unknown command '{name}'")
+
+    # Una conexión en modo suscripción solo recibe mensajes (y SUBSCRIBE/UNSUBSCRIBE/PING)
+    async def _subscription(self, reader, writer, channels: List[bytes], resp3: bool = False):
+        forwarders = {}
+
+        async def forward(channel: bytes):
+            async for message in self.kv.subscribe(channel.decode()):
+                writer.write(_array([_bulk(b"message"), _bulk(channel), _bulk(message)], push=resp3))
+                await writer.drain()
+
+        async def subscribe(channel: bytes):
+            if channel not in forwarders:
+                forwarders[channel] = asyncio.create_task(forward(channel))
+                await asyncio.sleep(0) # La suscripción queda activa antes de confirmarla
+            writer.write(_array([_bulk(b"subscribe"), _bulk(channel), _integer(len(forwarders))], push=resp3))
+
+        try:
+            for channel in channels:
+                await subscribe(channel)
+            await writer.drain()
+            while forwarders:
+                command = await _read_command(reader)
+                if command is None:
+                    return
+                name, args = command[0].decode().upper(), command[1:]
+                if name == "SUBSCRIBE":
+                    for channel in args:
+                        await subscribe(channel)
+                elif name == "UNSUBSCRIBE":
+                    for channel in args or list(forwarders):
+                        task = forwarders.pop(channel, None)
+                        if task is not None:
+                            task.cancel()
+                        writer.write(
+                            _array([_bulk(b"unsubscribe"), _bulk(channel), _integer(len(forwarders))], push=resp3)
+                        )
+                elif name == "PING":
+                    # En RESP3 la conexión suscrita sigue aceptando respuestas normales
+                    writer.write(b"+PONG\r\n" if resp3 else _array([_bulk(b"pong"), _bulk(b"")]))
+                else:
+                    writer.write(b"-ERR only (UN)SUBSCRIBE / PING allowed in this context\r\n")
+                await writer.drain()
+        finally:
+            for task in forwarders.values():
+                task.cancel()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        protocol = 2 # Cada conexión empieza en RESP2 hasta que pide otro con HELLO
+        try:
+            while True:
+                command = await _read_command(reader)
+                if command is None:
+                    break
+                if not command:
+                    continue
+                name, args = command[0].decode().upper(), command[1:]
+                if name == "SUBSCRIBE":
+                    await self._subscription(reader, writer, args, resp3=protocol == 3)
+                    continue
+                if name == "HELLO":
+                    requested = int(args[0]) if args and args[0].isdigit() else protocol
+                    if requested in (2, 3):
+                        protocol = requested
+                        writer.write(_hello(protocol))
+                    else:
+                        writer.write(b"-NOPROTO unsupported protocol version\r\n")
+                    await writer.drain()
+                    continue
+                try:
+                    writer.write(await self._execute(name, args, resp3=protocol == 3))
+                except (RespError, IndexError, ValueError) as e:
+                    message = str(e) if isinstance(e, RespError) else "ERR syntax error"
+                    writer.write(f"-{message}\r\n".encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int):
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"kv_server escuchando en redis://{host}:{port}/0")
+        async with server:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sustituto local de Redis para el estado compartido")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    asyncio.run(KVServer().serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
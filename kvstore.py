@@ -0,0 +1,319 @@
+# Estado compartido entre workers y nodos: un subconjunto de la API de redis.asyncio
+# (GET/SET con PX, DEL, INCRBY atómico, PEXPIRE, PTTL, PUBLISH) más subscribe(), con tres backends:
+# - "local://": en memoria del proceso (un solo worker, o pruebas)
+# - "shm://nombre" o "shm:///ruta/fichero.db": SQLite en memoria compartida (/dev/shm), para
+#   varios workers de uvicorn en la misma máquina
+# - "redis://..." / "rediss://...": un servidor Redis (requiere el paquete redis); para probar sin
+#   Redis se puede usar el sustituto local de kv_server.py
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# URL del almacén compartido por defecto (cachés, límites de login, invalidaciones).
+# Vacía = sin almacén compartido: cada proceso mantiene su propio estado.
+SHARED_STATE_URL = os.getenv("SHARED_STATE_URL") or os.getenv("REDIS_URL")
+# Cada cuánto consulta un suscriptor del backend shm:// si hay mensajes nuevos (segundos)
+SHARED_STATE_POLL_INTERVAL = float(os.getenv("SHARED_STATE_POLL_INTERVAL", 0.1))
+# Segundos que se conservan los mensajes publicados en el backend shm://
+SHARED_STATE_MESSAGE_RETENTION = float(os.getenv("SHARED_STATE_MESSAGE_RETENTION", 60))
+
+
+def _encode(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+# Sustituto en proceso del subconjunto de la API de redis.asyncio que usamos.
+# Permite probar los backends "compartidos" sin levantar un servidor Redis.
+class LocalKV:
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._subscribers: "dict[str, set]" = {} # canal -> colas de los suscriptores
+
+    def _alive(self, key) -> bool:
+        expires_at = self._expires.get(key)
+        if expires_at is not None and time.time() >= expires_at:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self._data.get(key) if self._alive(key) else None
+
+    async def set(self, key: str, value, px: Optional[int] = None):
+        self._data[key] = _encode(value)
+        if px is not None:
+            self._expires[key] = time.time() + px / 1000
+        else:
+            self._expires.pop(key, None)
+        return True
+
+    async def delete(self, *keys: str) -> int:
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                removed += 1
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return removed
+
+    async def incrby(self, key: str, amount: int = 1) -> int:
+        value = int(self._data[key]) + amount if self._alive(key) else amount
+        self._data[key] = str(value).encode()
+        return value
+
+    async def pexpire(self, key: str, ms: int) -> bool:
+        if not self._alive(key):
+            return False
+        self._expires[key] = time.time() + ms / 1000
+        return True
+
+    async def pttl(self, key: str) -> int:
+        if not self._alive(key):
+            return -2
+        expires_at = self._expires.get(key)
+        if expires_at is None:
+            return -1
+        return int((expires_at - time.time()) * 1000)
+
+    async def publish(self, channel: str, message) -> int:
+        queues = self._subscribers.get(channel, ())
+        for queue in queues:
+            queue.put_nowait(_encode(message))
+        return len(queues)
+
+    async def subscribe(self, channel: str) -> AsyncIterator[bytes]:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers.setdefault(channel, set()).add(queue)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self._subscribers[channel].discard(queue)
+
+    async def aclose(self):
+        pass
+
+
+# Backend para varios workers en una misma máquina: una base SQLite en memoria compartida
+# (/dev/shm si existe). Cada operación es una transacción corta, así que INCRBY es atómico entre
+# procesos. Todas las llamadas de un proceso se ejecutan en un único hilo propio, que es el
+# dueño de la conexión, para no bloquear el event loop si otro proceso tiene el lock.
+# La mensajería se implementa con una tabla de mensajes que los suscriptores consultan cada
+# SHARED_STATE_POLL_INTERVAL segundos.
+class SharedMemoryKV:
+    def __init__(self, path: str, poll_interval: float = SHARED_STATE_POLL_INTERVAL):
+        self.path = path
+        self.poll_interval = poll_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shm-kv")
+        self._conn: Optional[sqlite3.Connection] = None
+        self._writes = 0
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=OFF") # Vive en memoria: no hay nada que proteger frente a un apagado
+            conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT NOT NULL, payload BLOB NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn = conn
+        return self._conn
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    # Transacción de escritura (BEGIN IMMEDIATE toma el lock de escritura desde el principio)
+    def _write(self, func, *args):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn, time.time(), *args)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            now = time.time()
+            conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+            conn.execute("DELETE FROM messages WHERE created_at < ?", (now - SHARED_STATE_MESSAGE_RETENTION,))
+        return result
+
+    @staticmethod
+    def _live_row(conn, now: float, key: str):
+        return conn.execute(
+            "SELECT value, expires_at FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, now),
+        ).fetchone()
+
+    def _get(self, key: str) -> Optional[bytes]:
+        row = self._live_row(self._connection(), time.time(), key)
+        return row[0] if row else None
+
+    @staticmethod
+    def _set(conn, now, key, value, px):
+        expires_at = now + px / 1000 if px is not None else None
+        conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)", (key, value, expires_at))
+        return True
+
+    def _delete(self, conn, now, keys) -> int:
+        removed = 0
+        for key in keys:
+            removed += 1 if self._live_row(conn, now, key) else 0
+            conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+        return removed
+
+    def _incrby(self, conn, now, key, amount) -> int:
+        row = self._live_row(conn, now, key)
+        value = int(row[0]) + amount if row else amount
+        if row:
+            conn.execute("UPDATE kv SET value = ? WHERE key = ?", (str(value).encode(), key))
+        else:
+            conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, NULL)", (key, str(value).encode()))
+        return value
+
+    def _pexpire(self, conn, now, key, ms) -> bool:
+        if not self._live_row(conn, now, key):
+            return False
+        conn.execute("UPDATE kv SET expires_at = ? WHERE key = ?", (now + ms / 1000, key))
+        return True
+
+    def _pttl(self, key: str) -> int:
+        row = self._live_row(self._connection(), time.time(), key)
+        if row is None:
+            return -2
+        if row[1] is None:
+            return -1
+        return int((row[1] - time.time()) * 1000)
+
+    @staticmethod
+    def _publish(conn, now, channel, message) -> int:
+        conn.execute("INSERT INTO messages (channel, payload, created_at) VALUES (?, ?, ?)", (channel, message, now))
+        return 1
+
+    def _messages_after(self, channel: str, last_id: Optional[int]):
+        conn = self._connection()
+        if last_id is None:
+            return conn.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()[0], []
+        rows = conn.execute(
+            "SELECT id, payload FROM messages WHERE channel = ? AND id > ? ORDER BY id", (channel, last_id)
+        ).fetchall()
+        return (rows[-1][0] if rows else last_id), [payload for _, payload in rows]
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self._call(self._get, key)
+
+    async def set(self, key: str, value, px: Optional[int] = None):
+        return await self._call(self._write, self._set, key, _encode(value), px)
+
+    async def delete(self, *keys: str) -> int:
+        return await self._call(self._write, self._delete, keys)
+
+    async def incrby(self, key: str, amount: int = 1) -> int:
+        return await self._call(self._write, self._incrby, key, amount)
+
+    async def pexpire(self, key: str, ms: int) -> bool:
+        return await self._call(self._write, self._pexpire, key, ms)
+
+    async def pttl(self, key: str) -> int:
+        return await self._call(self._pttl, key)
+
+    async def publish(self, channel: str, message) -> int:
+        return await self._call(self._write, self._publish, channel, _encode(message))
+
+    # Solo recibe los mensajes publicados después de suscribirse (como Redis)
+    async def subscribe(self, channel: str) -> AsyncIterator[bytes]:
+        last_id, _ = await self._call(self._messages_after, channel, None)
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            last_id, payloads = await self._call(self._messages_after, channel, last_id)
+            for payload in payloads:
+                yield payload
+
+    async def aclose(self):
+        if self._conn is not None:
+            await self._call(self._conn.close)
+            self._conn = None
+        self._executor.shutdown(wait=False)
+
+
+# Adaptador de un cliente de redis.asyncio: añade subscribe() con la misma interfaz que los
+# demás backends y delega el resto de operaciones en el cliente.
+class RedisKV:
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    async def subscribe(self, channel: str) -> AsyncIterator[bytes]:
+        pubsub = self.client.pubsub()
+        await pubsub.subscribe(channel)
+        try:
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    yield message["data"]
+        finally:
+            await pubsub.unsubscribe(channel)
+            await pubsub.aclose()
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+def _shm_path(url: str) -> str:
+    location = url[len("shm://"):]
+    if location.startswith("/"):
+        return location
+    directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return os.path.join(directory, f"{location or 'python-auth-app'}.kv.db")
+
+
+def _open_kv(url: str):
+    if url.startswith("local://"):
+        return LocalKV()
+    if url.startswith("shm://"):
+        return SharedMemoryKV(_shm_path(url))
+    try:
+        import redis.asyncio as redis_asyncio
+    except ImportError as e:
+        raise RuntimeError(
+            "Se configuró un almacén Redis pero el paquete 'redis' no está instalado."
+        ) from e
+    return RedisKV(redis_asyncio.from_url(url))
+
+
+# Clientes abiertos por URL: los componentes que usan el mismo almacén comparten conexión
+_clients: "dict[str, object]" = {}
+
+
+# Devuelve el cliente para `url`, o None si no hay almacén compartido configurado.
+# El paquete `redis` solo es necesario cuando se usa un servidor Redis real.
+def connect_kv(url: Optional[str] = SHARED_STATE_URL):
+    if not url:
+        return None
+    client = _clients.get(url)
+    if client is None:
+        client = _clients[url] = _open_kv(url)
+    return client
+
+
+# Cierra todos los clientes abiertos (al apagar la aplicación)
+async def close_all():
+    clients = list(_clients.values())
+    _clients.clear()
+    for client in clients:
+        await client.aclose()
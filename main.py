@@ -1,22 +1,82 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+import asyncio
+import functools
+import hmac
+import os
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Body, Depends, HTTPException, Query, Request, status
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
 from sqlalchemy.ext.asyncio import AsyncSession
-from jose import JWTError
-from datetime import timedelta
-from typing import List
+from datetime import date, datetime, timedelta, timezone
+from typing import Annotated, AsyncIterator, List, Optional
 
-import schemas, crud, models, belvo_api 
-from database import engine, Base, get_db
+import schemas, crud, models, belvo_api, migrations
+from database import engine, AsyncSessionLocal, get_db, get_read_db, pool_stats, read_session, warm_pool
+import kvstore
+from hashing import password_hasher
+from invalidation import invalidation_bus
+from metrics import MetricsMiddleware, registry
+from migrations import DB_MIGRATE_ON_STARTUP
+from principals import principal_cache
+from rate_limit import client_ip, login_rate_limiter
+from revocation import revocation_index
+from serialization import FastJSONResponse, dumps, etag_matches, make_etag, make_weak_etag, render_cache
+from sync import BELVO_SYNC_ENABLED, sync_engine
 from auth import (
     create_access_token,
-    verify_password,
-    decode_access_token,
+    decode_access_token_claims,
+    build_user_claims,
     ACCESS_TOKEN_EXPIRE_MINUTES,
+    JWT_EMBED_CLAIMS,
+    token_cache,
 )
 
+# Usuarios con acceso a las rutas /admin (separados por comas)
+ADMIN_USERNAMES = {name.strip() for name in os.getenv("ADMIN_USERNAMES", "").split(",") if name.strip()}
+# Segundos que un cliente puede reutilizar una respuesta de Belvo sin preguntar. Con 0 (por
+# defecto) la guarda pero la revalida siempre con If-None-Match, y recibe 304 sin cuerpo si no cambió.
+BELVO_HTTP_MAX_AGE = int(os.getenv("BELVO_HTTP_MAX_AGE", 0))
+BELVO_CACHE_CONTROL = f"private, max-age={BELVO_HTTP_MAX_AGE}" if BELVO_HTTP_MAX_AGE > 0 else "private, no-cache"
+# Token del scraper de Prometheus para /metrics ("Authorization: Bearer <METRICS_TOKEN>").
+# Sin él, /metrics solo es accesible para administradores.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Ciclo de vida de la aplicación. El esquema se gestiona fuera de los workers
+# (`python manage.py migrate`, ver migrations.py): al arrancar solo se comprueba su versión con
+# una consulta, se calientan el pool de conexiones, el cliente de Belvo y las cachés, y se
+# lanzan las tareas en segundo plano.
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if DB_MIGRATE_ON_STARTUP:
+        await migrations.migrate(engine)
+    else:
+        await migrations.check_schema(engine)
+    await warm_pool()
+    # Abre el cliente HTTP compartido (pool de conexiones keep-alive) hacia Belvo
+    await belvo_api.belvo_client.start()
+    # Carga la lista de revocación y la mantiene sincronizada con la DB en segundo plano
+    revocation_sync = asyncio.create_task(revocation_index.run_sync_loop(AsyncSessionLocal))
+    # Invalidaciones publicadas por los demás workers/nodos (ver invalidation.py)
+    invalidation_listener = asyncio.create_task(invalidation_bus.run())
+    # Copia periódica de los datos de Belvo de los links registrados a la DB local
+    belvo_sync = asyncio.create_task(sync_engine.run()) if BELVO_SYNC_ENABLED else None
+    # Precarga de la caché de Belvo sin retrasar el arranque
+    cache_warmup = asyncio.create_task(belvo_api.warm_cache()) if belvo_api.BELVO_WARM_CACHE else None
+    try:
+        yield
+    finally:
+        # Detiene las tareas en segundo plano y libera los pools al apagar la aplicación
+        for task in (revocation_sync, invalidation_listener, belvo_sync, cache_warmup):
+            if task is not None:
+                task.cancel()
+        password_hasher.shutdown()
+        await belvo_api.belvo_client.aclose()
+        await kvstore.close_all()
+
+
 # Inicializa la aplicación FastAPI
-app = FastAPI(title="API de Autenticación de Usuarios")
+app = FastAPI(title="API de Autenticación de Usuarios", lifespan=lifespan)
 
 # Configuración de CORS
 origins = [
@@ -35,17 +95,15 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Latencia por ruta, peticiones en curso y perfilado bajo demanda (ver metrics.py).
+# Se añade la última para ser la capa más externa y medir también CORS.
+app.add_middleware(MetricsMiddleware)
+
 # Esquema de seguridad para OAuth2 con el flujo de contraseña
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-
-# Función para crear las tablas en la base de datos al iniciar la aplicación
-@app.on_event("startup")
-async def on_startup():
-    async with engine.begin() as conn:
-        # Crea todas las tablas definidas en Base (nuestro models.py)
-        await conn.run_sync(Base.metadata.create_all)
-    print("Tablas de la base de datos creadas/actualizadas.")
+# Documentación de las rutas que responden en streaming como array JSON o NDJSON (?format=)
+_STREAM_RESPONSES = {200: {"content": {"application/json": {}, "application/x-ndjson": {}}}}
 
 
 # --- RUTAS DE AUTENTICACIÓN ---
@@ -56,19 +114,15 @@ async def on_startup():
     "/signup", response_model=schemas.UserResponse, summary="Registrar un nuevo usuario"
 )
 async def signup(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
-    db_user_by_username = await crud.get_user_by_username(db, username=user.username)
-    if db_user_by_username:
-        raise HTTPException(
-            status_code=400, detail="El nombre de usuario ya está registrado."
-        )
-
-    db_user_by_email = await crud.get_user_by_email(db, email=user.email)
-    if db_user_by_email:
-        raise HTTPException(
-            status_code=400, detail="El correo electrónico ya está registrado."
-        )
-
-    return await crud.create_user(db=db, user=user)
+    # Un único INSERT: los índices únicos detectan los duplicados
+    try:
+        return await crud.create_user(db=db, user=user)
+    except crud.DuplicateUserError as e:
+        if e.field == "email":
+            detail = "El correo electrónico ya está registrado."
+        else: # "username"
+            detail = "El nombre de usuario ya está registrado."
+        raise HTTPException(status_code=400, detail=detail)
 
 
 # Ruta para iniciar sesión y obtener un token (Sign In)
@@ -76,38 +130,127 @@ async def signup(user: schemas.UserCreate, db: AsyncSession = Depends(get_db)):
     "/token", response_model=schemas.Token, summary="Iniciar sesión y obtener token JWT"
 )
 async def login_for_access_token(
-    form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)
+    request: Request,
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    # Todo en el primario: con una réplica retrasada podría iniciar sesión un usuario recién
+    # desactivado (y con claims embebidos su token no se volvería a comprobar) o uno recién
+    # eliminado (el refresh token violaría la clave foránea)
+    db: AsyncSession = Depends(get_db),
 ):
+    # Rechazo rápido (429) por IP, por usuario o por bloqueo progresivo, antes de la DB y bcrypt
+    await login_rate_limiter.check(client_ip(request), form_data.username)
     user = await crud.get_user_by_username(db, username=form_data.username)
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    # bcrypt se ejecuta en el pool de hashing para no bloquear el event loop
+    if not user or not await password_hasher.verify(form_data.password, user.hashed_password):
+        await login_rate_limiter.record_failure(form_data.username)
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Wrong username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    # Solo tras verificar la contraseña, para no revelar a terceros qué cuentas están desactivadas
+    if user.disabled_at is not None:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Account disabled")
+    await login_rate_limiter.record_success(form_data.username)
+    if password_hasher.needs_update(user.hashed_password):
+        # Hash con un esquema o coste antiguo: se rehashea después de responder
+        password_hasher.rehash_in_background(
+            form_data.password, functools.partial(_save_password_hash, user.id, user.hashed_password)
+        )
+    # Copia desacoplada de la sesión: el commit de issue_refresh_token expira los objetos ORM
+    principal = schemas.Principal.model_validate(user)
+    refresh_token, session_id = await crud.issue_refresh_token(db, user.id)
+    return _issue_tokens(principal, refresh_token, session_id)
+
+
+# Guarda un hash rehasheado tras el login, con su propia sesión (la de la petición ya se cerró)
+async def _save_password_hash(user_id: int, old_hash: str, new_hash: str):
+    async with AsyncSessionLocal() as db:
+        await crud.update_password_hash(db, user_id, old_hash, new_hash)
+
+
+# Construye la respuesta con un access token de vida corta ligado a la sesión (claim "sid")
+def _issue_tokens(user, refresh_token: str, session_id: str) -> dict:
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data={**build_user_claims(user), "sid": session_id}, expires_delta=access_token_expires
     )
-    return {"access_token": access_token, "token_type": "bearer"}
+    return {
+        "access_token": access_token,
+        "token_type": "bearer",
+        "refresh_token": refresh_token,
+        "expires_in": int(access_token_expires.total_seconds()),
+    }
+
 
+# Ruta para renovar el access token. El refresh token se rota en cada uso; reutilizar uno
+# ya rotado revoca toda la sesión.
+@app.post(
+    "/token/refresh", response_model=schemas.Token, summary="Renovar el token de acceso"
+)
+async def refresh_access_token(body: schemas.RefreshRequest, db: AsyncSession = Depends(get_db)):
+    try:
+        user, refresh_token, session_id = await crud.rotate_refresh_token(db, body.refresh_token)
+    except crud.InvalidRefreshTokenError:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Invalid refresh token",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
+    return _issue_tokens(user, refresh_token, session_id)
 
-# Dependencia para obtener el usuario actual a partir del token JWT
+
+# Dependencia para obtener el usuario actual a partir del token JWT.
+# Orden de resolución: claims embebidos en el token (sin DB) -> caché de principals -> DB.
+# En la DB se consulta el primario (la sesión solo abre conexión si hay fallo de caché): una
+# réplica retrasada devolvería el token_version anterior a una desactivación o un cambio de
+# contraseña, y ese principal obsoleto volvería a la caché durante PRINCIPAL_CACHE_TTL.
 async def get_current_user(
     token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)
-):
+) -> schemas.Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    username = decode_access_token(token)
-    if username is None:
+    claims = decode_access_token_claims(token)
+    # Los tokens emitidos antes de la revocación (sin "uid" ni "jti") escaparían a la lista de
+    # revocación y a la invalidación de usuarios: se rechazan (los de vida corta ya caducaron)
+    if claims is None or claims.get("uid") is None or claims.get("jti") is None:
         raise credentials_exception
-    user = await crud.get_user_by_username(db, username=username)
-    if user is None:
+    # Lista de revocación: búsqueda en memoria, sin consultar la DB
+    if revocation_index.is_revoked(claims["jti"]):
+        raise credentials_exception
+    user_id = claims["uid"]
+    token_version = claims.get("ver", 0)
+
+    if principal_cache.is_invalidated(user_id, claims.get("iat")):
+        raise credentials_exception
+    if JWT_EMBED_CLAIMS and "email" in claims:
+        # Los claims están firmados por nosotros: no hace falta revalidarlos
+        return schemas.Principal.model_construct(
+            id=user_id, username=claims["sub"], email=claims["email"], token_version=token_version
+        )
+
+    principal = principal_cache.get(user_id, token_version)
+    if principal is not None:
+        return principal
+    user = await crud.get_user_by_id(db, user_id=user_id)
+    if user is None or (user.token_version or 0) != token_version:
         raise credentials_exception
-    return user
+    principal = schemas.Principal.model_validate(user)
+    principal_cache.put(principal)
+    return principal
+
+
+# Dependencia para rutas de administración: el usuario debe estar en ADMIN_USERNAMES
+async def get_current_admin(current_user: schemas.Principal = Depends(get_current_user)) -> schemas.Principal:
+    if current_user.username not in ADMIN_USERNAMES:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Se requieren permisos de administrador.",
+        )
+    return current_user
 
 
 # Ruta de ejemplo para verificar el usuario autenticado (requiere token)
@@ -116,22 +259,193 @@ async def get_current_user(
     response_model=schemas.UserResponse,
     summary="Obtener información del usuario actual",
 )
-async def read_users_me(current_user: models.User = Depends(get_current_user)):
+async def read_users_me(current_user: schemas.Principal = Depends(get_current_user)):
     return current_user
 
 
-# Ruta para cerrar sesión (Sign Out) - en una API stateless, "cerrar sesión"
-# es simplemente dejar de usar el token. No hay una "sesión" activa en el servidor.
-# Esta ruta es más para informar al cliente que el token ya no debe usarse.
-@app.post("/signout", summary="Cerrar sesión (Invalidar token JWT en el cliente)")
-async def signout(current_user: models.User = Depends(get_current_user)):
-    return {"message": "Session closed. Please discard the token."}
+# Ruta para cerrar sesión (Sign Out): revoca el token de acceso actual y los refresh
+# tokens de su sesión, de modo que ninguno de los dos vuelve a ser aceptado.
+@app.post("/signout", summary="Cerrar sesión (Revocar el token JWT y su sesión)")
+async def signout(
+    token: str = Depends(oauth2_scheme),
+    current_user: schemas.Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    claims = decode_access_token_claims(token)
+    await crud.revoke_access_token(db, claims["jti"], claims["exp"])
+    if claims.get("sid") is not None:
+        await crud.revoke_refresh_family(db, claims["sid"])
+    return {"message": "Sesión cerrada. El token ha sido revocado."}
+
+# --- RUTAS DE ADMINISTRACIÓN ---
+
+# Importación masiva de usuarios (onboarding). Los duplicados se omiten.
+# Como mucho 10000 usuarios por petición; las importaciones mayores, con `manage.py import-users`.
+@app.post(
+    "/admin/users/import",
+    response_model=schemas.BulkImportResult,
+    summary="Importar usuarios en lote",
+)
+async def import_users(
+    users: Annotated[List[schemas.UserCreate], Body(min_length=1, max_length=10000)],
+    db: AsyncSession = Depends(get_db),
+    admin: schemas.Principal = Depends(get_current_admin),
+):
+    inserted = await crud.bulk_create_users(db, users)
+    return {"received": len(users), "inserted": inserted, "skipped": len(users) - inserted}
+
+
+_USER_ORDER_QUERY = Query("id", pattern="^(id|username|email)$", description="Columna de orden")
+_USER_PREFIX_QUERY = Query(
+    None, min_length=1, max_length=100, description="Prefijo de la columna de orden (username o email)"
+)
+
+def _check_user_prefix(order_by: str, prefix: Optional[str]):
+    if prefix is not None and order_by == "id":
+        raise HTTPException(status_code=400, detail="La búsqueda por prefijo requiere order_by=username o email.")
+
+# Listado de usuarios con paginación por clave: `next_cursor` de la respuesta se pasa como
+# `cursor` para obtener la página siguiente. Cada página cuesta lo mismo sin importar su posición.
+@app.get("/admin/users", response_model=schemas.UserPage, summary="Listar usuarios (paginación por cursor)")
+async def list_users(
+    limit: int = Query(100, ge=1, le=1000),
+    cursor: Optional[str] = Query(None, description="next_cursor de la página anterior"),
+    order_by: str = _USER_ORDER_QUERY,
+    prefix: Optional[str] = _USER_PREFIX_QUERY,
+    include_disabled: bool = True,
+    db: AsyncSession = Depends(get_read_db),
+    admin: schemas.Principal = Depends(get_current_admin),
+):
+    _check_user_prefix(order_by, prefix)
+    try:
+        after = crud.decode_user_cursor(cursor, order_by) if cursor else None
+    except crud.InvalidCursorError:
+        raise HTTPException(status_code=400, detail="Cursor inválido.")
+    users, next_cursor = await crud.list_users(
+        db, order_by=order_by, prefix=prefix, after=after, limit=limit, include_disabled=include_disabled
+    )
+    return FastJSONResponse({"items": users, "next_cursor": next_cursor})
+
+
+# Exportación completa en streaming (array JSON o NDJSON), leída por páginas de la réplica
+@app.get(
+    "/admin/users/export",
+    summary="Exportar usuarios en streaming",
+    responses=_STREAM_RESPONSES,
+)
+async def export_users(
+    format: str = Query("ndjson", pattern="^(json|ndjson)$", description="Array JSON o NDJSON"),
+    order_by: str = _USER_ORDER_QUERY,
+    prefix: Optional[str] = _USER_PREFIX_QUERY,
+    include_disabled: bool = True,
+    page_size: int = Query(1000, ge=1, le=10000, description="Usuarios leídos de la DB por consulta"),
+    admin: schemas.Principal = Depends(get_current_admin),
+):
+    _check_user_prefix(order_by, prefix)
+    users = crud.iter_users(
+        read_session, order_by=order_by, prefix=prefix, include_disabled=include_disabled, page_size=page_size
+    )
+    first = await anext(users, None)
+    ndjson = format == "ndjson"
+    return StreamingResponse(
+        _json_stream_body(first, users, ndjson),
+        media_type="application/x-ndjson" if ndjson else "application/json",
+    )
+
+
+# Eliminación masiva por id, en lotes (sus links y sesiones se eliminan en cascada)
+@app.post("/admin/users/bulk-delete", response_model=schemas.BulkUserResult, summary="Eliminar usuarios en lote")
+async def bulk_delete_users(
+    body: schemas.BulkUserIds,
+    db: AsyncSession = Depends(get_db),
+    admin: schemas.Principal = Depends(get_current_admin),
+):
+    affected = await crud.bulk_delete_users(db, body.ids)
+    return {"requested": len(body.ids), "affected": affected}
+
+
+# Desactivación masiva por id, en lotes: no pueden iniciar sesión y sus tokens dejan de valer
+@app.post("/admin/users/bulk-disable", response_model=schemas.BulkUserResult, summary="Desactivar usuarios en lote")
+async def bulk_disable_users(
+    body: schemas.BulkUserIds,
+    db: AsyncSession = Depends(get_db),
+    admin: schemas.Principal = Depends(get_current_admin),
+):
+    affected = await crud.bulk_disable_users(db, body.ids)
+    return {"requested": len(body.ids), "affected": affected}
+
+
+# Estado de los componentes con stats(); /metrics los publica como gauges de Prometheus
+registry.add_collector("password_hasher", password_hasher.stats)
+registry.add_collector("belvo_cache", belvo_api.belvo_cache.stats)
+registry.add_collector("belvo_upstream", belvo_api.belvo_client.stats)
+registry.add_collector("render_cache", render_cache.stats)
+registry.add_collector("principal_cache", principal_cache.stats)
+registry.add_collector("token_cache", token_cache.stats)
+registry.add_collector("database", pool_stats)
+registry.add_collector("login_rate_limiter", login_rate_limiter.stats)
+registry.add_collector("revocation_index", revocation_index.stats)
+registry.add_collector("invalidation_bus", invalidation_bus.stats)
+registry.add_collector("belvo_sync", sync_engine.stats)
+
+
+# Dependencia para /metrics: el token del scraper (METRICS_TOKEN) o, sin él, un administrador.
+# Las métricas exponen rutas, volumen de tráfico y estado interno: no son públicas.
+async def authorize_metrics(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> None:
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(token.encode(), METRICS_TOKEN.encode()):
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED,
+                detail="Could not validate credentials",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+        return
+    await get_current_admin(await get_current_user(token, db))
+
+
+# Métricas del servicio en formato de texto de Prometheus (histogramas de latencia y estado
+# de pools y cachés). Con ?format=json devuelve solo el estado de los componentes.
+@app.get(
+    "/metrics",
+    summary="Métricas internas del servicio",
+    response_class=PlainTextResponse,
+    dependencies=[Depends(authorize_metrics)],
+)
+async def get_metrics(format: str = Query("prometheus", pattern="^(prometheus|json)$")):
+    if format == "json":
+        return FastJSONResponse(dumps(registry.collect_stats()))
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 # --- Nuevos Endpoints de Belvo ---
+# Los datos de Belvo llegan ya validados desde belvo_api, así que estas rutas devuelven
+# FastJSONResponse (orjson, bytes reutilizados de render_cache) en lugar de dejar que FastAPI
+# los vuelva a validar; response_model se mantiene para la documentación OpenAPI.
+# Todas las lecturas llevan ETag y Cache-Control: un cliente que sondea con If-None-Match recibe
+# 304 sin cuerpo mientras los datos no cambien.
+
+def _validator_headers(etag: str, headers: Optional[dict] = None) -> dict:
+    return {**(headers or {}), "ETag": etag, "Cache-Control": BELVO_CACHE_CONTROL}
+
+# 304 sin cuerpo si el cliente ya tiene esta versión (If-None-Match); None en otro caso
+def _not_modified(request: Request, etag: str, headers: Optional[dict] = None) -> Optional[Response]:
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=_validator_headers(etag, headers))
+    return None
+
+# Respuesta ya serializada con su ETag, o 304 si el cliente ya la tiene
+def _conditional_json(request: Request, body: bytes, etag: str, headers: Optional[dict] = None) -> Response:
+    return _not_modified(request, etag, headers) or FastJSONResponse(body, headers=_validator_headers(etag, headers))
+
+# Datos de la caché de Belvo: si es el mismo objeto que la última vez, render_cache devuelve
+# los bytes y el ETag ya calculados (sin serializar ni llamar a Belvo)
+def _cached_json(request: Request, key: str, value) -> Response:
+    body, etag = render_cache.render_with_etag(key, value)
+    return _conditional_json(request, body, etag)
 
 @app.get("/belvo/institutions", response_model=List[schemas.Institution], summary="Obtener lista de instituciones bancarias de Belvo")
-async def get_institutions_belvo():
-    return await belvo_api.get_belvo_institutions()
+async def get_institutions_belvo(request: Request, client: belvo_api.BelvoClient = Depends(belvo_api.get_belvo_client)):
+    institutions = await belvo_api.get_belvo_institutions(client)
+    return _cached_json(request, "institutions", institutions)
 
 # El endpoint para generar tokens de link ya no es necesario si todas las llamadas usan Basic Auth
 # @app.post("/belvo/auth-tokens", response_model=schemas.BelvoAuthTokens, summary="Generar tokens de Belvo para el widget de creación de link")
@@ -140,14 +454,272 @@ async def get_institutions_belvo():
 #     link_creation_token = await belvo_api.get_belvo_link_creation_token()
 #     return {"access_token": access_token, "link_creation_token": link_creation_token}
 
-@app.get("/belvo/accounts", response_model=List[schemas.Account], summary="Obtener cuentas bancarias para el link_id predefinido de Belvo")
-async def get_accounts_belvo():
-    return await belvo_api.get_belvo_accounts()
+# Rutas antiguas ligadas al link predefinido (MOCK_LINK_ID). Se mantienen por compatibilidad,
+# ahora con autenticación; usar las rutas /belvo/links/{link_id}/... en su lugar.
+@app.get("/belvo/accounts", response_model=List[schemas.Account], deprecated=True, summary="Obtener cuentas bancarias para el link_id predefinido de Belvo")
+async def get_accounts_belvo(
+    request: Request,
+    current_user: schemas.Principal = Depends(get_current_user),
+    client: belvo_api.BelvoClient = Depends(belvo_api.get_belvo_client),
+):
+    accounts = await belvo_api.get_belvo_accounts(client)
+    return _cached_json(request, f"accounts:{belvo_api.MOCK_LINK_ID}", accounts)
+
+@app.get("/belvo/balances", response_model=List[schemas.Balance], deprecated=True, summary="Obtener balances para el link_id predefinido de Belvo")
+async def get_balances_belvo(
+    request: Request,
+    current_user: schemas.Principal = Depends(get_current_user),
+    client: belvo_api.BelvoClient = Depends(belvo_api.get_belvo_client),
+):
+    balances = await belvo_api.get_belvo_balances(client)
+    return _cached_json(request, f"balances:{belvo_api.MOCK_LINK_ID}", balances)
+
+# Serializa los elementos conforme llegan, como array JSON o NDJSON (las transacciones ya
+# vienen validadas de belvo_api o de la copia local; los usuarios, de crud.iter_users)
+async def _json_stream_body(first: Optional[dict], transactions: AsyncIterator[dict], ndjson: bool):
+    if not ndjson:
+        yield b"["
+    count = 0
+    transaction = first
+    while transaction is not None:
+        data = dumps(transaction)
+        if ndjson:
+            yield data + b"\n"
+        else:
+            yield (b"," if count else b"") + data
+        count += 1
+        transaction = await anext(transactions, None)
+    if not ndjson:
+        yield b"]"
 
-@app.get("/belvo/balances", response_model=List[schemas.Balance], summary="Obtener balances para el link_id predefinido de Belvo")
-async def get_balances_belvo():
-    return await belvo_api.get_belvo_balances()
+# Respuesta en streaming con las transacciones de un link
+async def _stream_transactions(client, link_id: str, page_size, date_from, date_to, limit, format) -> StreamingResponse:
+    transactions = belvo_api.iter_belvo_transactions(
+        client, link_id=link_id, page_size=page_size, date_from=date_from, date_to=date_to, limit=limit
+    )
+    # Se espera a la primera página antes de responder para que los errores de Belvo
+    # lleguen al cliente con su código HTTP y no como un stream cortado.
+    first = await anext(transactions, None)
+    ndjson = format == "ndjson"
+    return StreamingResponse(
+        _json_stream_body(first, transactions, ndjson),
+        media_type="application/x-ndjson" if ndjson else "application/json",
+    )
 
-@app.get("/belvo/transactions", response_model=List[schemas.Transaction], summary="Obtener transacciones para el link_id predefinido de Belvo")
-async def get_transactions_belvo():
-    return await belvo_api.get_belvo_transactions()
+@app.get(
+    "/belvo/transactions",
+    deprecated=True,
+    summary="Obtener transacciones para el link_id predefinido de Belvo",
+    responses=_STREAM_RESPONSES,
+)
+async def get_transactions_belvo(
+    page_size: int = Query(100, ge=1, le=1000, description="Transacciones por página pedida a Belvo"),
+    date_from: Optional[date] = Query(None, description="Fecha valor mínima (incluida)"),
+    date_to: Optional[date] = Query(None, description="Fecha valor máxima (incluida)"),
+    limit: Optional[int] = Query(None, ge=1, description="Número máximo de transacciones"),
+    format: str = Query("json", pattern="^(json|ndjson)$", description="Array JSON o NDJSON"),
+    current_user: schemas.Principal = Depends(get_current_user),
+    client: belvo_api.BelvoClient = Depends(belvo_api.get_belvo_client),
+):
+    return await _stream_transactions(
+        client, belvo_api.MOCK_LINK_ID, page_size, date_from, date_to, limit, format
+    )
+
+# --- Links de Belvo del usuario ---
+
+# Dependencia: el link pedido debe pertenecer al usuario autenticado (404 si no, para no
+# revelar links de otros usuarios). Se consulta el primario: un link recién registrado puede
+# no haber llegado aún a la réplica.
+async def get_owned_link(
+    link_id: str,
+    current_user: schemas.Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+) -> models.BelvoLink:
+    link = await crud.get_user_link(db, current_user.id, link_id)
+    if link is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Link no encontrado")
+    return link
+
+@app.get("/belvo/links", response_model=List[schemas.BelvoLinkResponse], summary="Listar los links de Belvo del usuario")
+async def list_links_belvo(
+    current_user: schemas.Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db),
+):
+    return await crud.get_user_links(db, current_user.id)
+
+@app.post(
+    "/belvo/links",
+    response_model=schemas.BelvoLinkResponse,
+    status_code=status.HTTP_201_CREATED,
+    summary="Registrar un link de Belvo para el usuario",
+)
+async def create_link_belvo(
+    link: schemas.BelvoLinkCreate,
+    current_user: schemas.Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    client: belvo_api.BelvoClient = Depends(belvo_api.get_belvo_client),
+):
+    # La propiedad la decide Belvo, no el cliente: el link debe haberse creado con el
+    # external_id del usuario (si no, cualquiera podría registrar el link_id de otro)
+    belvo_link = await belvo_api.get_belvo_link(client, link.link_id)
+    if not belvo_api.link_belongs_to(belvo_link, current_user.id):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="El link no pertenece al usuario")
+    if link.institution is None and belvo_link.get("institution"):
+        link = link.model_copy(update={"institution": belvo_link["institution"]})
+    try:
+        return await crud.create_user_link(db, current_user.id, link)
+    except crud.DuplicateLinkError:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="El link ya está registrado")
+
+@app.delete("/belvo/links/{link_id}", status_code=status.HTTP_204_NO_CONTENT, summary="Eliminar un link de Belvo del usuario")
+async def delete_link_belvo(
+    link_id: str,
+    current_user: schemas.Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+):
+    if not await crud.delete_user_link(db, current_user.id, link_id):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Link no encontrado")
+
+# Consulta en lote: resume muchos links del usuario con concurrencia acotada.
+# Los links que no son del usuario se rechazan antes de llamar a Belvo (consultando el primario,
+# como get_owned_link).
+@app.post(
+    "/belvo/links/batch",
+    response_model=List[schemas.LinkSummary],
+    summary="Obtener cuentas/balances/transacciones de varios links a la vez",
+)
+async def batch_links_belvo(
+    body: schemas.LinkBatchRequest,
+    current_user: schemas.Principal = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    client: belvo_api.BelvoClient = Depends(belvo_api.get_belvo_client),
+):
+    owned = await crud.get_owned_link_ids(db, current_user.id, body.link_ids)
+    missing = [link_id for link_id in body.link_ids if link_id not in owned]
+    if missing:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail={"links_not_found": missing})
+    summaries = await belvo_api.fetch_links_batch(
+        client, body.link_ids, resources=body.resources, transactions_limit=body.transactions_limit
+    )
+    return FastJSONResponse(summaries)
+
+# --- Lecturas desde la copia local (ver sync.py) ---
+
+# Cabeceras de frescura: cuándo se sincronizó el link por última vez y hace cuántos segundos
+def _freshness_headers(state: models.BelvoSyncState) -> dict:
+    age = (datetime.now(timezone.utc).replace(tzinfo=None) - state.last_synced_at).total_seconds()
+    headers = {
+        "X-Belvo-Synced-At": state.last_synced_at.isoformat(timespec="seconds") + "Z",
+        "X-Belvo-Data-Age": str(max(0, int(age))),
+    }
+    if state.last_error:
+        headers["X-Belvo-Sync-Error"] = "1"
+    return headers
+
+# Asegura que haya copia local del link antes de leerla. Si nunca se sincronizó, o si se pide
+# refresh=true, se sincroniza ahora (las peticiones simultáneas comparten la sincronización).
+# Si Belvo falla pero ya hay copia, se sirve la copia con sus cabeceras de antigüedad.
+# Devuelve el estado y la fábrica de sesiones a usar: tras sincronizar se lee del primario,
+# ya que la réplica puede no tener aún lo recién escrito.
+async def _ensure_mirror(link_id: str, refresh: bool, db: AsyncSession):
+    state = await crud.get_sync_state(db, link_id)
+    if not refresh and state is not None and state.last_synced_at is not None:
+        return state, read_session
+    try:
+        state = await sync_engine.sync_link(link_id)
+    except HTTPException:
+        if state is None or state.last_synced_at is None:
+            raise
+        state.last_error = state.last_error or "refresh failed"
+    return state, AsyncSessionLocal
+
+_REFRESH_QUERY = Query(False, description="Sincronizar con Belvo antes de responder")
+
+# ETag de los datos de la copia local: cambia con cada bloque de filas guardado (data_version) y
+# con cada sincronización completa, así que se puede comprobar If-None-Match con el estado de
+# sincronización, antes de leer los datos
+def _mirror_etag(resource: str, state: models.BelvoSyncState, *params) -> str:
+    return make_weak_etag(resource, state.link_id, state.data_version, state.last_synced_at, *params)
+
+# Cuentas o balances de la copia local con sus cabeceras de frescura (o 304)
+async def _mirrored_response(request: Request, model, link_id: str, refresh: bool, db: AsyncSession) -> Response:
+    state, session_factory = await _ensure_mirror(link_id, refresh, db)
+    headers = _freshness_headers(state)
+    etag = _mirror_etag(model.__tablename__, state)
+    not_modified = _not_modified(request, etag, headers)
+    if not_modified is not None:
+        return not_modified
+    async with session_factory() as read_db:
+        data = await crud.get_mirrored_data(read_db, model, link_id)
+    return FastJSONResponse(data, headers=_validator_headers(etag, headers))
+
+@app.get("/belvo/links/{link_id}/accounts", response_model=List[schemas.Account], summary="Obtener las cuentas de un link")
+async def get_link_accounts_belvo(
+    request: Request,
+    refresh: bool = _REFRESH_QUERY,
+    link: models.BelvoLink = Depends(get_owned_link),
+    db: AsyncSession = Depends(get_read_db),
+):
+    return await _mirrored_response(request, models.BelvoAccount, link.link_id, refresh, db)
+
+@app.get("/belvo/links/{link_id}/balances", response_model=List[schemas.Balance], summary="Obtener los balances de un link")
+async def get_link_balances_belvo(
+    request: Request,
+    refresh: bool = _REFRESH_QUERY,
+    link: models.BelvoLink = Depends(get_owned_link),
+    db: AsyncSession = Depends(get_read_db),
+):
+    return await _mirrored_response(request, models.BelvoBalance, link.link_id, refresh, db)
+
+@app.get(
+    "/belvo/links/{link_id}/transactions",
+    summary="Obtener las transacciones de un link (de la más reciente a la más antigua)",
+    responses=_STREAM_RESPONSES,
+)
+async def get_link_transactions_belvo(
+    request: Request,
+    page_size: int = Query(500, ge=1, le=5000, description="Transacciones leídas de la DB por consulta"),
+    date_from: Optional[date] = Query(None, description="Fecha valor mínima (incluida)"),
+    date_to: Optional[date] = Query(None, description="Fecha valor máxima (incluida)"),
+    limit: Optional[int] = Query(None, ge=1, description="Número máximo de transacciones"),
+    format: str = Query("json", pattern="^(json|ndjson)$", description="Array JSON o NDJSON"),
+    refresh: bool = _REFRESH_QUERY,
+    link: models.BelvoLink = Depends(get_owned_link),
+    db: AsyncSession = Depends(get_read_db),
+):
+    state, session_factory = await _ensure_mirror(link.link_id, refresh, db)
+    headers = _freshness_headers(state)
+    etag = _mirror_etag("transactions", state, date_from, date_to, limit, format)
+    not_modified = _not_modified(request, etag, headers)
+    if not_modified is not None:
+        return not_modified
+    transactions = crud.iter_mirrored_transactions(
+        session_factory, link.link_id, date_from=date_from, date_to=date_to, limit=limit, page_size=page_size
+    )
+    first = await anext(transactions, None)
+    ndjson = format == "ndjson"
+    return StreamingResponse(
+        _json_stream_body(first, transactions, ndjson),
+        media_type="application/x-ndjson" if ndjson else "application/json",
+        headers=_validator_headers(etag, headers),
+    )
+
+@app.get(
+    "/belvo/links/{link_id}/summary",
+    response_model=schemas.LinkSummary,
+    summary="Obtener cuentas, balances y transacciones de un link en una sola llamada",
+)
+async def get_link_summary_belvo(
+    request: Request,
+    transactions_limit: int = Query(100, ge=1, le=1000, description="Número máximo de transacciones"),
+    link: models.BelvoLink = Depends(get_owned_link),
+    client: belvo_api.BelvoClient = Depends(belvo_api.get_belvo_client),
+):
+    summary = await belvo_api.get_belvo_link_summary(
+        client, link.link_id, transactions_limit=transactions_limit
+    )
+    # Resultados parciales se devuelven con 200; si no se obtuvo nada, es un fallo de Belvo
+    if all(summary[branch] is None for branch in belvo_api.LINK_RESOURCES):
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=summary["errors"])
+    body = dumps(summary)
+    return _conditional_json(request, body, make_etag(body))
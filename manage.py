@@ -0,0 +1,134 @@
+# Comandos de administración que se ejecutan fuera del servidor web.
+#
+# Uso:
+#   python manage.py migrate [--check]
+#   python manage.py import-users usuarios.csv [--batch-size 1000]
+#   python manage.py purge-tokens
+#   python manage.py sync-belvo [link_id ...]
+#   python manage.py calibrate-hashing [--scheme argon2] [--target-ms 250]
+import argparse
+import asyncio
+import csv
+import sys
+
+from pydantic import ValidationError
+
+import auth, belvo_api, crud, migrations, schemas
+from database import AsyncSessionLocal, engine
+from hashing import password_hasher
+from sync import sync_engine
+
+
+# Aplica las migraciones pendientes del esquema (una vez por despliegue, antes de arrancar
+# los workers). Con --check solo comprueba si hay migraciones pendientes.
+async def migrate(check: bool):
+    version = await migrations.current_version(engine)
+    if check:
+        if version is None or version < migrations.LATEST_VERSION:
+            print(f"Migraciones pendientes: esquema en la versión {version or 0} de {migrations.LATEST_VERSION}")
+            sys.exit(1)
+        print(f"Esquema al día (versión {version}).")
+        return
+    applied = await migrations.migrate(engine)
+    if applied:
+        print(f"Migraciones aplicadas: {', '.join(str(v) for v in applied)}")
+    else:
+        print(f"Nada que migrar (versión {version}).")
+
+
+# Lee un CSV con columnas username,email,password e inserta los usuarios en lotes
+async def import_users(path: str, batch_size: int):
+    received = inserted = invalid = 0
+    async with AsyncSessionLocal() as db:
+        with open(path, newline="", encoding="utf-8") as csv_file:
+            batch = []
+            for line_number, row in enumerate(csv.DictReader(csv_file), start=2):
+                try:
+                    batch.append(schemas.UserCreate(**row))
+                except ValidationError as e:
+                    invalid += 1
+                    print(f"Línea {line_number} inválida: {e.errors()[0]['msg']}", file=sys.stderr)
+                    continue
+                if len(batch) >= batch_size:
+                    received += len(batch)
+                    inserted += await crud.bulk_create_users(db, batch, batch_size=batch_size)
+                    batch = []
+                    print(f"{received} usuarios procesados...", file=sys.stderr)
+            if batch:
+                received += len(batch)
+                inserted += await crud.bulk_create_users(db, batch, batch_size=batch_size)
+    print(f"Leídos: {received}, insertados: {inserted}, duplicados: {received - inserted}, inválidos: {invalid}")
+
+
+# Elimina refresh tokens y revocaciones ya expirados (pensado para un cron diario)
+async def purge_tokens():
+    async with AsyncSessionLocal() as db:
+        await crud.purge_expired_tokens(db)
+    print("Tokens expirados eliminados.")
+
+
+# Sincroniza ahora los links indicados, o todos los vencidos si no se indica ninguno
+async def sync_belvo(link_ids):
+    if not link_ids:
+        print(f"Links sincronizados: {await sync_engine.run_once()}")
+        return
+    for link_id in link_ids:
+        try:
+            state = await sync_engine.sync_link(link_id)
+            print(f"{link_id}: sincronizado hasta {state.last_value_date}")
+        except Exception as e:
+            print(f"{link_id}: error {getattr(e, 'detail', e)}", file=sys.stderr)
+
+
+# Busca los parámetros de hashing que se acercan a la latencia de verificación objetivo en
+# esta máquina y muestra las variables de entorno correspondientes
+async def calibrate_hashing(scheme: str, target_ms: float, memory_mib: int):
+    result = auth.calibrate_password_hashing(
+        scheme, target_ms / 1000, argon2_memory_cost=memory_mib * 1024,
+    )
+    print(f"Verificación: {result['verify_seconds'] * 1000:.0f} ms (objetivo {target_ms:.0f} ms)")
+    for name, value in result["settings"].items():
+        print(f"{name}={value}")
+
+
+async def run(args):
+    try:
+        await args.handler(args)
+    finally:
+        password_hasher.shutdown()
+        await belvo_api.belvo_client.aclose()
+        await engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Comandos de administración de la API")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="Aplicar las migraciones pendientes del esquema")
+    migrate_parser.add_argument("--check", action="store_true", help="Salir con código 1 si hay migraciones pendientes")
+    migrate_parser.set_defaults(handler=lambda args: migrate(args.check))
+
+    import_parser = subparsers.add_parser("import-users", help="Importar usuarios desde un CSV (username,email,password)")
+    import_parser.add_argument("path")
+    import_parser.add_argument("--batch-size", type=int, default=1000)
+    import_parser.set_defaults(handler=lambda args: import_users(args.path, args.batch_size))
+
+    purge_parser = subparsers.add_parser("purge-tokens", help="Eliminar refresh tokens y revocaciones expirados")
+    purge_parser.set_defaults(handler=lambda args: purge_tokens())
+
+    sync_parser = subparsers.add_parser("sync-belvo", help="Sincronizar ahora los datos de Belvo a la DB local")
+    sync_parser.add_argument("link_ids", nargs="*")
+    sync_parser.set_defaults(handler=lambda args: sync_belvo(args.link_ids))
+
+    calibrate_parser = subparsers.add_parser("calibrate-hashing", help="Elegir el coste de hashing para una latencia objetivo")
+    calibrate_parser.add_argument("--scheme", choices=["bcrypt", "argon2"], default="bcrypt")
+    calibrate_parser.add_argument("--target-ms", type=float, default=250)
+    calibrate_parser.add_argument("--memory-mib", type=int, default=auth.ARGON2_MEMORY_COST // 1024, help="Memoria inicial de argon2")
+    calibrate_parser.set_defaults(handler=lambda args: calibrate_hashing(args.scheme, args.target_ms, args.memory_mib))
+
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,335 @@
+import asyncio
+import cProfile
+import functools
+import os
+import random
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Perfilado bajo demanda: una petición con la cabecera "X-Profile: <PROFILE_TOKEN>" se perfila
+# y el resultado se guarda en PROFILE_DIR. Sin PROFILE_TOKEN la cabecera se ignora.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+# Fracción de peticiones perfiladas al azar (0 = ninguna; p. ej. 0.001 = 1 de cada 1000)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# "cprofile" (biblioteca estándar, .prof para snakeviz/pstats) o "pyinstrument" (.html, opcional)
+PROFILER = os.getenv("PROFILER", "cprofile")
+
+# Límites de los histogramas de latencia (segundos)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+# Valor de una muestra: enteros sin exponente ni pérdida de dígitos (los contadores y _count
+# crecen sin límite; con :g a partir de 1e6 dejarían de cambiar) y el resto con repr
+def _format_value(value) -> str:
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    if value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+# Métricas mínimas compatibles con el formato de texto de Prometheus. Cada observación es
+# una búsqueda binaria y unas sumas en un diccionario (sin locks: todo ocurre en el event loop,
+# salvo los contadores del pool de hashing, donde una pérdida ocasional es aceptable).
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        for labels, value in self._values.items():
+            yield self.name, self.labelnames, labels, value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def dec(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) - amount
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple, list] = {} # labels -> [conteo por bucket..., suma, total]
+
+    def observe(self, value: float, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [0] * (len(self.buckets) + 2)
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            state[index] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def samples(self):
+        names = self.labelnames + ("le",)
+        for labels, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                yield f"{self.name}_bucket", names, labels + (f"{bound:g}",), cumulative
+            yield f"{self.name}_bucket", names, labels + ("+Inf",), state[-1]
+            yield f"{self.name}_sum", self.labelnames, labels, state[-2]
+            yield f"{self.name}_count", self.labelnames, labels, state[-1]
+
+
+# Convierte los diccionarios de stats() de cada componente en gauges:
+# {"hits": 3, "breaker": {"state": "open"}} -> app_<componente>_hits 3, app_<componente>_breaker_state{value="open"} 1
+def _stats_samples(prefix: str, stats: dict, labelnames=(), labels=()):
+    if stats and all(isinstance(value, dict) for value in stats.values()):
+        # Diccionario de instancias (p. ej. pools "primary"/"replica_0"): la clave pasa a etiqueta
+        for instance, instance_stats in stats.items():
+            yield from _stats_samples(prefix, instance_stats, labelnames + ("instance",), labels + (instance,))
+        return
+    for key, value in stats.items():
+        name = re.sub(r"[^a-zA-Z0-9_]", "_", f"{prefix}_{key}")
+        if isinstance(value, bool):
+            yield name, labelnames, labels, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, labelnames, labels, value
+        elif isinstance(value, str):
+            yield name, labelnames + ("value",), labels + (value,), 1
+        elif isinstance(value, dict):
+            yield from _stats_samples(name, value, labelnames, labels)
+
+
+class Registry:
+    def __init__(self, namespace: str = "app"):
+        self.namespace = namespace
+        self._metrics: list = []
+        self._collectors: Dict[str, Callable[[], dict]] = {}
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self.register(Counter(f"{self.namespace}_{name}", documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self.register(Gauge(f"{self.namespace}_{name}", documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(f"{self.namespace}_{name}", documentation, labelnames, buckets))
+
+    # Componentes con un método stats() (cachés, pools...): se leen al generar /metrics
+    def add_collector(self, name: str, stats: Callable[[], dict]):
+        self._collectors[name] = stats
+
+    def collect_stats(self) -> dict:
+        return {name: stats() for name, stats in self._collectors.items()}
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labelnames, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}")
+        for component, stats in self.collect_stats().items():
+            for name, labelnames, labels, value in _stats_samples(f"{self.namespace}_{component}", stats):
+                lines.append(f"{name}{_format_labels(labelnames, labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+HTTP_REQUEST_SECONDS = registry.histogram(
+    "http_request_duration_seconds", "Latencia de las peticiones HTTP por ruta", ("method", "route", "status")
+)
+# Por método: la ruta solo se conoce después del enrutado y el path crudo dispararía la cardinalidad
+HTTP_IN_FLIGHT = registry.gauge("http_requests_in_flight", "Peticiones HTTP en curso", ("method",))
+CRUD_SECONDS = registry.histogram("crud_duration_seconds", "Duración de las operaciones de crud", ("operation",))
+DB_QUERY_SECONDS = registry.histogram("db_query_duration_seconds", "Duración de cada sentencia SQL", ("statement",))
+PASSWORD_HASH_SECONDS = registry.histogram(
+    "password_hash_duration_seconds", "Tiempo de bcrypt en el pool de hashing", ("operation",)
+)
+PASSWORD_HASH_WAIT_SECONDS = registry.histogram(
+    "password_hash_queue_wait_seconds", "Espera por un worker libre del pool de hashing"
+)
+UPSTREAM_SECONDS = registry.histogram(
+    "upstream_request_duration_seconds", "Duración de cada petición HTTP a servicios externos",
+    ("service", "endpoint", "status"),
+)
+PROFILES_TAKEN = registry.counter("profiles_total", "Peticiones perfiladas", ("trigger",))
+
+
+# Decorador para medir corrutinas con un histograma; la etiqueta es el nombre de la función
+def timed(histogram: Histogram):
+    def decorator(func):
+        label = func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, label)
+        return wrapper
+    return decorator
+
+
+# Mide cada sentencia SQL del motor (eventos de SQLAlchemy sobre el motor síncrono subyacente).
+# El inicio se guarda en el contexto de ejecución de la sentencia: si falla, after_cursor_execute
+# no se llama y el contexto simplemente se descarta, sin afectar a las mediciones siguientes.
+def instrument_engine(async_engine):
+    from sqlalchemy import event
+
+    sync_engine = async_engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context._metrics_query_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_metrics_query_start", None)
+        if start is not None:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - start, statement.lstrip().split(" ", 1)[0].upper())
+
+
+# Perfilador de una petición. Solo se perfila una petición a la vez: cProfile es global al
+# hilo y en un event loop mide también las corrutinas de otras peticiones concurrentes.
+class _RequestProfiler:
+    _lock = threading.Lock()
+
+    def __init__(self, label: str):
+        self.label = label
+        self.active = self._lock.acquire(blocking=False)
+        self._profiler = None
+        if not self.active:
+            return
+        try:
+            if PROFILER == "pyinstrument":
+                from pyinstrument import Profiler # Dependencia opcional
+                self._profiler = Profiler(async_mode="enabled")
+                self._profiler.start()
+            else:
+                self._profiler = cProfile.Profile()
+                self._profiler.enable()
+        except Exception as e:
+            print(f"No se pudo iniciar el perfilador {PROFILER!r}: {e}")
+            self._lock.release()
+            self.active = False
+
+    # Detiene el perfilador (en el hilo del event loop, que es donde se activó)
+    def stop(self):
+        try:
+            if PROFILER == "pyinstrument":
+                self._profiler.stop()
+            else:
+                self._profiler.disable()
+        finally:
+            self._lock.release()
+
+    # Escribe el perfil a disco; bloqueante, se ejecuta en un hilo del executor
+    def write(self) -> str:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        base = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%dT%H%M%S')}-{self.label}")
+        if PROFILER == "pyinstrument":
+            path = base + ".html"
+            with open(path, "w", encoding="utf-8") as output:
+                output.write(self._profiler.output_html())
+        else:
+            path = base + ".prof"
+            self._profiler.dump_stats(path)
+        return path
+
+
+# Middleware ASGI: latencia por ruta (plantilla de la ruta, no la URL, para acotar la
+# cardinalidad), peticiones en curso y perfilado opcional. Coste por petición: dos
+# perf_counter y unas operaciones de diccionario.
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def _should_profile(self, scope) -> Optional[str]:
+        if PROFILE_TOKEN:
+            for name, value in scope.get("headers", ()):
+                if name == b"x-profile" and value.decode("latin-1") == PROFILE_TOKEN:
+                    return "header"
+        if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+            return "sample"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        method = scope["method"]
+        status_code = 500
+        trigger = self._should_profile(scope)
+        profiler = None
+        if trigger:
+            label = re.sub(r"[^a-zA-Z0-9]+", "_", f"{method}{scope['path']}").strip("_")
+            profiler = _RequestProfiler(label)
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(method)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            HTTP_IN_FLIGHT.dec(method)
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.observe(elapsed, method, getattr(route, "path", "unmatched"), status_code)
+            if profiler is not None and profiler.active:
+                profiler.stop()
+                path = await asyncio.get_running_loop().run_in_executor(None, profiler.write)
+                PROFILES_TAKEN.inc(trigger)
+                print(f"Perfil de {method} {scope['path']} ({elapsed * 1000:.1f} ms) guardado en {path}")
@@ -0,0 +1,226 @@
+# Migraciones versionadas del esquema de la base de datos.
+# Se ejecutan una sola vez por despliegue, fuera de los workers web:
+#
+#   python manage.py migrate            # aplica las migraciones pendientes
+#   python manage.py migrate --check    # sale con código 1 si hay migraciones pendientes
+#
+# Las migraciones aplicadas se registran en la tabla schema_migrations. Cada migración es una
+# función que recibe una conexión síncrona de SQLAlchemy (se ejecuta con run_sync) y no debe
+# modificarse una vez publicada: los cambios de esquema posteriores van en una migración nueva.
+import os
+from datetime import datetime, timezone
+from typing import Callable, List, NamedTuple, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import (
+    JSON, Column, Date, DateTime, ForeignKey, Index, Integer, MetaData, String, Table, Text, UniqueConstraint,
+    func, inspect, select, text,
+)
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+load_dotenv()
+
+# Solo para desarrollo y pruebas (un único proceso): aplica las migraciones al arrancar
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "false").lower() in ("1", "true", "yes")
+# Segundos esperando el lock de migraciones de MySQL si otro proceso está migrando
+DB_MIGRATION_LOCK_TIMEOUT = int(os.getenv("DB_MIGRATION_LOCK_TIMEOUT", 60))
+
+_metadata = MetaData()
+schema_migrations = Table(
+    "schema_migrations",
+    _metadata,
+    Column("version", Integer, primary_key=True),
+    Column("description", String(200), nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    upgrade: Callable
+
+
+# 1: tablas existentes hasta ahora. checkfirst=True adopta las bases de datos creadas con el
+# antiguo create_all del arranque sin tocar las tablas que ya existen.
+# Las tablas se definen aquí tal como eran al publicar la migración (y no con models.*), para
+# que la migración no cambie cuando cambian los modelos.
+def _initial_schema(connection):
+    metadata = MetaData()
+    Table(
+        "users", metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("username", String(50), unique=True, index=True),
+        Column("email", String(100), unique=True, index=True),
+        Column("hashed_password", String(255)),
+        Column("token_version", Integer, nullable=False, server_default="0"),
+    )
+    Table(
+        "refresh_tokens", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("token_hash", String(64), unique=True, index=True, nullable=False),
+        Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=False),
+        Column("family_id", String(32), index=True, nullable=False),
+        Column("created_at", DateTime, nullable=False),
+        Column("expires_at", DateTime, nullable=False),
+        Column("revoked_at", DateTime, nullable=True),
+    )
+    Table(
+        "revoked_tokens", metadata,
+        Column("jti", String(32), primary_key=True),
+        Column("revoked_at", DateTime, index=True, nullable=False),
+        Column("expires_at", DateTime, index=True, nullable=False),
+    )
+    Table(
+        "belvo_links", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("user_id", Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False),
+        Column("link_id", String(64), index=True, nullable=False),
+        Column("institution", String(100), nullable=True),
+        Column("created_at", DateTime, nullable=False),
+        UniqueConstraint("user_id", "link_id", name="uq_belvo_links_user_link"),
+    )
+    Table(
+        "belvo_accounts", metadata,
+        Column("id", String(64), primary_key=True),
+        Column("link_id", String(64), index=True, nullable=False),
+        Column("data", JSON, nullable=False),
+        Column("synced_at", DateTime, nullable=False),
+    )
+    Table(
+        "belvo_balances", metadata,
+        Column("id", String(64), primary_key=True),
+        Column("link_id", String(64), index=True, nullable=False),
+        Column("account_id", String(64), nullable=True),
+        Column("data", JSON, nullable=False),
+        Column("synced_at", DateTime, nullable=False),
+    )
+    Table(
+        "belvo_transactions", metadata,
+        Column("id", String(64), primary_key=True),
+        Column("link_id", String(64), nullable=False),
+        Column("account_id", String(64), nullable=True),
+        Column("value_date", Date, nullable=False),
+        Column("data", JSON, nullable=False),
+        Column("synced_at", DateTime, nullable=False),
+        Index("ix_belvo_transactions_link_date", "link_id", "value_date", "id"),
+    )
+    Table(
+        "belvo_sync_state", metadata,
+        Column("link_id", String(64), primary_key=True),
+        Column("last_value_date", Date, nullable=True),
+        Column("last_transaction_id", String(64), nullable=True),
+        Column("last_synced_at", DateTime, nullable=True),
+        Column("next_sync_at", DateTime, index=True, nullable=False),
+        Column("last_error", Text, nullable=True),
+    )
+    metadata.create_all(connection, checkfirst=True)
+
+
+# Columnas existentes de una tabla (para migraciones que deben tolerar esquemas parciales)
+def _columns(connection, table: str) -> set:
+    return {column["name"] for column in inspect(connection).get_columns(table)}
+
+
+# 2: desactivación de cuentas desde la administración de usuarios. La comprobación previa cubre
+# las bases de datos migradas con versiones anteriores de la migración 1, que creaba las tablas
+# a partir de los modelos de ese momento.
+def _add_users_disabled_at(connection):
+    if "disabled_at" not in _columns(connection, "users"):
+        connection.execute(text("ALTER TABLE users ADD COLUMN disabled_at DATETIME NULL"))
+
+
+# 3: users.token_version. Las bases de datos creadas con el create_all anterior a la versión de
+# tokens ya tenían la tabla users, que la migración 1 adopta sin modificarla; aquí se añade la
+# columna si falta (con valor 0 para los usuarios existentes).
+def _add_users_token_version(connection):
+    if "token_version" not in _columns(connection, "users"):
+        connection.execute(text("ALTER TABLE users ADD COLUMN token_version INTEGER NOT NULL DEFAULT 0"))
+
+
+# 4: estado de sincronización para los links ya registrados. Desde ahora se crea al registrar
+# el link, en lugar de que el planificador lo busque en cada pasada.
+def _backfill_belvo_sync_state(connection):
+    connection.execute(
+        text(
+            "INSERT INTO belvo_sync_state (link_id, next_sync_at) "
+            "SELECT DISTINCT link_id, :now FROM belvo_links "
+            "WHERE link_id NOT IN (SELECT link_id FROM belvo_sync_state)"
+        ),
+        {"now": datetime.now(timezone.utc).replace(tzinfo=None)},
+    )
+
+
+# 5: belvo_sync_state.data_version, contador de cambios de la copia local de cada link
+def _add_belvo_sync_state_data_version(connection):
+    if "data_version" not in _columns(connection, "belvo_sync_state"):
+        connection.execute(text("ALTER TABLE belvo_sync_state ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0"))
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Esquema inicial", _initial_schema),
+    Migration(2, "users.disabled_at", _add_users_disabled_at),
+    Migration(3, "users.token_version", _add_users_token_version),
+    Migration(4, "belvo_sync_state de los links existentes", _backfill_belvo_sync_state),
+    Migration(5, "belvo_sync_state.data_version", _add_belvo_sync_state_data_version),
+]
+LATEST_VERSION = max(migration.version for migration in MIGRATIONS)
+
+
+class PendingMigrationsError(Exception):
+    pass
+
+
+def _migrate(connection) -> List[int]:
+    is_mysql = connection.dialect.name == "mysql"
+    if is_mysql:
+        # Un solo proceso migra a la vez; los demás esperan y ya no encuentran nada pendiente
+        acquired = connection.execute(
+            text("SELECT GET_LOCK('schema_migrations', :timeout)"), {"timeout": DB_MIGRATION_LOCK_TIMEOUT}
+        ).scalar()
+        if acquired != 1:
+            raise RuntimeError("No se pudo obtener el lock de migraciones (¿hay otra migración en curso?)")
+    try:
+        _metadata.create_all(connection, checkfirst=True)
+        applied = set(connection.execute(select(schema_migrations.c.version)).scalars())
+        done = []
+        for migration in sorted(MIGRATIONS, key=lambda migration: migration.version):
+            if migration.version in applied:
+                continue
+            migration.upgrade(connection)
+            connection.execute(schema_migrations.insert().values(
+                version=migration.version,
+                description=migration.description,
+                applied_at=datetime.now(timezone.utc).replace(tzinfo=None),
+            ))
+            done.append(migration.version)
+        return done
+    finally:
+        if is_mysql:
+            connection.execute(text("SELECT RELEASE_LOCK('schema_migrations')"))
+
+
+# Aplica las migraciones pendientes y devuelve las versiones aplicadas
+async def migrate(engine) -> List[int]:
+    async with engine.begin() as conn:
+        return await conn.run_sync(_migrate)
+
+
+# Versión actual del esquema (None si nunca se ha migrado). Una sola consulta barata, sin
+# reflexión del esquema: si la tabla no existe la consulta falla.
+async def current_version(engine) -> Optional[int]:
+    try:
+        async with engine.connect() as conn:
+            return (await conn.execute(select(func.max(schema_migrations.c.version)))).scalar()
+    except (OperationalError, ProgrammingError):
+        return None
+
+
+# Comprobación del arranque: falla si el esquema está por detrás del código
+async def check_schema(engine):
+    version = await current_version(engine)
+    if version is None or version < LATEST_VERSION:
+        raise PendingMigrationsError(
+            f"Esquema en la versión {version or 0}, el código requiere la {LATEST_VERSION}: "
+            "ejecuta `python manage.py migrate`"
+        )
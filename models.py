@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String
+from sqlalchemy import JSON, Column, Date, DateTime, ForeignKey, Index, Integer, String, Text, UniqueConstraint
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -10,7 +10,116 @@ class User(Base):
     username = Column(String(50), unique=True, index=True) # Nombre de usuario, debe ser único
     email = Column(String(100), unique=True, index=True) # Correo electrónico, debe ser único
     hashed_password = Column(String(255)) # Contraseña hasheada (NO la contraseña en texto plano)
+    # Versión de los tokens del usuario: al incrementarla se invalidan todos sus tokens emitidos
+    token_version = Column(Integer, nullable=False, default=0, server_default="0")
+    # Momento en que un administrador desactivó la cuenta (None = activa); no puede iniciar sesión
+    disabled_at = Column(DateTime, nullable=True)
+
+    # Links de Belvo registrados por el usuario
+    links = relationship("BelvoLink", back_populates="user", cascade="all, delete-orphan", passive_deletes=True)
 
     # Representación de la instancia del objeto cuando se imprime
     def __repr__(self):
-        return f"<User(id={self.id}, username='{self.username}', email='{self.email}')>"
\ No newline at end of file
+        return f"<User(id={self.id}, username='{self.username}', email='{self.email}')>"
+
+# Refresh token emitido en un login. Solo se guarda el hash SHA-256 del token.
+# Todos los tokens obtenidos por rotación desde un mismo login comparten `family_id`
+# (la "sesión"); reutilizar un token ya rotado revoca la familia completa.
+class RefreshToken(Base):
+    __tablename__ = "refresh_tokens"
+
+    id = Column(Integer, primary_key=True)
+    token_hash = Column(String(64), unique=True, index=True, nullable=False)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), index=True, nullable=False)
+    family_id = Column(String(32), index=True, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    revoked_at = Column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return f"<RefreshToken(id={self.id}, user_id={self.user_id}, family_id='{self.family_id}')>"
+
+
+# Token de acceso revocado antes de su expiración (lista de revocación).
+# Se sincroniza periódicamente a un índice en memoria (ver revocation.py).
+class RevokedToken(Base):
+    __tablename__ = "revoked_tokens"
+
+    jti = Column(String(32), primary_key=True)
+    revoked_at = Column(DateTime, index=True, nullable=False) # Para la sincronización incremental
+    expires_at = Column(DateTime, index=True, nullable=False) # Para purgar entradas ya inútiles
+
+    def __repr__(self):
+        return f"<RevokedToken(jti='{self.jti}')>"
+
+
+# Link de Belvo (conexión con una institución) asociado a un usuario
+class BelvoLink(Base):
+    __tablename__ = "belvo_links"
+    __table_args__ = (UniqueConstraint("user_id", "link_id", name="uq_belvo_links_user_link"),)
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    link_id = Column(String(64), index=True, nullable=False) # Identificador del link en Belvo
+    institution = Column(String(100), nullable=True)
+    created_at = Column(DateTime, nullable=False)
+
+    user = relationship("User", back_populates="links")
+
+    def __repr__(self):
+        return f"<BelvoLink(id={self.id}, user_id={self.user_id}, link_id='{self.link_id}')>"
+
+
+# --- Copia local de los datos de Belvo (ver sync.py) ---
+# Cada fila guarda el objeto tal como lo devuelve Belvo (`data`) más las columnas por las que
+# se filtra y ordena. Las tablas se indexan por link_id, no por usuario: si dos usuarios
+# registran el mismo link, los datos se sincronizan una sola vez.
+
+class BelvoAccount(Base):
+    __tablename__ = "belvo_accounts"
+
+    id = Column(String(64), primary_key=True) # id de la cuenta en Belvo
+    link_id = Column(String(64), index=True, nullable=False)
+    data = Column(JSON, nullable=False)
+    synced_at = Column(DateTime, nullable=False)
+
+
+class BelvoBalance(Base):
+    __tablename__ = "belvo_balances"
+
+    id = Column(String(64), primary_key=True)
+    link_id = Column(String(64), index=True, nullable=False)
+    account_id = Column(String(64), nullable=True)
+    data = Column(JSON, nullable=False)
+    synced_at = Column(DateTime, nullable=False)
+
+
+class BelvoTransaction(Base):
+    __tablename__ = "belvo_transactions"
+    # Lecturas por link ordenadas por fecha valor (y paginación por clave con el id)
+    __table_args__ = (Index("ix_belvo_transactions_link_date", "link_id", "value_date", "id"),)
+
+    id = Column(String(64), primary_key=True)
+    link_id = Column(String(64), nullable=False)
+    account_id = Column(String(64), nullable=True)
+    value_date = Column(Date, nullable=False)
+    data = Column(JSON, nullable=False)
+    synced_at = Column(DateTime, nullable=False)
+
+
+# Estado de sincronización de un link: marca de agua de transacciones (value_date, id)
+# y planificación de la próxima sincronización.
+class BelvoSyncState(Base):
+    __tablename__ = "belvo_sync_state"
+
+    link_id = Column(String(64), primary_key=True)
+    last_value_date = Column(Date, nullable=True)
+    last_transaction_id = Column(String(64), nullable=True)
+    last_synced_at = Column(DateTime, nullable=True) # Última sincronización completa correcta
+    # Se incrementa en la misma transacción que cada bloque de filas guardado (parte del ETag)
+    data_version = Column(Integer, nullable=False, default=0, server_default="0")
+    next_sync_at = Column(DateTime, index=True, nullable=False)
+    last_error = Column(Text, nullable=True)
+
+    def __repr__(self):
+        return f"<BelvoSyncState(link_id='{self.link_id}', last_synced_at={self.last_synced_at})>"
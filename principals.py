@@ -0,0 +1,95 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from dotenv import load_dotenv
+
+import schemas
+from auth import ACCESS_TOKEN_EXPIRE_MINUTES
+
+load_dotenv()
+
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 10000))
+# El TTL nunca supera la vida de un token de acceso
+PRINCIPAL_CACHE_TTL = min(
+    float(os.getenv("PRINCIPAL_CACHE_TTL", 300)), ACCESS_TOKEN_EXPIRE_MINUTES * 60
+)
+
+
+# Caché en proceso de usuarios autenticados, indexada por (id de usuario, versión de token).
+# Evita una consulta a la DB por cada petición autenticada.
+class PrincipalCache:
+    def __init__(self, max_entries: int = PRINCIPAL_CACHE_SIZE, ttl: float = PRINCIPAL_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[tuple, tuple]" = OrderedDict()
+        # user_id -> instante de invalidación; los tokens emitidos antes quedan rechazados
+        self._invalidated: "dict[int, float]" = {}
+        # Métricas
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int, token_version: int) -> Optional[schemas.Principal]:
+        key = (user_id, token_version)
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= time.monotonic():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, principal: schemas.Principal):
+        key = (principal.id, principal.token_version)
+        self._entries[key] = (principal, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    # Debe llamarse cuando un usuario se modifica o se elimina
+    def invalidate_user(self, user_id: int):
+        self.invalidate_users([user_id])
+
+    # Varios usuarios a la vez (operaciones masivas): una sola pasada por la caché
+    def invalidate_users(self, user_ids):
+        user_ids = set(user_ids)
+        for key in [key for key in self._entries if key[0] in user_ids]:
+            del self._entries[key]
+        now = time.time()
+        for user_id in user_ids:
+            self._invalidated[user_id] = now
+        self._prune_invalidated()
+
+    # Para tokens con claims embebidos: ¿se emitió el token antes de invalidar al usuario?
+    # "iat" tiene resolución de segundos (truncado): ante la duda se rechaza. Un token emitido en
+    # el mismo segundo que la invalidación, antes o después, se considera invalidado; toda causa
+    # de invalidación (baja, desactivación) impide además volver a iniciar sesión.
+    def is_invalidated(self, user_id: int, issued_at: Optional[float]) -> bool:
+        invalidated_at = self._invalidated.get(user_id)
+        if invalidated_at is None:
+            return False
+        return issued_at is None or issued_at <= invalidated_at
+
+    def _prune_invalidated(self):
+        # Pasada la vida máxima de un token, la marca ya no puede afectar a ningún token vigente
+        cutoff = time.time() - ACCESS_TOKEN_EXPIRE_MINUTES * 60
+        for user_id in [uid for uid, at in self._invalidated.items() if at < cutoff]:
+            del self._invalidated[user_id]
+
+    def clear(self):
+        self._entries.clear()
+        self._invalidated.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidated_users": len(self._invalidated),
+        }
+
+
+principal_cache = PrincipalCache()
@@ -0,0 +1,206 @@
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request, status
+
+import kvstore
+
+load_dotenv()
+
+# Límites de intentos de login: capacidad del bucket y recarga (intentos por minuto)
+LOGIN_RATE_IP_CAPACITY = int(os.getenv("LOGIN_RATE_IP_CAPACITY", 20))
+LOGIN_RATE_IP_PER_MINUTE = float(os.getenv("LOGIN_RATE_IP_PER_MINUTE", 10))
+LOGIN_RATE_USERNAME_CAPACITY = int(os.getenv("LOGIN_RATE_USERNAME_CAPACITY", 5))
+LOGIN_RATE_USERNAME_PER_MINUTE = float(os.getenv("LOGIN_RATE_USERNAME_PER_MINUTE", 5))
+# Backoff progresivo por usuario: tras LOGIN_BACKOFF_THRESHOLD fallos seguidos el usuario se
+# bloquea LOGIN_BACKOFF_BASE segundos, duplicando en cada fallo hasta LOGIN_BACKOFF_MAX
+LOGIN_BACKOFF_THRESHOLD = int(os.getenv("LOGIN_BACKOFF_THRESHOLD", 5))
+LOGIN_BACKOFF_BASE = float(os.getenv("LOGIN_BACKOFF_BASE", 1))
+LOGIN_BACKOFF_MAX = float(os.getenv("LOGIN_BACKOFF_MAX", 900))
+# Ventana durante la que se recuerdan los fallos de un usuario
+LOGIN_FAILURE_WINDOW = float(os.getenv("LOGIN_FAILURE_WINDOW", 3600))
+# Usar X-Forwarded-For solo si la API está detrás de un proxy de confianza
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "false").lower() in ("1", "true", "yes")
+# Almacén compartido entre workers/nodos (por defecto SHARED_STATE_URL; vacío = memoria del
+# proceso); ver kvstore.py
+RATE_LIMIT_URL = os.getenv("RATE_LIMIT_URL") or kvstore.SHARED_STATE_URL
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))
+
+
+# Backend en memoria para un solo nodo: token buckets exactos.
+# El número de claves está acotado (LRU) para que una ráfaga desde muchas IPs no agote la memoria.
+class MemoryRateLimitBackend:
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, list]" = OrderedDict()
+        self._failures: "OrderedDict[str, tuple]" = OrderedDict()
+        self._locks: "dict[str, float]" = {}
+
+    def _touch(self, store: OrderedDict, key: str, value):
+        store[key] = value
+        store.move_to_end(key)
+        while len(store) > self.max_keys:
+            store.popitem(last=False)
+
+    # Consume un token; devuelve (permitido, segundos hasta el próximo token)
+    async def take(self, key: str, capacity: int, refill_per_second: float) -> Tuple[bool, float]:
+        now = time.monotonic()
+        tokens, updated_at = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated_at) * refill_per_second)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._touch(self._buckets, key, (tokens, now))
+        return allowed, 0.0 if allowed else (1 - tokens) / refill_per_second
+
+    async def add_failure(self, key: str, window: float) -> int:
+        now = time.monotonic()
+        count, expires_at = self._failures.get(key, (0, 0.0))
+        count = count + 1 if expires_at > now else 1
+        self._touch(self._failures, key, (count, now + window))
+        return count
+
+    async def clear_failures(self, key: str):
+        self._failures.pop(key, None)
+        self._locks.pop(key, None)
+
+    async def lock(self, key: str, seconds: float):
+        self._locks[key] = time.monotonic() + seconds
+        if len(self._locks) > self.max_keys:
+            now = time.monotonic()
+            self._locks = {k: until for k, until in self._locks.items() if until > now}
+
+    async def lock_remaining(self, key: str) -> float:
+        until = self._locks.get(key)
+        if until is None:
+            return 0.0
+        remaining = until - time.monotonic()
+        if remaining <= 0:
+            del self._locks[key]
+            return 0.0
+        return remaining
+
+
+# Backend compartido sobre un almacén compatible con Redis (varios nodos).
+# Aproxima el token bucket con una ventana fija: `capacity` intentos por cada intervalo
+# que tarda el bucket en llenarse. Solo usa INCR/PEXPIRE/SET/PTTL (atómicos en Redis).
+class KVRateLimitBackend:
+    def __init__(self, kv, prefix: str = "rl:"):
+        self.kv = kv
+        self.prefix = prefix
+
+    async def take(self, key: str, capacity: int, refill_per_second: float) -> Tuple[bool, float]:
+        window = capacity / refill_per_second
+        now = time.time()
+        window_start = math.floor(now / window) * window
+        counter_key = f"{self.prefix}b:{key}:{int(window_start)}"
+        count = await self.kv.incrby(counter_key, 1)
+        if count == 1:
+            await self.kv.pexpire(counter_key, int(window * 1000) + 1000)
+        allowed = count <= capacity
+        return allowed, 0.0 if allowed else window_start + window - now
+
+    async def add_failure(self, key: str, window: float) -> int:
+        failure_key = f"{self.prefix}f:{key}"
+        count = await self.kv.incrby(failure_key, 1)
+        await self.kv.pexpire(failure_key, int(window * 1000))
+        return count
+
+    async def clear_failures(self, key: str):
+        await self.kv.delete(f"{self.prefix}f:{key}", f"{self.prefix}l:{key}")
+
+    async def lock(self, key: str, seconds: float):
+        await self.kv.set(f"{self.prefix}l:{key}", b"1", px=max(1, int(seconds * 1000)))
+
+    async def lock_remaining(self, key: str) -> float:
+        ttl_ms = await self.kv.pttl(f"{self.prefix}l:{key}")
+        return ttl_ms / 1000 if ttl_ms > 0 else 0.0
+
+
+def build_backend(url: Optional[str] = RATE_LIMIT_URL):
+    kv = kvstore.connect_kv(url)
+    if kv is None:
+        return MemoryRateLimitBackend()
+    return KVRateLimitBackend(kv)
+
+
+# Dirección del cliente, opcionalmente tomada de X-Forwarded-For
+def client_ip(request: Request) -> str:
+    if RATE_LIMIT_TRUST_PROXY:
+        forwarded = request.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.client.host if request.client else "unknown"
+
+
+# Limitador de intentos de login. `check` se llama antes de tocar la DB o bcrypt,
+# por lo que los intentos rechazados cuestan microsegundos.
+class LoginRateLimiter:
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else build_backend()
+        # Métricas
+        self.allowed = 0
+        self.rejected_ip = 0
+        self.rejected_username = 0
+        self.rejected_lockout = 0
+        self.failures = 0
+        self.lockouts = 0
+
+    @staticmethod
+    def _too_many(retry_after: float) -> HTTPException:
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Demasiados intentos de inicio de sesión. Inténtalo más tarde.",
+            headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+        )
+
+    async def check(self, ip: str, username: str):
+        username = username.strip().lower()
+        remaining = await self.backend.lock_remaining(f"user:{username}")
+        if remaining > 0:
+            self.rejected_lockout += 1
+            raise self._too_many(remaining)
+        allowed, retry_after = await self.backend.take(
+            f"ip:{ip}", LOGIN_RATE_IP_CAPACITY, LOGIN_RATE_IP_PER_MINUTE / 60
+        )
+        if not allowed:
+            self.rejected_ip += 1
+            raise self._too_many(retry_after)
+        allowed, retry_after = await self.backend.take(
+            f"user:{username}", LOGIN_RATE_USERNAME_CAPACITY, LOGIN_RATE_USERNAME_PER_MINUTE / 60
+        )
+        if not allowed:
+            self.rejected_username += 1
+            raise self._too_many(retry_after)
+        self.allowed += 1
+
+    async def record_failure(self, username: str):
+        username = username.strip().lower()
+        self.failures += 1
+        count = await self.backend.add_failure(f"user:{username}", LOGIN_FAILURE_WINDOW)
+        if count >= LOGIN_BACKOFF_THRESHOLD:
+            exponent = min(count - LOGIN_BACKOFF_THRESHOLD, 30)
+            await self.backend.lock(
+                f"user:{username}", min(LOGIN_BACKOFF_MAX, LOGIN_BACKOFF_BASE * 2 ** exponent)
+            )
+            self.lockouts += 1
+
+    async def record_success(self, username: str):
+        await self.backend.clear_failures(f"user:{username.strip().lower()}")
+
+    def stats(self) -> dict:
+        return {
+            "allowed": self.allowed,
+            "rejected_ip": self.rejected_ip,
+            "rejected_username": self.rejected_username,
+            "rejected_lockout": self.rejected_lockout,
+            "failures": self.failures,
+            "lockouts": self.lockouts,
+        }
+
+
+login_rate_limiter = LoginRateLimiter()
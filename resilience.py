@@ -0,0 +1,228 @@
+import asyncio
+import random
+import time
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Optional
+
+import httpx
+
+# Respuestas del upstream que merece la pena reintentar (saturación o fallo transitorio)
+RETRYABLE_STATUSES = frozenset({429, 502, 503, 504})
+
+
+# El circuito está abierto: no se llama al upstream hasta que pase `retry_after`
+class CircuitOpenError(Exception):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"Circuito '{name}' abierto")
+        self.name = name
+        self.retry_after = retry_after
+
+
+# Se agotó el tiempo total (todos los intentos incluidos) de una llamada
+class DeadlineExceededError(Exception):
+    pass
+
+
+# Reintentos con backoff exponencial y jitter completo: la espera antes del intento n es
+# un valor aleatorio entre 0 y min(max_delay, base_delay * 2**n). El jitter evita que
+# muchos clientes reintenten a la vez contra un upstream que se está recuperando.
+class RetryPolicy:
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.2, max_delay: float = 2.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+# Circuit breaker: tras `failure_threshold` fallos seguidos se abre y las llamadas fallan al
+# instante durante `recovery_timeout` segundos. Después deja pasar una única llamada de prueba
+# (semiabierto): si va bien se cierra, si falla vuelve a abrirse.
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = recovery_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        # Métricas
+        self.opened = 0
+        self.short_circuited = 0
+
+    def before_call(self):
+        if self.state == self.CLOSED:
+            return
+        remaining = self._opened_at + self.recovery_timeout - time.monotonic()
+        if self.state == self.OPEN and remaining <= 0:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return
+        self.short_circuited += 1
+        raise CircuitOpenError(self.name, max(remaining, 1.0))
+
+    # La llamada terminó sin resultado (p. ej. cancelada): libera la llamada de prueba
+    def release(self):
+        self._probe_in_flight = False
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                self.opened += 1
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+    def stats(self) -> dict:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "opened": self.opened,
+            "short_circuited": self.short_circuited,
+        }
+
+
+def _retry_after_seconds(response: httpx.Response) -> Optional[float]:
+    value = response.headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+# Política de llamadas a un servicio externo: plazo total, reintentos (solo para peticiones
+# idempotentes), circuit breaker y, opcionalmente, peticiones de cobertura ("hedged"): si un
+# intento no ha respondido en `hedge_delay` segundos se lanza otro en paralelo y se usa el
+# primero que termine. Reduce la latencia de cola a costa de alguna petición extra.
+class UpstreamPolicy:
+    def __init__(
+        self,
+        name: str,
+        *,
+        retry: Optional[RetryPolicy] = None,
+        breaker: Optional[CircuitBreaker] = None,
+        deadline: Optional[float] = None,
+        hedge_delay: Optional[float] = None,
+        retry_statuses=RETRYABLE_STATUSES,
+    ):
+        self.name = name
+        self.retry = retry or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker(name)
+        self.deadline = deadline
+        self.hedge_delay = hedge_delay or None
+        self.retry_statuses = retry_statuses
+        # Métricas
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.deadline_exceeded = 0
+
+    # Fallo del upstream (cuenta para el breaker): errores de red/timeout y respuestas 5xx o 429.
+    # Un 4xx es un error de la petición, no del servicio.
+    def _is_failure(self, response: Optional[httpx.Response], error: Optional[BaseException]) -> bool:
+        if error is not None:
+            return isinstance(error, (httpx.TransportError, asyncio.TimeoutError))
+        return response.status_code >= 500 or response.status_code == 429
+
+    async def _hedged(self, send: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+        first = asyncio.ensure_future(send())
+        if self.hedge_delay is None:
+            return await first
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.hedge_delay)
+        except BaseException:
+            first.cancel()
+            raise
+        if done:
+            return first.result()
+        self.hedges += 1
+        second = asyncio.ensure_future(send())
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    # Ejecuta `send` (que hace la petición y devuelve la respuesta) aplicando la política.
+    # Devuelve la última respuesta (aunque sea un error HTTP) o propaga la última excepción.
+    async def call(self, send: Callable[[], Awaitable[httpx.Response]], *, idempotent: bool = True) -> httpx.Response:
+        self.calls += 1
+        self.breaker.before_call()
+        attempts = self.retry.max_attempts if idempotent else 1
+        give_up_at = time.monotonic() + self.deadline if self.deadline else None
+        attempt = 0
+        while True:
+            response, error = None, None
+            try:
+                if give_up_at is None:
+                    response = await self._hedged(send)
+                else:
+                    response = await asyncio.wait_for(self._hedged(send), give_up_at - time.monotonic())
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                error = e
+            except BaseException:
+                # Cancelación u otros errores: la llamada de prueba del breaker no debe quedar colgada
+                self.breaker.release()
+                raise
+
+            if not self._is_failure(response, error):
+                self.breaker.record_success()
+                return response
+            self.breaker.record_failure()
+
+            attempt += 1
+            retryable = error is not None or response.status_code in self.retry_statuses
+            delay = self.retry.backoff(attempt - 1)
+            if response is not None and (retry_after := _retry_after_seconds(response)) is not None:
+                delay = max(delay, retry_after)
+            out_of_time = give_up_at is not None and time.monotonic() + delay >= give_up_at
+            if not retryable or attempt >= attempts or out_of_time or self.breaker.state == CircuitBreaker.OPEN:
+                self.failures += 1
+                if error is not None:
+                    if isinstance(error, asyncio.TimeoutError) and give_up_at is not None:
+                        self.deadline_exceeded += 1
+                        raise DeadlineExceededError(f"Sin respuesta de '{self.name}' en {self.deadline:g} s") from error
+                    raise error
+                return response
+            self.retries += 1
+            await asyncio.sleep(delay)
+            self.breaker.before_call()
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "failures": self.failures,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "deadline_exceeded": self.deadline_exceeded,
+            "breaker": self.breaker.stats(),
+        }
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+from dotenv import load_dotenv
+from sqlalchemy.future import select
+
+import models
+
+load_dotenv()
+
+# Cada cuántos segundos se traen de la DB las revocaciones hechas por otros workers/nodos
+REVOCATION_SYNC_INTERVAL = float(os.getenv("REVOCATION_SYNC_INTERVAL", 5))
+# Solape de cada sincronización incremental, para no perder filas confirmadas con retraso
+REVOCATION_SYNC_OVERLAP = float(os.getenv("REVOCATION_SYNC_OVERLAP", 30))
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+# Índice en memoria de los jti revocados (hash set con expiración).
+# La comprobación por petición es una búsqueda O(1) en un diccionario: sin consultas a la DB.
+# Las entradas se purgan cuando el token habría expirado de todos modos.
+class RevocationIndex:
+    def __init__(self):
+        self._revoked: "dict[str, float]" = {} # jti -> exp (timestamp)
+        self._synced_until: Optional[datetime] = None
+        self._next_prune = 0.0
+        # Métricas
+        self.checks = 0
+        self.hits = 0
+        self.syncs = 0
+        self.sync_errors = 0
+
+    def add(self, jti: str, expires_at: float):
+        if expires_at > time.time():
+            self._revoked[jti] = expires_at
+
+    def is_revoked(self, jti: Optional[str]) -> bool:
+        self.checks += 1
+        if jti is None or jti not in self._revoked:
+            return False
+        self.hits += 1
+        return True
+
+    def prune(self):
+        now = time.time()
+        for jti in [jti for jti, exp in self._revoked.items() if exp <= now]:
+            del self._revoked[jti]
+
+    # Trae las revocaciones nuevas desde la última sincronización (la primera, todas las vigentes)
+    async def sync(self, db):
+        started_at = _utcnow()
+        query = select(models.RevokedToken.jti, models.RevokedToken.expires_at).where(
+            models.RevokedToken.expires_at > started_at
+        )
+        if self._synced_until is not None:
+            query = query.where(
+                models.RevokedToken.revoked_at >= self._synced_until - timedelta(seconds=REVOCATION_SYNC_OVERLAP)
+            )
+        result = await db.execute(query)
+        for jti, expires_at in result.all():
+            self.add(jti, expires_at.replace(tzinfo=timezone.utc).timestamp())
+        self._synced_until = started_at
+        self.syncs += 1
+        if time.monotonic() >= self._next_prune:
+            self.prune()
+            self._next_prune = time.monotonic() + 60
+
+    # Bucle de sincronización en segundo plano (se lanza en el arranque de la aplicación)
+    async def run_sync_loop(self, session_factory, interval: float = REVOCATION_SYNC_INTERVAL):
+        while True:
+            try:
+                async with session_factory() as db:
+                    await self.sync(db)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.sync_errors += 1
+                print(f"Error sincronizando la lista de revocación: {e}")
+            await asyncio.sleep(interval)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._revoked),
+            "checks": self.checks,
+            "hits": self.hits,
+            "syncs": self.syncs,
+            "sync_errors": self.sync_errors,
+        }
+
+
+revocation_index = RevocationIndex()
@@ -1,5 +1,6 @@
-from pydantic import BaseModel, EmailStr
-from typing import List, Optional
+from datetime import datetime
+from pydantic import BaseModel, EmailStr, Field, field_validator
+from typing import Dict, List, Literal, Optional
 
 # Esquema base para usuario (atributos comunes)
 class UserBase(BaseModel):
@@ -17,6 +18,31 @@ class UserResponse(UserBase):
     class Config:
         orm_mode = True # Permite que Pydantic lea datos directamente de un modelo ORM
 
+# Resultado de una importación masiva de usuarios
+class BulkImportResult(BaseModel):
+    received: int
+    inserted: int
+    skipped: int # Usuarios omitidos porque el username o el email ya existían
+
+# Usuario en los listados de administración
+class AdminUser(UserBase):
+    id: int
+    disabled_at: Optional[datetime] = None
+
+# Página de usuarios; `next_cursor` se pasa como `cursor` para pedir la siguiente (None = última)
+class UserPage(BaseModel):
+    items: List[AdminUser]
+    next_cursor: Optional[str] = None
+
+# Ids de usuario para una operación masiva
+class BulkUserIds(BaseModel):
+    ids: List[int] = Field(min_length=1, max_length=10000)
+
+# Resultado de una operación masiva sobre usuarios
+class BulkUserResult(BaseModel):
+    requested: int
+    affected: int # Usuarios modificados (los inexistentes o ya desactivados no cuentan)
+
 # Esquema para el inicio de sesión
 class UserLogin(BaseModel):
     username: str
@@ -26,11 +52,25 @@ class UserLogin(BaseModel):
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: Optional[str] = None
+    expires_in: Optional[int] = None # Segundos de vida del access_token
+
+# Esquema para renovar el token de acceso
+class RefreshRequest(BaseModel):
+    refresh_token: str
 
 # Esquema para los datos del token
 class TokenData(BaseModel):
     username: str | None = None
 
+# Usuario autenticado resuelto a partir del token (cacheable, sin sesión de DB asociada)
+class Principal(UserBase):
+    id: int
+    token_version: int = 0
+
+    class Config:
+        from_attributes = True
+
 # Belvo Schemas
 # Esquema para Institution (Instituciones)
 class Institution(BaseModel):
@@ -98,4 +138,40 @@ class Transaction(BaseModel):
     type: str
     status: str
     category: str
-    subcategory: Optional[str] = None
\ No newline at end of file
+    subcategory: Optional[str] = None
+
+# Resumen combinado de un link. Una rama a None indica que falló; el motivo está en `errors`.
+class LinkSummary(BaseModel):
+    link_id: str
+    accounts: Optional[List[Account]] = None
+    balances: Optional[List[Balance]] = None
+    transactions: Optional[List[Transaction]] = None
+    errors: Dict[str, str] = {}
+
+# Esquemas para los links de Belvo del usuario
+class BelvoLinkCreate(BaseModel):
+    link_id: str = Field(min_length=1, max_length=64)
+    institution: Optional[str] = Field(None, max_length=100)
+
+class BelvoLinkResponse(BaseModel):
+    id: int
+    link_id: str
+    institution: Optional[str] = None
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+# Consulta en lote de varios links del usuario
+class LinkBatchRequest(BaseModel):
+    link_ids: List[str] = Field(min_length=1, max_length=500)
+    resources: List[Literal["accounts", "balances", "transactions"]] = ["accounts", "balances"]
+    transactions_limit: int = Field(100, ge=1, le=1000)
+
+    # Un resumen por link_id pedido, en el mismo orden: los repetidos se rechazan
+    @field_validator("link_ids")
+    @classmethod
+    def unique_link_ids(cls, link_ids: List[str]) -> List[str]:
+        if len(set(link_ids)) != len(link_ids):
+            raise ValueError("link_ids no puede contener ids repetidos")
+        return link_ids
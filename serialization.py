@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Any, List, Optional, Tuple
+
+from dotenv import load_dotenv
+from fastapi.responses import Response
+from pydantic import TypeAdapter
+
+import schemas
+
+load_dotenv()
+
+# Serialización rápida de las respuestas de Belvo con orjson (si está instalado).
+# FAST_JSON=false fuerza el módulo json de la biblioteca estándar.
+FAST_JSON = os.getenv("FAST_JSON", "true").lower() in ("1", "true", "yes")
+# Respuestas ya serializadas que se conservan en memoria (ver RenderCache)
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", 256))
+
+try:
+    import orjson
+except ImportError: # Dependencia opcional: sin ella se usa json
+    orjson = None
+
+JSON_ENCODER = "orjson" if FAST_JSON and orjson is not None else "json"
+
+if JSON_ENCODER == "orjson":
+    def dumps(value: Any) -> bytes:
+        return orjson.dumps(value)
+else:
+    def dumps(value: Any) -> bytes:
+        return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+# Validadores de los datos de Belvo (pydantic v2, compilados una sola vez).
+# Los datos se validan al llegar de Belvo y se guardan ya normalizados (solo los campos del
+# esquema, en tipos JSON): a partir de ahí son de confianza y se serializan sin re-validar.
+ADAPTERS = {
+    "institutions": TypeAdapter(List[schemas.Institution]),
+    "accounts": TypeAdapter(List[schemas.Account]),
+    "balances": TypeAdapter(List[schemas.Balance]),
+    "transactions": TypeAdapter(List[schemas.Transaction]),
+}
+TRANSACTION_ADAPTER = TypeAdapter(schemas.Transaction)
+
+
+def normalize(resource: str, items: list) -> list:
+    adapter = ADAPTERS[resource]
+    return adapter.dump_python(adapter.validate_python(items), mode="json")
+
+
+def normalize_transaction(item: dict) -> dict:
+    return TRANSACTION_ADAPTER.dump_python(TRANSACTION_ADAPTER.validate_python(item), mode="json")
+
+
+# ETag fuerte a partir de los bytes de la respuesta (BLAKE2b de 128 bits: rápido y sin colisiones prácticas)
+def make_etag(body: bytes) -> str:
+    return '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+# ETag débil a partir de una versión de los datos (p. ej. la fecha de la última sincronización):
+# permite responder 304 sin leer ni serializar los datos.
+def make_weak_etag(*version: Any) -> str:
+    return 'W/"%s"' % hashlib.blake2b(repr(version).encode(), digest_size=16).hexdigest()
+
+
+# Comparación débil de If-None-Match (RFC 9110): lista de ETags separados por comas, o "*"
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+
+# Respuesta JSON serializada con `dumps`. Devolverla desde una ruta evita la validación
+# de response_model y el codificador de FastAPI: solo para datos ya normalizados.
+class FastJSONResponse(Response):
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+
+
+# Memoria de respuestas ya serializadas. Si el valor que devuelve la caché de Belvo es el
+# mismo objeto que la última vez (caché en memoria), se reutilizan sus bytes y su ETag sin
+# volver a serializar ni a calcular el hash. Con un backend externo cada lectura es un objeto
+# nuevo y se serializa de nuevo.
+class RenderCache:
+    def __init__(self, max_entries: int = RENDER_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # Métricas
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, key: str, value: Any) -> bytes:
+        return self.render_with_etag(key, value)[0]
+
+    # Devuelve (bytes, ETag)
+    def render_with_etag(self, key: str, value: Any) -> Tuple[bytes, str]:
+        cached: Optional[tuple] = self._entries.get(key)
+        if cached is not None and cached[0] is value:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return cached[1], cached[2]
+        self.misses += 1
+        body = dumps(value)
+        etag = make_etag(body)
+        self._entries[key] = (value, body, etag)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return body, etag
+
+    def stats(self) -> dict:
+        return {
+            "encoder": JSON_ENCODER,
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+render_cache = RenderCache()
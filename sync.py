@@ -0,0 +1,316 @@
+import asyncio
+import os
+import random
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from sqlalchemy import insert, update
+from sqlalchemy.future import select
+
+import belvo_api, models
+from database import AsyncSessionLocal
+
+load_dotenv()
+
+# Sincronización en segundo plano de los datos de Belvo hacia la base de datos local
+BELVO_SYNC_ENABLED = os.getenv("BELVO_SYNC_ENABLED", "true").lower() in ("1", "true", "yes")
+# Cada cuánto se sincroniza cada link (segundos), con un reparto aleatorio de ±BELVO_SYNC_JITTER
+# (fracción) para que los links no se sincronicen todos a la vez
+BELVO_SYNC_INTERVAL = float(os.getenv("BELVO_SYNC_INTERVAL", 900))
+BELVO_SYNC_JITTER = float(os.getenv("BELVO_SYNC_JITTER", 0.2))
+# Cada cuánto el planificador busca links pendientes y cuántos sincroniza a la vez
+BELVO_SYNC_TICK = float(os.getenv("BELVO_SYNC_TICK", 10))
+BELVO_SYNC_CONCURRENCY = int(os.getenv("BELVO_SYNC_CONCURRENCY", 4))
+BELVO_SYNC_BATCH = int(os.getenv("BELVO_SYNC_BATCH", 100))
+# Días que se vuelven a pedir por detrás de la marca de agua: Belvo puede añadir o corregir
+# transacciones con fecha valor pasada (p. ej. pendientes que se confirman)
+BELVO_SYNC_OVERLAP_DAYS = int(os.getenv("BELVO_SYNC_OVERLAP_DAYS", 3))
+# Tiempo que un nodo se reserva un link mientras lo sincroniza (evita duplicar trabajo entre workers)
+BELVO_SYNC_LEASE = float(os.getenv("BELVO_SYNC_LEASE", 300))
+BELVO_SYNC_PAGE_SIZE = int(os.getenv("BELVO_SYNC_PAGE_SIZE", 500))
+# Filas por sentencia de upsert
+BELVO_SYNC_UPSERT_BATCH = int(os.getenv("BELVO_SYNC_UPSERT_BATCH", 500))
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _parse_date(value) -> date:
+    return date.fromisoformat(str(value)[:10])
+
+
+# INSERT ... ON DUPLICATE KEY UPDATE (MySQL) / ON CONFLICT DO UPDATE (SQLite, PostgreSQL).
+# Reaplicar la misma página deja la tabla igual: la sincronización es idempotente.
+def _upsert_statement(dialect: str, table, update_columns: Iterable[str]):
+    if dialect == "mysql":
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+        statement = mysql_insert(table)
+        return statement.on_duplicate_key_update({c: statement.inserted[c] for c in update_columns})
+    if dialect in ("sqlite", "postgresql"):
+        if dialect == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        statement = dialect_insert(table)
+        return statement.on_conflict_do_update(
+            index_elements=[c.name for c in table.primary_key.columns],
+            set_={c: statement.excluded[c] for c in update_columns},
+        )
+    raise NotImplementedError(f"Upsert no soportado para el dialecto {dialect!r}")
+
+
+# Solo se actualizan las columnas presentes en las filas: las demás conservan su valor.
+async def upsert_rows(db, model, rows: List[dict], batch_size: int = BELVO_SYNC_UPSERT_BATCH) -> int:
+    if not rows:
+        return 0
+    table = model.__table__
+    update_columns = [c.name for c in table.columns if not c.primary_key and c.name in rows[0]]
+    statement = _upsert_statement(db.get_bind().dialect.name, table, update_columns)
+    for start in range(0, len(rows), batch_size):
+        await db.execute(statement, rows[start:start + batch_size])
+    return len(rows)
+
+
+# Motor de sincronización: copia cuentas, balances y transacciones de cada link registrado
+# a las tablas locales (models.BelvoAccount, ...). Las rutas de lectura sirven desde ahí.
+# - Incremental: las transacciones se piden desde la marca de agua (última fecha valor vista)
+#   menos BELVO_SYNC_OVERLAP_DAYS; lo ya guardado se actualiza con un upsert.
+# - Planificador: cada BELVO_SYNC_TICK segundos reserva los links vencidos (UPDATE condicional
+#   sobre next_sync_at, así dos workers no sincronizan el mismo link) y los procesa con
+#   como mucho BELVO_SYNC_CONCURRENCY a la vez.
+# - sync_link() también se puede llamar bajo demanda (refresh=true); las llamadas concurrentes
+#   para el mismo link comparten una única sincronización.
+class BelvoSyncEngine:
+    def __init__(
+        self,
+        client: Optional[belvo_api.BelvoClient] = None,
+        session_factory=AsyncSessionLocal,
+        *,
+        interval: float = BELVO_SYNC_INTERVAL,
+        jitter: float = BELVO_SYNC_JITTER,
+        concurrency: int = BELVO_SYNC_CONCURRENCY,
+        overlap_days: int = BELVO_SYNC_OVERLAP_DAYS,
+        page_size: int = BELVO_SYNC_PAGE_SIZE,
+    ):
+        self.client = client
+        self.session_factory = session_factory
+        self.interval = interval
+        self.jitter = jitter
+        self.concurrency = max(1, concurrency)
+        self.overlap_days = overlap_days
+        self.page_size = page_size
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        # Métricas
+        self.runs = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.transactions_upserted = 0
+        self.last_duration = 0.0
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def _next_sync_at(self, now: datetime) -> datetime:
+        spread = self.interval * self.jitter
+        return now + timedelta(seconds=max(0.0, self.interval + random.uniform(-spread, spread)))
+
+    async def sync_link(self, link_id: str) -> models.BelvoSyncState:
+        task = self._inflight.get(link_id)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(self._run_sync(link_id))
+            self._inflight[link_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(link_id, None))
+        # shield: si el cliente que pidió el refresco se desconecta, la sincronización termina igual
+        return await asyncio.shield(task)
+
+    async def _run_sync(self, link_id: str) -> models.BelvoSyncState:
+        async with self._get_semaphore():
+            started = time.perf_counter()
+            try:
+                return await self._sync(link_id)
+            except Exception as e:
+                self.failures += 1
+                await self._record_failure(link_id, e)
+                raise
+            finally:
+                self.runs += 1
+                self.last_duration = time.perf_counter() - started
+
+    # Upsert de unas filas del link en su propia transacción corta. En la misma transacción se
+    # incrementa data_version: el ETag de la copia local cambia con cada bloque que se guarda,
+    # también si la sincronización se interrumpe antes de terminar.
+    async def _save_rows(self, link_id: str, model, rows: List[dict]) -> int:
+        if not rows:
+            return 0
+        async with self.session_factory() as db:
+            count = await upsert_rows(db, model, rows)
+            await db.execute(
+                update(models.BelvoSyncState)
+                .where(models.BelvoSyncState.link_id == link_id)
+                .values(data_version=models.BelvoSyncState.data_version + 1)
+            )
+            await db.commit()
+        return count
+
+    # Guarda la marca de agua al final de una sincronización completa y devuelve el estado
+    async def _save_state(self, link_id: str, values: dict) -> models.BelvoSyncState:
+        async with self.session_factory() as db:
+            await upsert_rows(db, models.BelvoSyncState, [{"link_id": link_id, **values}])
+            await db.commit()
+            return await db.get(models.BelvoSyncState, link_id, populate_existing=True)
+
+    async def _sync(self, link_id: str) -> models.BelvoSyncState:
+        async with self.session_factory() as db:
+            state = await db.get(models.BelvoSyncState, link_id)
+            watermark = (state.last_value_date, state.last_transaction_id) if state and state.last_value_date else None
+            if state is None:
+                # data_version se incrementa sobre la fila de estado: tiene que existir antes del primer bloque
+                await self._ensure_states(db, [link_id], _utcnow())
+                await db.commit()
+
+        # Nunca hay una transacción abierta en la DB mientras se espera a Belvo: cada bloque de
+        # filas se guarda en una transacción corta después de recibirlo. Si la sincronización se
+        # interrumpe a medias, la marca de agua no avanza y la siguiente repite el tramo (upsert).
+        accounts, balances = await asyncio.gather(
+            belvo_api.fetch_belvo_resource(self.client, "accounts", link_id),
+            belvo_api.fetch_belvo_resource(self.client, "balances", link_id),
+        )
+        date_from = watermark[0] - timedelta(days=self.overlap_days) if watermark else None
+        now = _utcnow()
+        await self._save_rows(link_id, models.BelvoAccount, [
+            {"id": a["id"], "link_id": link_id, "data": a, "synced_at": now} for a in accounts
+        ])
+        await self._save_rows(link_id, models.BelvoBalance, [
+            {"id": b["id"], "link_id": link_id, "account_id": b.get("account_id"), "data": b, "synced_at": now}
+            for b in balances
+        ])
+        # Las transacciones se guardan página a página: memoria acotada aunque el link tenga años de historial
+        page: List[dict] = []
+        async for transaction in belvo_api.iter_belvo_transactions(
+            self.client, link_id=link_id, page_size=self.page_size, date_from=date_from
+        ):
+            value_date = _parse_date(transaction["value_date"])
+            page.append({
+                "id": transaction["id"],
+                "link_id": link_id,
+                "account_id": (transaction.get("account") or {}).get("id"),
+                "value_date": value_date,
+                "data": transaction,
+                "synced_at": now,
+            })
+            if watermark is None or (value_date, transaction["id"]) > watermark:
+                watermark = (value_date, transaction["id"])
+            if len(page) >= self.page_size:
+                self.transactions_upserted += await self._save_rows(link_id, models.BelvoTransaction, page)
+                page = []
+        self.transactions_upserted += await self._save_rows(link_id, models.BelvoTransaction, page)
+
+        values = {
+            "last_value_date": watermark[0] if watermark else None,
+            "last_transaction_id": watermark[1] if watermark else None,
+            "last_synced_at": now,
+            "next_sync_at": self._next_sync_at(now),
+            "last_error": None,
+        }
+        return await self._save_state(link_id, values)
+
+    # Guarda el error y reprograma el link (con el mismo intervalo y jitter) sin tocar la marca de agua
+    async def _record_failure(self, link_id: str, error: Exception):
+        detail = error.detail if isinstance(error, HTTPException) else repr(error)
+        now = _utcnow()
+        try:
+            async with self.session_factory() as db:
+                await self._ensure_states(db, [link_id], now)
+                await db.execute(
+                    update(models.BelvoSyncState)
+                    .where(models.BelvoSyncState.link_id == link_id)
+                    .values(last_error=str(detail)[:1000], next_sync_at=self._next_sync_at(now))
+                )
+                await db.commit()
+        except Exception as e:
+            print(f"Error guardando el estado de sincronización del link {link_id}: {e}")
+
+    # Crea el estado de un link que aún no lo tiene (vencido desde ya). Normalmente ya existe:
+    # se crea al registrar el link (crud.create_user_link).
+    async def _ensure_states(self, db, link_ids: List[str], now: datetime):
+        if not link_ids:
+            return
+        statement = (
+            insert(models.BelvoSyncState)
+            .prefix_with("IGNORE", dialect="mysql")
+            .prefix_with("OR IGNORE", dialect="sqlite")
+        )
+        await db.execute(statement, [{"link_id": link_id, "next_sync_at": now} for link_id in link_ids])
+
+    # Reserva hasta `limit` links vencidos: cada UPDATE condicional solo tiene éxito en un worker.
+    # Una sola consulta con LIMIT sobre el índice de next_sync_at, sin importar cuántos links haya.
+    async def claim_due_links(self, limit: int = BELVO_SYNC_BATCH) -> List[str]:
+        now = _utcnow()
+        async with self.session_factory() as db:
+            due = (await db.execute(
+                select(models.BelvoSyncState.link_id)
+                .where(
+                    models.BelvoSyncState.next_sync_at <= now,
+                    models.BelvoSyncState.link_id.in_(
+                        select(models.BelvoLink.link_id)
+                    ),
+                )
+                .order_by(models.BelvoSyncState.next_sync_at)
+                .limit(limit)
+            )).scalars().all()
+            claimed = []
+            lease_until = now + timedelta(seconds=BELVO_SYNC_LEASE)
+            for link_id in due:
+                result = await db.execute(
+                    update(models.BelvoSyncState)
+                    .where(models.BelvoSyncState.link_id == link_id, models.BelvoSyncState.next_sync_at <= now)
+                    .values(next_sync_at=lease_until)
+                )
+                if result.rowcount:
+                    claimed.append(link_id)
+            await db.commit()
+        return claimed
+
+    # Una pasada del planificador; los errores de un link no afectan a los demás
+    async def run_once(self) -> int:
+        link_ids = await self.claim_due_links()
+        results = await asyncio.gather(*(self.sync_link(link_id) for link_id in link_ids), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException) and not isinstance(result, Exception):
+                raise result
+        return len(link_ids)
+
+    # Bucle del planificador (se lanza en el arranque de la aplicación)
+    async def run(self, tick: float = BELVO_SYNC_TICK):
+        # Arranque escalonado: varios workers iniciados a la vez no consultan la DB al unísono
+        await asyncio.sleep(random.uniform(0, tick))
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error en el planificador de sincronización de Belvo: {e}")
+            await asyncio.sleep(tick * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def stats(self) -> dict:
+        return {
+            "runs": self.runs,
+            "failures": self.failures,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._inflight),
+            "transactions_upserted": self.transactions_upserted,
+            "last_duration_seconds": round(self.last_duration, 6),
+        }
+
+
+sync_engine = BelvoSyncEngine()
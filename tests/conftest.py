@@ -0,0 +1,20 @@
+# Configuración común de las pruebas: los módulos de la aplicación leen el entorno al
+# importarse, así que se fija aquí, antes de que cualquier prueba los importe.
+# Requiere además pytest y aiosqlite: python -m pytest
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ.setdefault("BELVO_SECRET_ID", "test")
+os.environ.setdefault("BELVO_SECRET_PASSWORD", "test")
+# Base de datos por defecto de database.engine; las pruebas que usan la DB crean la suya
+os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'app.db')}"
+os.environ["BELVO_SYNC_ENABLED"] = "false"
+# Sin almacén compartido: cada prueba construye el suyo
+for name in ("SHARED_STATE_URL", "REDIS_URL", "INVALIDATION_URL"):
+    os.environ.pop(name, None)
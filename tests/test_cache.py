@@ -0,0 +1,135 @@
+# Caché de respuestas (cache.py): single-flight, stale-while-revalidate y errores
+import asyncio
+import gc
+
+import pytest
+
+from cache import KVBackend, MemoryBackend, ResponseCache
+from kvstore import LocalKV
+
+
+class Upstream:
+    """Función de carga que cuenta sus llamadas y se puede bloquear o hacer fallar."""
+
+    def __init__(self):
+        self.calls = 0
+        self.release = asyncio.Event()
+        self.release.set()
+        self.failing = False
+
+    async def __call__(self):
+        self.calls += 1
+        await self.release.wait()
+        if self.failing:
+            raise RuntimeError("belvo caído")
+        return {"version": self.calls}
+
+
+@pytest.fixture(params=["memory", "kv"])
+def make_cache(request):
+    def make():
+        backend = MemoryBackend() if request.param == "memory" else KVBackend(LocalKV())
+        return ResponseCache(backend)
+    return make
+
+
+def test_concurrent_misses_share_one_fetch(make_cache):
+    async def scenario():
+        cache, upstream = make_cache(), Upstream()
+        upstream.release.clear()
+        waiters = [asyncio.ensure_future(cache.get_or_fetch("k", upstream, ttl=60)) for _ in range(10)]
+        await asyncio.sleep(0)
+        upstream.release.set()
+        results = await asyncio.gather(*waiters)
+        assert upstream.calls == 1
+        assert results == [{"version": 1}] * 10
+        assert cache.stats()["coalesced"] == 9
+        # Ya en caché: sin más llamadas
+        assert await cache.get_or_fetch("k", upstream, ttl=60) == {"version": 1}
+        assert upstream.calls == 1
+    asyncio.run(scenario())
+
+
+def test_cancelled_waiter_does_not_cancel_shared_fetch(make_cache):
+    async def scenario():
+        cache, upstream = make_cache(), Upstream()
+        upstream.release.clear()
+        first = asyncio.ensure_future(cache.get_or_fetch("k", upstream, ttl=60))
+        second = asyncio.ensure_future(cache.get_or_fetch("k", upstream, ttl=60))
+        await asyncio.sleep(0)
+        first.cancel()
+        upstream.release.set()
+        assert await second == {"version": 1}
+        assert first.cancelled()
+        assert upstream.calls == 1
+    asyncio.run(scenario())
+
+
+def test_stale_entry_is_served_while_refreshing(make_cache):
+    async def scenario():
+        cache, upstream = make_cache(), Upstream()
+        assert await cache.get_or_fetch("k", upstream, ttl=0.05, stale_ttl=60) == {"version": 1}
+        await asyncio.sleep(0.1)
+        # Caducada pero dentro de stale_ttl: se responde al momento con el valor viejo...
+        upstream.release.clear()
+        assert await cache.get_or_fetch("k", upstream, ttl=0.05, stale_ttl=60) == {"version": 1}
+        assert await cache.get_or_fetch("k", upstream, ttl=0.05, stale_ttl=60) == {"version": 1}
+        assert cache.stats()["stale_hits"] == 2
+        # ...con una sola revalidación en segundo plano, que luego sustituye la entrada
+        upstream.release.set()
+        await asyncio.sleep(0.01)
+        assert upstream.calls == 2
+        assert await cache.get_or_fetch("k", upstream, ttl=60) == {"version": 2}
+    asyncio.run(scenario())
+
+
+def test_errors_are_not_cached(make_cache):
+    async def scenario():
+        cache, upstream = make_cache(), Upstream()
+        upstream.failing = True
+        upstream.release.clear()
+        waiters = [asyncio.ensure_future(cache.get_or_fetch("k", upstream, ttl=60)) for _ in range(3)]
+        await asyncio.sleep(0)
+        upstream.release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert all(isinstance(result, RuntimeError) for result in results)
+        assert upstream.calls == 1
+        assert cache.stats()["in_flight"] == 0
+        # La siguiente petición vuelve a llamar al origen
+        upstream.failing = False
+        assert await cache.get_or_fetch("k", upstream, ttl=60) == {"version": 2}
+    asyncio.run(scenario())
+
+
+def test_failed_refresh_keeps_stale_entry(make_cache):
+    async def scenario():
+        cache, upstream = make_cache(), Upstream()
+        await cache.get_or_fetch("k", upstream, ttl=0.05, stale_ttl=60)
+        await asyncio.sleep(0.1)
+        upstream.failing = True
+        assert await cache.get_or_fetch("k", upstream, ttl=0.05, stale_ttl=60) == {"version": 1}
+        await asyncio.sleep(0.01)
+        assert cache.stats()["refresh_errors"] == 1
+        assert await cache.get_or_fetch("k", upstream, ttl=0.05, stale_ttl=60) == {"version": 1}
+    asyncio.run(scenario())
+
+
+def test_unretrieved_fetch_error_is_not_reported(make_cache):
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        reported = []
+        loop.set_exception_handler(lambda _, context: reported.append(context))
+        cache, upstream = make_cache(), Upstream()
+        upstream.failing = True
+        upstream.release.clear()
+        # El único cliente se desconecta: nadie recoge el error de la llamada compartida
+        waiter = asyncio.ensure_future(cache.get_or_fetch("k", upstream, ttl=60))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        # La llamada falla después de que el cliente se haya ido
+        await asyncio.sleep(0.01)
+        upstream.release.set()
+        await asyncio.sleep(0.01)
+        gc.collect()
+        assert reported == []
+    asyncio.run(scenario())
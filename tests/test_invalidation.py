@@ -0,0 +1,153 @@
+# Invalidación entre workers (invalidation.py): cada "worker" tiene su bus y sus cachés, y
+# solo comparten el almacén (un LocalKV, o dos conexiones al mismo fichero shm://)
+import asyncio
+import time
+
+import pytest
+
+import schemas
+from cache import KVBackend, ResponseCache
+from invalidation import InvalidationBus, invalidation_bus
+from kvstore import LocalKV, SharedMemoryKV
+from principals import PrincipalCache, principal_cache
+from revocation import RevocationIndex, revocation_index
+from serialization import RenderCache
+
+
+class Worker:
+    """Estado en memoria de un proceso, conectado al bus como en invalidation.py."""
+
+    def __init__(self, kv):
+        self.principals = PrincipalCache()
+        self.revocations = RevocationIndex()
+        self.bus = InvalidationBus(kv, channel="test:invalidate")
+        self.bus.on("user", lambda user_id: self.principals.invalidate_user(user_id))
+        self.bus.on("users", lambda user_ids: self.principals.invalidate_users(user_ids))
+        self.bus.on("revoked", lambda jti, expires_at: self.revocations.add(jti, expires_at))
+
+    async def __aenter__(self):
+        self.listener = asyncio.ensure_future(self.bus.run())
+        await asyncio.sleep(0.05) # Suscrito antes de que nadie publique
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.listener.cancel()
+        await asyncio.gather(self.listener, return_exceptions=True)
+
+
+@pytest.fixture(params=["local", "shm"])
+def open_stores(request, tmp_path):
+    def open_stores():
+        if request.param == "local":
+            kv = LocalKV()
+            return [kv, kv]
+        return [SharedMemoryKV(str(tmp_path / "kv.db"), poll_interval=0.01) for _ in range(2)]
+    return open_stores
+
+
+async def _close(stores):
+    for kv in {id(kv): kv for kv in stores}.values():
+        await kv.aclose()
+
+
+async def _eventually(condition, timeout: float = 2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "la invalidación no llegó al otro worker"
+        await asyncio.sleep(0.01)
+
+
+def _principal(user_id: int) -> schemas.Principal:
+    return schemas.Principal(id=user_id, username=f"user{user_id}", email=f"user{user_id}@example.com")
+
+
+def test_user_invalidation_reaches_other_workers(open_stores):
+    async def scenario():
+        stores = open_stores()
+        try:
+            async with Worker(stores[0]) as first, Worker(stores[1]) as second:
+                issued_at = time.time() - 1
+                for worker in (first, second):
+                    worker.principals.put(_principal(7))
+                    worker.principals.put(_principal(8))
+                # El worker que modifica al usuario lo aplica en local y lo difunde
+                first.principals.invalidate_user(7)
+                await first.bus.publish("user", user_id=7)
+                await _eventually(lambda: second.principals.get(7, 0) is None)
+                assert second.principals.is_invalidated(7, issued_at)
+                assert second.principals.get(8, 0) is not None
+                # Nadie procesa sus propios mensajes
+                assert first.bus.stats()["received"] == 0
+                assert second.bus.stats()["received"] == 1
+
+                await second.bus.publish("users", user_ids=[8, 9])
+                await _eventually(lambda: first.principals.get(8, 0) is None)
+                assert first.principals.is_invalidated(9, issued_at)
+        finally:
+            await _close(stores)
+    asyncio.run(scenario())
+
+
+def test_revocation_reaches_other_workers(open_stores):
+    async def scenario():
+        stores = open_stores()
+        try:
+            async with Worker(stores[0]) as first, Worker(stores[1]) as second:
+                first.revocations.add("jti-1", time.time() + 60)
+                await first.bus.publish("revoked", jti="jti-1", expires_at=time.time() + 60)
+                await _eventually(lambda: second.revocations.is_revoked("jti-1"))
+                assert not second.revocations.is_revoked("jti-2")
+        finally:
+            await _close(stores)
+    asyncio.run(scenario())
+
+
+def test_module_bus_updates_module_caches(monkeypatch):
+    # El bus de la aplicación aplica los mensajes de otros procesos a principal_cache y revocation_index
+    async def scenario():
+        kv = LocalKV()
+        monkeypatch.setattr(invalidation_bus, "kv", kv)
+        listener = asyncio.ensure_future(invalidation_bus.run())
+        await asyncio.sleep(0.05)
+        other = InvalidationBus(kv, channel=invalidation_bus.channel)
+        try:
+            principal_cache.put(_principal(41))
+            await other.publish("user", user_id=41)
+            await other.publish("revoked", jti="module-jti", expires_at=time.time() + 60)
+            await _eventually(lambda: revocation_index.is_revoked("module-jti"))
+            assert principal_cache.get(41, 0) is None
+            assert principal_cache.is_invalidated(41, time.time() - 1)
+        finally:
+            listener.cancel()
+            await asyncio.gather(listener, return_exceptions=True)
+            principal_cache.clear()
+    asyncio.run(scenario())
+
+
+def test_shared_belvo_cache_invalidation_rerenders_on_other_workers(open_stores):
+    # render_cache no necesita mensajes: reutiliza los bytes solo mientras la caché de Belvo
+    # devuelva el mismo objeto, y una clave invalidada en el almacén compartido trae uno nuevo
+    async def scenario():
+        stores = open_stores()
+        calls = []
+
+        async def fetch():
+            calls.append(1)
+            return {"version": len(calls)}
+
+        try:
+            caches = [ResponseCache(KVBackend(kv)) for kv in stores]
+            renderers = [RenderCache(), RenderCache()]
+            await caches[0].get_or_fetch("accounts:link", fetch, ttl=60)
+            value = await caches[1].get_or_fetch("accounts:link", fetch, ttl=60)
+            body, etag = renderers[1].render_with_etag("accounts:link", value)
+            assert len(calls) == 1
+
+            await caches[0].invalidate("accounts:link")
+            value = await caches[1].get_or_fetch("accounts:link", fetch, ttl=60)
+            new_body, new_etag = renderers[1].render_with_etag("accounts:link", value)
+            assert len(calls) == 2
+            assert (new_body, new_etag) != (body, etag)
+        finally:
+            await _close(stores)
+    asyncio.run(scenario())
@@ -0,0 +1,101 @@
+# Backends de estado compartido (kvstore.py): TTL, contadores y pub/sub entre dos clientes
+# del mismo almacén. Con el paquete redis instalado se prueba también RedisKV contra kv_server.
+import asyncio
+import contextlib
+
+import pytest
+
+import kvstore
+from kv_server import KVServer
+from kvstore import LocalKV, SharedMemoryKV
+
+
+# Dos clientes sobre el mismo almacén (dos workers): el mismo LocalKV, dos conexiones al mismo
+# fichero shm:// o dos clientes de Redis contra un kv_server en un puerto libre
+@contextlib.asynccontextmanager
+async def open_stores(backend: str, tmp_path):
+    server = None
+    if backend == "local":
+        kv = LocalKV()
+        stores = [kv, kv]
+    elif backend == "shm":
+        stores = [SharedMemoryKV(str(tmp_path / "kv.db"), poll_interval=0.01) for _ in range(2)]
+    else:
+        redis_asyncio = pytest.importorskip("redis.asyncio")
+        server = await asyncio.start_server(KVServer().handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        stores = [kvstore.RedisKV(redis_asyncio.from_url(f"redis://127.0.0.1:{port}/0")) for _ in range(2)]
+    try:
+        yield stores
+    finally:
+        for kv in {id(kv): kv for kv in stores}.values():
+            await kv.aclose()
+        if server is not None:
+            server.close()
+
+
+BACKENDS = ["local", "shm", "redis"]
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_values_expire_with_their_ttl(backend, tmp_path):
+    async def scenario():
+        async with open_stores(backend, tmp_path) as (first, second):
+            await first.set("permanent", "a")
+            await first.set("short", b"b", px=100)
+            assert await second.get("permanent") == b"a"
+            assert await second.get("short") == b"b"
+            assert await second.pttl("permanent") == -1
+            assert 0 < await second.pttl("short") <= 100
+            assert await second.pttl("missing") == -2
+            await asyncio.sleep(0.15)
+            assert await second.get("short") is None
+            assert await second.pttl("short") == -2
+            assert await second.delete("short", "permanent") == 1
+            assert await first.get("permanent") is None
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_pexpire_and_incrby(backend, tmp_path):
+    async def scenario():
+        async with open_stores(backend, tmp_path) as (first, second):
+            assert not await first.pexpire("counter", 100)
+            # Incrementos concurrentes desde los dos clientes: ninguno se pierde
+            await asyncio.gather(*(kv.incrby("counter", 1) for kv in (first, second) for _ in range(20)))
+            assert await first.incrby("counter", 0) == 40
+            assert await second.pexpire("counter", 100)
+            await asyncio.sleep(0.15)
+            # Caducado: el contador vuelve a empezar
+            assert await first.incrby("counter", 5) == 5
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("backend", BACKENDS)
+def test_publish_reaches_subscribers_of_other_clients(backend, tmp_path):
+    async def scenario():
+        async with open_stores(backend, tmp_path) as (publisher, subscriber):
+            # Solo se reciben los mensajes publicados después de suscribirse
+            await publisher.publish("chan", "before")
+            messages = subscriber.subscribe("chan")
+            first = asyncio.ensure_future(messages.__anext__())
+            await asyncio.sleep(0.1)
+            await publisher.publish("other", "ignored")
+            await publisher.publish("chan", "one")
+            await publisher.publish("chan", b"two")
+            assert await asyncio.wait_for(first, 2) == b"one"
+            assert await asyncio.wait_for(messages.__anext__(), 2) == b"two"
+            await messages.aclose()
+    asyncio.run(scenario())
+
+
+def test_connect_kv_shares_clients_by_url(tmp_path):
+    async def scenario():
+        url = f"shm://{tmp_path / 'kv.db'}"
+        try:
+            assert kvstore.connect_kv(None) is None
+            assert kvstore.connect_kv(url) is kvstore.connect_kv(url)
+            assert isinstance(kvstore.connect_kv("local://"), LocalKV)
+        finally:
+            await kvstore.close_all()
+    asyncio.run(scenario())
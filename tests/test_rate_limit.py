@@ -0,0 +1,99 @@
+# Limitador de intentos de login (rate_limit.py) con el estado compartido entre workers
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import rate_limit
+from kvstore import LocalKV, SharedMemoryKV
+from rate_limit import KVRateLimitBackend, LoginRateLimiter, MemoryRateLimitBackend
+
+
+# Dos workers con su propio limitador sobre el mismo almacén: un LocalKV compartido, o dos
+# conexiones al mismo fichero shm:// (como dos procesos)
+@pytest.fixture(params=["local", "shm"])
+def open_workers(request, tmp_path):
+    def open_workers():
+        if request.param == "local":
+            kv = LocalKV()
+            stores = [kv, kv]
+        else:
+            stores = [SharedMemoryKV(str(tmp_path / "kv.db"), poll_interval=0.01) for _ in range(2)]
+        return stores, [LoginRateLimiter(KVRateLimitBackend(kv)) for kv in stores]
+    return open_workers
+
+
+async def _close(stores):
+    for kv in set(stores):
+        await kv.aclose()
+
+
+async def _rejected(limiter: LoginRateLimiter, ip: str, username: str) -> HTTPException:
+    with pytest.raises(HTTPException) as raised:
+        await limiter.check(ip, username)
+    assert raised.value.status_code == 429
+    assert int(raised.value.headers["Retry-After"]) >= 1
+    return raised.value
+
+
+def test_username_limit_is_shared_between_workers(open_workers):
+    async def scenario():
+        stores, (first, second) = open_workers()
+        try:
+            # Cada intento desde una IP distinta: solo cuenta el límite por usuario
+            for attempt in range(rate_limit.LOGIN_RATE_USERNAME_CAPACITY):
+                await (first, second)[attempt % 2].check(f"10.0.0.{attempt}", "Ana")
+            await _rejected(second, "10.0.1.1", "ana ")
+            assert second.stats()["rejected_username"] == 1
+            # Otro usuario no se ve afectado
+            await first.check("10.0.1.2", "bea")
+        finally:
+            await _close(stores)
+    asyncio.run(scenario())
+
+
+def test_lockout_is_shared_and_expires(open_workers, monkeypatch):
+    monkeypatch.setattr(rate_limit, "LOGIN_BACKOFF_THRESHOLD", 2)
+    monkeypatch.setattr(rate_limit, "LOGIN_BACKOFF_BASE", 0.2)
+
+    async def scenario():
+        stores, (first, second) = open_workers()
+        try:
+            await first.record_failure("ana")
+            await first.check("10.0.0.1", "ana")
+            await first.record_failure("ana")
+            # El bloqueo lo impuso un worker y lo respeta el otro, antes de tocar los buckets
+            await _rejected(second, "10.0.0.2", "ana")
+            assert second.stats()["rejected_lockout"] == 1
+            # Caduca con el TTL de la clave
+            await asyncio.sleep(0.3)
+            await second.check("10.0.0.3", "ana")
+        finally:
+            await _close(stores)
+    asyncio.run(scenario())
+
+
+def test_success_clears_failures(open_workers, monkeypatch):
+    monkeypatch.setattr(rate_limit, "LOGIN_BACKOFF_THRESHOLD", 2)
+
+    async def scenario():
+        stores, (first, second) = open_workers()
+        try:
+            await first.record_failure("ana")
+            await second.record_success("ana")
+            # El contador volvió a cero: un fallo más no llega al umbral
+            await first.record_failure("ana")
+            await second.check("10.0.0.1", "ana")
+            assert first.stats()["lockouts"] == 0
+        finally:
+            await _close(stores)
+    asyncio.run(scenario())
+
+
+def test_memory_bucket_refills():
+    async def scenario():
+        backend = MemoryRateLimitBackend()
+        assert [(await backend.take("k", 2, 20))[0] for _ in range(3)] == [True, True, False]
+        await asyncio.sleep(0.06)
+        assert (await backend.take("k", 2, 20))[0]
+    asyncio.run(scenario())